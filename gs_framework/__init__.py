@@ -1,19 +1,20 @@
 # -*- coding: UTF-8 -*-
 from .state_variable import StateVariable
 from .stateful_object import State
-from .service import StatefulService, StatelessService
+from .service import StatefulService, StatelessService, ServiceHost
 from .activatable_stateful_service import Env, Agent, Episode
 from .object_reference import ObjectRef
 from .state_stream import ObjectStateStream
-from .state_var_change_dispatcher import state_var_change_handler, pick_one_change
+from .state_var_change_dispatcher import state_var_change_handler, pick_one_change, object_removed_handler
 from .state_storage import StateStreamStorage
 from .stateful_object import create_stateful_object
 from .timer_handler import timer
 from .crontab_handler import crontab
 from .handler import StatefulObjectAndCommitStream
 
-__all__ = ["StateVariable", "State", "StatefulService", "StatelessService", "Env", "Agent", "Episode", "ObjectRef",
-           "ObjectStateStream", "state_var_change_handler", "pick_one_change",
+__all__ = ["StateVariable", "State", "StatefulService", "StatelessService", "ServiceHost", "Env", "Agent", "Episode",
+           "ObjectRef",
+           "ObjectStateStream", "state_var_change_handler", "pick_one_change", "object_removed_handler",
            "StateStreamStorage", "create_stateful_object", "timer", "crontab","StatefulObjectAndCommitStream"]
 
 # 暂时为了方便，将 loging 的输出级别写在了 __init__ 中
@@ -27,8 +27,8 @@ class Activatable(State):
 
 class Env(StatefulService, Activatable):
 
-    async def start(self):
-        await super().start()
+    async def _post_start(self):
+        await super()._post_start()
         self.active.VALUE = 1
         await self.commit_state_var_changes()
 
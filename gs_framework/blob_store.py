@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+"""
+Claim-check store for large state var values
+
+For topics enabled by BlobStore.enable, state var values whose serialized size is over the threshold are written into
+a content addressed file store, and messages carry a BlobRef instead. Stream storages save the BlobRef as it is, so the
+tables and their changelogs stay small, and identical values are stored once.
+
+BlobRefs are resolved when the value is read by stateful objects (refer to MessageAsStateReader) or by state storages,
+and the dispatcher resolves the values of the state vars handled before state var change handlers run. The bytes of
+the latest resolved blobs are kept in an LRU cache.
+
+The store dir must be shared by the senders and receivers, for example a local dir for services of one node, or a
+shared file system mount.
+"""
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import NamedTuple, Any, Dict, Optional, Union, Tuple
+
+from .metrics import Metrics
+from .shared_memory_values import SharedValueHandle
+from .utilities import object_2_bytes, bytes_2_object, generate_uuid
+
+logger = logging.getLogger(__name__)
+
+
+class BlobRef(NamedTuple):
+    """sent in place of a state var value kept in the blob store"""
+
+    digest: str
+    """sha256 of the serialized value"""
+    size: int
+
+
+class BlobStore:
+    """Opt in per topic, the store dir and the cache are shared by the topics"""
+
+    _store_dir: Optional[str] = None
+    _threshold_bytes_by_topic: Dict[str, int] = dict()
+    _cache_max_bytes: int = 0
+    _cache_bytes: int = 0
+    _cache: Dict[str, bytes] = OrderedDict()
+
+    @staticmethod
+    def enable(topic_name: str, store_dir: str = "/opt/gsfaust/blobs", threshold_bytes: int = 256 * 1024,
+               cache_max_bytes: int = 256 * 1024 * 1024):
+        os.makedirs(store_dir, exist_ok=True)
+        BlobStore._store_dir = store_dir
+        BlobStore._threshold_bytes_by_topic[topic_name] = threshold_bytes
+        BlobStore._cache_max_bytes = cache_max_bytes
+
+    @staticmethod
+    def is_enabled(topic_name: str) -> bool:
+        return topic_name in BlobStore._threshold_bytes_by_topic
+
+    @staticmethod
+    def _blob_path(digest: str) -> str:
+        return os.path.join(BlobStore._store_dir, digest[:2], digest)
+
+    @staticmethod
+    def _cache_put(digest: str, data: bytes):
+        if len(data) > BlobStore._cache_max_bytes:
+            return
+        cache = BlobStore._cache
+        if digest not in cache:
+            cache[digest] = data
+            BlobStore._cache_bytes = BlobStore._cache_bytes + len(data)
+            while BlobStore._cache_bytes > BlobStore._cache_max_bytes:
+                _, evicted_data = cache.popitem(last=False)
+                BlobStore._cache_bytes = BlobStore._cache_bytes - len(evicted_data)
+
+    @staticmethod
+    def put_bytes(data: bytes) -> BlobRef:
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = BlobStore._blob_path(digest)
+        if os.path.exists(blob_path):
+            Metrics.increase("blob.values.deduplicated")
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # write to a temp file then rename, so that readers never see a partial blob
+            temp_path = f"{blob_path}.{generate_uuid()}.tmp"
+            with open(temp_path, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, blob_path)
+            Metrics.increase("blob.values.stored")
+            Metrics.increase("blob.bytes.stored", len(data))
+        return BlobRef(digest=digest, size=len(data))
+
+    @staticmethod
+    def get_bytes(blob_ref: BlobRef) -> bytes:
+        cache = BlobStore._cache
+        data = cache.get(blob_ref.digest, None)
+        if data is not None:
+            cache.move_to_end(blob_ref.digest)
+            Metrics.increase("blob.cache.hits")
+            return data
+
+        Metrics.increase("blob.cache.misses")
+        with open(BlobStore._blob_path(blob_ref.digest), "rb") as blob_file:
+            data = blob_file.read()
+        BlobStore._cache_put(blob_ref.digest, data)
+        return data
+
+    @staticmethod
+    def resolve(value: Any) -> Any:
+        """return the value referred if value is a BlobRef, otherwise value itself"""
+        if not isinstance(value, BlobRef):
+            return value
+        try:
+            return bytes_2_object(BlobStore.get_bytes(value))
+        except OSError as e:
+            Metrics.increase("blob.values.lost")
+            logger.error(f"blob {value.digest} is lost: {e}")
+            return None
+
+    @staticmethod
+    def has_refs(state_vars: Dict[str, Any]) -> bool:
+        return any(isinstance(value, BlobRef) for value in state_vars.values())
+
+    @staticmethod
+    def externalize_state_vars(topic_name: str, state_vars: Union[Dict[str, Any], Tuple[Dict[str, Any], ...]],
+                               message_size: int) -> Union[Dict[str, Any], Tuple[Dict[str, Any], ...]]:
+        """
+        return state_vars with large values replaced by BlobRefs, state_vars itself is not modified.
+        state_vars can also be a tuple of state var dicts, refer to StateStreamStorage.
+        message_size is the size of state_vars serialized. No value is serialized again to measure its size unless the
+        whole message is over the threshold
+        """
+        threshold_bytes = BlobStore._threshold_bytes_by_topic.get(topic_name, None)
+        if threshold_bytes is None or state_vars is None or message_size <= threshold_bytes:
+            return state_vars
+        if isinstance(state_vars, tuple):
+            return tuple(BlobStore.externalize_state_vars(topic_name, item, message_size) for item in state_vars)
+
+        externalized = None
+        for name, value in state_vars.items():
+            if value is None or isinstance(value, (bool, int, float, BlobRef, SharedValueHandle)):
+                continue
+            value_bytes = object_2_bytes(value)
+            if len(value_bytes) <= threshold_bytes:
+                continue
+
+            if externalized is None:
+                externalized = dict(state_vars)
+            blob_ref = externalized[name] = BlobStore.put_bytes(value_bytes)
+            BlobStore._cache_put(blob_ref.digest, value_bytes)
+        return externalized if externalized is not None else state_vars
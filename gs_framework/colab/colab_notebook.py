@@ -2,7 +2,7 @@ import re
 import time
 
 from enum import Enum
-from typing import Iterable, Optional, List, Tuple, Dict, Set
+from typing import Iterable, Optional, List, Tuple, Dict, Set, NamedTuple, Callable
 
 import selenium
 from selenium.common.exceptions import TimeoutException
@@ -79,6 +79,149 @@ def is_cell_focused(el_cell: WebElement) -> bool:
 #     return cell_status
 
 
+class CellState(NamedTuple):
+    index: int  # 1 based
+    classes: Tuple[str, ...]
+    top_line: Optional[str]  # the first line not blank, None if no line is rendered
+    line_count: int
+
+    @property
+    def is_code(self) -> bool:
+        return is_code_cell_from_cell_classes(self.classes)
+
+    @property
+    def status(self) -> Optional[CellStatus]:
+        return cell_status_from_cell_classes(self.classes) if self.is_code else None
+
+
+class PageState(NamedTuple):
+    """snapshot of the cells of a notebook, read in one round trip by ColabNotebook.get_page_state"""
+
+    cells: Tuple[CellState, ...]
+
+    @property
+    def cell_count(self) -> int:
+        return len(self.cells)
+
+    def cell(self, cell_index: int) -> Optional[CellState]:
+        for cell in self.cells:
+            if cell.index == cell_index:
+                return cell
+        return None
+
+    def running_cell_index(self) -> Optional[int]:
+        for cell in self.cells:
+            if CellStatus.running == cell.status:
+                return cell.index
+        return None
+
+
+# returns [nth-child index, class name, top line, line count] of each cell. nth-child index keeps the cell index same
+# as ColabNotebook._css_selector_4_cell
+_JS_4_PAGE_STATE = r"""
+var cells = [];
+document.querySelectorAll('div[id^="cell-"]').forEach(function (cell) {
+    var lines = cell.querySelectorAll('div.view-line');
+    var topLine = null;
+    for (var i = 0; i < lines.length; i++) {
+        var line = lines[i].innerText.replace(/\u00a0/g, ' ');
+        if (!/^\s*$/.test(line)) {
+            topLine = line;
+            break;
+        }
+    }
+    var index = Array.prototype.indexOf.call(cell.parentElement.children, cell) + 1;
+    cells.push([index, cell.className, topLine, lines.length]);
+});
+return cells;
+"""
+
+_JS_4_CELL_LINES = r"""
+var cell = document.querySelector(arguments[0]);
+if (!cell) {
+    return null;
+}
+return Array.prototype.map.call(cell.querySelectorAll('div.view-line'),
+                                function (line) { return line.innerText.replace(/\u00a0/g, ' '); });
+"""
+
+
+class CellEvent(NamedTuple):
+    """class change of a cell recorded by the cell observer in page"""
+
+    seq: int  # grows with each event, refer to ColabNotebook._mark_cell_events
+    index: int  # 1 based
+    classes: Tuple[str, ...]
+    time: float  # time.time() of the page
+
+    @property
+    def status(self) -> Optional[CellStatus]:
+        return cell_status_from_cell_classes(self.classes) if is_code_cell_from_cell_classes(self.classes) else None
+
+
+# record class changes of cells into window.__gsCellEvents, and wake up the waiter of _JS_4_WAIT_CELL_EVENTS.
+# returns the seq of the latest event. seq starts from the install time, so it keeps growing when the page is reloaded
+# and the observer is installed again
+_JS_4_INSTALL_CELL_OBSERVER = r"""
+if (window.__gsCellEvents) {
+    return window.__gsCellEventSeq;
+}
+window.__gsCellEventSeq = Date.now() * 1000;
+var events = window.__gsCellEvents = [];
+var lastClassNames = new WeakMap();
+new MutationObserver(function (mutations) {
+    mutations.forEach(function (mutation) {
+        var cell = mutation.target;
+        if (cell.tagName !== 'DIV' || !cell.id || cell.id.indexOf('cell-') !== 0 ||
+                lastClassNames.get(cell) === cell.className) {
+            return;
+        }
+        lastClassNames.set(cell, cell.className);
+        var index = Array.prototype.indexOf.call(cell.parentElement.children, cell) + 1;
+        window.__gsCellEventSeq = window.__gsCellEventSeq + 1;
+        events.push([window.__gsCellEventSeq, index, cell.className, Date.now()]);
+        if (events.length > 1000) {
+            events.shift();
+        }
+    });
+    if (events.length > 0 && window.__gsCellWaiter) {
+        window.__gsCellWaiter();
+    }
+}).observe(document.body, {attributes: true, attributeFilter: ['class'], subtree: true});
+return window.__gsCellEventSeq;
+"""
+
+# wait till cell events after the seq given are recorded or timeout, then return them. Events are kept for the other
+# waiters. null if the observer is not installed, e.g. the page is reloaded
+_JS_4_WAIT_CELL_EVENTS = r"""
+var afterSeq = arguments[0];
+var timeoutMs = arguments[1];
+var callback = arguments[arguments.length - 1];
+var events = window.__gsCellEvents;
+if (!events) {
+    callback(null);
+    return;
+}
+function eventsAfter() {
+    return events.filter(function (event) { return event[0] > afterSeq; });
+}
+var done = false;
+function reply() {
+    if (!done) {
+        done = true;
+        window.__gsCellWaiter = null;
+        callback(eventsAfter());
+    }
+}
+if (timeoutMs <= 0 || eventsAfter().length > 0) {
+    reply();
+} else {
+    window.__gsCellWaiter = reply;
+    setTimeout(reply, timeoutMs);
+}
+"""
+
+
 class BackendNotAvailableError(Exception):
     pass
 
@@ -102,6 +245,10 @@ class ColabNotebook(WebPage):
         super().__init__(*args, **kwargs)
         self._has_run_cell = False
         self._cell_options: Dict[int, CellOptions] = dict()
+        self._page_state_reads = 0
+        self._page_state_read_seconds = 0.0
+        self._idle_seconds = 0.0
+        """time spent waiting for the page to change"""
 
     @staticmethod
     def _css_selector_4_cell(cell_index: int):  # note it's 1 based index
@@ -117,12 +264,75 @@ class ColabNotebook(WebPage):
         return SeleniumLocator(By.CSS_SELECTOR, "#top-toolbar colab-connect-button"), \
                SeleniumLocator(By.CSS_SELECTOR, "#connect")
 
-    def get_cell_options(self, cell_index: int) -> CellOptions:
+    def get_page_state(self) -> PageState:
+        """classes, top lines and status of all the cells, in one webdriver round trip"""
+        start_time = time.monotonic()
+        cells = tuple(sorted((CellState(index, tuple(class_name.split()), top_line, line_count)
+                              for index, class_name, top_line, line_count
+                              in self.driver.execute_script(_JS_4_PAGE_STATE)),
+                             key=lambda cell: cell.index))
+        self._page_state_read_seconds = self._page_state_read_seconds + time.monotonic() - start_time
+        self._page_state_reads = self._page_state_reads + 1
+        return PageState(cells)
+
+    def page_state_overhead(self) -> str:
+        return f"{self._page_state_reads} page state reads in {self._page_state_read_seconds:.2f} seconds, " \
+               f"idle for {self._idle_seconds:.1f} seconds"
+
+    def _sleep(self, seconds: float):
+        time.sleep(seconds)
+        self._idle_seconds = self._idle_seconds + seconds
+
+    def _mark_cell_events(self) -> int:
+        """
+        install the cell observer if not yet, return the seq of the latest cell event. Changes of cells from now on
+        are the events after it, whoever else waits for the events meanwhile
+        """
+        return self.driver.execute_script(_JS_4_INSTALL_CELL_OBSERVER)
+
+    def wait_cell_events(self, timeout_seconds: float, after_seq: int) -> List[CellEvent]:
+        """
+        block till cells change classes or timeout, return the changes after the seq given, refer to
+        _mark_cell_events. 0 timeout returns at once
+        """
+        start_time = time.monotonic()
+        self.driver.set_script_timeout(timeout_seconds + 30)
+        events = self.driver.execute_async_script(_JS_4_WAIT_CELL_EVENTS, after_seq, int(timeout_seconds * 1000))
+        self._idle_seconds = self._idle_seconds + time.monotonic() - start_time
+        if events is None:
+            self._mark_cell_events()
+            return []
+        return [CellEvent(seq, index, tuple(class_name.split()), event_time / 1000)
+                for seq, index, class_name, event_time in events]
+
+    def _wait_4_cell_classes(self, cell_index: int, condition: Callable[[Tuple[str, ...]], bool],
+                             timeout_seconds: float, after_seq: int) -> Optional[Tuple[str, ...]]:
+        """return the classes of the cell once they meet the condition after the seq given, None if timeout"""
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                return None
+            events = self.wait_cell_events(remaining_seconds, after_seq)
+            if len(events) > 0:
+                after_seq = events[-1].seq
+            # only the latest classes of the cell count, the ones before are gone
+            cell_events = [event for event in events if event.index == cell_index]
+            if len(cell_events) > 0 and condition(cell_events[-1].classes):
+                return cell_events[-1].classes
+
+    def get_cell_options(self, cell_index: int, page_state: Optional[PageState] = None) -> CellOptions:
         options = self._cell_options.get(cell_index, None)
         if options is None:
-            line = self.get_cell_top_line(cell_index)
-            options = CellOptionParser.parse_line(line)
-            self._cell_options[cell_index] = options
+            # options of all the cells are parsed from one page state
+            page_state = page_state if page_state is not None else self.get_page_state()
+            for cell in page_state.cells:
+                if cell.top_line is not None and cell.index not in self._cell_options:
+                    self._cell_options[cell.index] = CellOptionParser.parse_line(cell.top_line)
+            if cell_index not in self._cell_options:
+                # lines of the cell are not rendered
+                self._cell_options[cell_index] = CellOptionParser.parse_line(self.get_cell_top_line(cell_index))
+            options = self._cell_options[cell_index]
         return options
 
     def prepare(self):
@@ -141,33 +351,42 @@ class ColabNotebook(WebPage):
         except selenium.common.exceptions.NoSuchElementException:
             return None
 
+    def _get_stop_checking_seconds(self, cell_index: int, page_state: Optional[PageState] = None) -> int:
+        cell_options = self.get_cell_options(cell_index, page_state)
+        assert cell_options.stop_checking_seconds is None or cell_options.stop_checking_seconds > 0
+
+        # if not given, the stop_checking_seconds of last cell is 120, 10 for other cells
+        has_next_cell = page_state.cell(cell_index + 1) is not None if page_state is not None \
+            else self.cell_exists(cell_index + 1)
+        return cell_options.stop_checking_seconds if cell_options.stop_checking_seconds is not None \
+            else 10 if has_next_cell else 120
+
     def _get_cell_status(self, cell_index: int) -> Optional[CellStatus]:
         el_cell = self._get_cell(cell_index)
         if el_cell is None:
             print(f"Cell {cell_index} not found")
             return None
         else:
-            cell_options = self.get_cell_options(cell_index)
-            assert cell_options.stop_checking_seconds is None or cell_options.stop_checking_seconds > 0
-
-            # if not given, the stop_checking_seconds of last cell is 120, 10 for other cells
-            stop_checking_seconds = cell_options.stop_checking_seconds \
-                if cell_options.stop_checking_seconds is not None \
-                else 10 if self.cell_exists(cell_index + 1) else 120
+            stop_checking_seconds = self._get_stop_checking_seconds(cell_index)
 
             # when vm is busy, the cell status can be not running for a short time (have watched as long as 36 seconds)
-            # so if the cell appears not running, need to check again and again to make sure it's really not running
-            cell_status = None
-            for seconds in range(0, stop_checking_seconds):
-                # print(f"{time.asctime(time.gmtime())} Check cell {cell_index} status for {seconds} seconds")
-                cell_status = get_cell_status(el_cell)
-                if is_cell_status_stopped(cell_status):
-                    time.sleep(1)
-                else:
-                    if seconds > 0:
-                        print(f"{time.asctime(time.gmtime())} cell {cell_index} status is {cell_status}, "
-                              f"but appeared stopped for {seconds} seconds")
-                    return cell_status
+            # so if the cell appears not running, wait for its class changes to make sure it's really not running
+            # changes before the status read are out of date
+            event_seq = self._mark_cell_events()
+            cell_status = get_cell_status(el_cell)
+            if not is_cell_status_stopped(cell_status):
+                return cell_status
+
+            start_time = time.monotonic()
+            classes = self._wait_4_cell_classes(
+                cell_index, lambda cell_classes: is_code_cell_from_cell_classes(cell_classes) and
+                not is_cell_status_stopped(cell_status_from_cell_classes(cell_classes)), stop_checking_seconds,
+                event_seq)
+            if classes is not None:
+                cell_status = cell_status_from_cell_classes(classes)
+                print(f"{time.asctime(time.gmtime())} cell {cell_index} status is {cell_status}, "
+                      f"but appeared stopped for {time.monotonic() - start_time:.1f} seconds")
+                return cell_status
 
             print(f"Cell {cell_index} is considered stopped: {cell_status}")
             return cell_status
@@ -184,7 +403,7 @@ class ColabNotebook(WebPage):
             except selenium.common.exceptions.NoSuchElementException:
                 return None
             except selenium.common.exceptions.StaleElementReferenceException:
-                time.sleep(2)
+                self._sleep(2)
                 retry_times = retry_times + 1
                 print(f"StaleElementReferenceException found when try to get line {line_number} of cell {cell_index}. "
                       f"Retry {retry_times}")
@@ -194,29 +413,14 @@ class ColabNotebook(WebPage):
         return None if el_line is None else el_line.text
 
     def get_cell_top_line(self, cell_index: int) -> Optional[str]:
-        line_number = 1
-        while True:
-            line_text = self.get_cell_line_text(cell_index, line_number)
-            if line_text is None:
-                return None
-            elif re.fullmatch(r"\s*", line_text) is None:
+        for line_text in self.get_cell_text(cell_index) or ():
+            if re.fullmatch(r"\s*", line_text) is None:
                 return line_text
-            else:
-                line_number = line_number + 1
+        return None
 
     def get_cell_text(self, cell_index: int) -> Optional[List[str]]:
-        if self.cell_exists(cell_index):
-            result = list()
-            line_number = 1
-            while True:
-                line_text = self.get_cell_line_text(cell_index, line_number)
-                if line_text is None:
-                    return result
-                else:
-                    result.append(line_text)
-                    line_number = line_number + 1
-        else:
-            return None
+        """all the lines of the cell in one round trip, None if the cell doesn't exist"""
+        return self.driver.execute_script(_JS_4_CELL_LINES, ColabNotebook._css_selector_4_cell(cell_index))
 
     def _scroll_cell_into_view(self, cell_index: int):
         cell_locator = (By.CSS_SELECTOR, ColabNotebook._css_selector_4_cell(cell_index))
@@ -234,6 +438,7 @@ class ColabNotebook(WebPage):
     def _click_cell(self, cell_index: int):
         el_cell = self._get_cell(cell_index)
         if el_cell is not None and not is_cell_focused(el_cell):
+            event_seq = self._mark_cell_events()
             line_number = 1
             last_err = None
             retry_times = 0
@@ -248,7 +453,7 @@ class ColabNotebook(WebPage):
                         last_err = err
                         line_number = line_number + 1
                 else:
-                    time.sleep(2)
+                    self._sleep(2)
                     retry_times = retry_times + 1
                     if retry_times > 3:
                         raise RuntimeError(f"failed to click cell {cell_index}: "
@@ -256,7 +461,9 @@ class ColabNotebook(WebPage):
                     else:
                         if line_number > 1:
                             line_number = 1
-            time.sleep(2)
+            # the cell is ready once focused
+            if self._wait_4_cell_classes(cell_index, is_cell_focused_from_cell_classes, 2, event_seq) is None:
+                print(f"{self.title} - Cell {cell_index} is not focused after clicked")
 
     def stop_cell(self, cell_index: int):
         cell_status = self._get_cell_status(cell_index)
@@ -269,9 +476,14 @@ class ColabNotebook(WebPage):
             assert is_cell_status_stopped(cell_status)
             print(f"{self.title} - Cell {cell_index} has been stopped. Status: {cell_status}")
 
-    def run_cell(self, cell_index: int):
-        el_cell = self._get_cell(cell_index)
-        if el_cell is not None and is_code_cell(el_cell):
+    def run_cell(self, cell_index: int, cell_state: Optional[CellState] = None):
+        """:param cell_state: of a page state read lately, saves reading the cell again"""
+        if cell_state is not None:
+            is_code = cell_state.is_code
+        else:
+            el_cell = self._get_cell(cell_index)
+            is_code = el_cell is not None and is_code_cell(el_cell)
+        if is_code:
             cell_options = self.get_cell_options(cell_index)
             print(f"{self.title} - run cell {cell_index} with option {cell_options}")
 
@@ -291,18 +503,17 @@ class ColabNotebook(WebPage):
             assert is_cell_status_stopped(cell_status)
             # need to click the cell to ensure the run icon appears
             self._click_cell(cell_index)
+            event_seq = self._mark_cell_events()
             self.js_click(ColabNotebook._cell_icon_locator(cell_index))
             # self._get_button_4_cell(cell_index).click()
 
             if not self._has_run_cell:
-                time.sleep(5)  # wait for the button doesn't move anymore.
-                has_been_authorized = False
-                try:
-                    el_run_anyway = self.wait(10).until(EC.element_to_be_clickable((By.ID, "ok")))
-                    print("Ask for authorization to run")
-                except TimeoutException:
+                el_run_anyway = self._wait_4_authorization_dialog(cell_index, 15, event_seq)
+                has_been_authorized = el_run_anyway is None
+                if has_been_authorized:
                     print("The notebook had been authorized to run")
-                    has_been_authorized = True
+                else:
+                    print("Ask for authorization to run")
 
                 if not has_been_authorized:
                     self.wait(10).until(lambda _: el_run_anyway.text.strip().upper() == 'RUN ANYWAY')
@@ -321,15 +532,53 @@ class ColabNotebook(WebPage):
 
             # do not wait for the cell turn to running status: it could end run quite quickly
 
-    def wait_4_cell_stop(self, cell_index):
-        notebook = self
+    def _find_ok_button(self) -> Optional[WebElement]:
+        """the OK button of the dialog popped up, without waiting"""
+        try:
+            return EC.element_to_be_clickable((By.ID, "ok"))(self.driver) or None
+        except (selenium.common.exceptions.NoSuchElementException,
+                selenium.common.exceptions.StaleElementReferenceException):
+            return None
 
-        def wait_condition(driver):
-            notebook.reconnect_vm_if_disconnected_message_pops_up()
-            return is_cell_status_stopped(notebook._get_cell_status(cell_index))
+    def _wait_4_authorization_dialog(self, cell_index: int, timeout_seconds: float,
+                                     after_seq: int) -> Optional[WebElement]:
+        """
+        return the OK button of the dialog asking for authorization to run, None if the cell starts (pending or
+        running) without asking after the cell event seq given, even if it has stopped already
+        """
+        def cell_started(event: CellEvent) -> bool:
+            return event.index == cell_index and event.status is not None and not is_cell_status_stopped(event.status)
 
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            el_ok = self._find_ok_button()
+            remaining_seconds = deadline - time.monotonic()
+            if el_ok is not None or remaining_seconds <= 0:
+                return el_ok
+            # the dialog is not a cell change, so check it every second
+            events = self.wait_cell_events(min(remaining_seconds, 1), after_seq)
+            if any(cell_started(event) for event in events):
+                return None
+            if len(events) > 0:
+                after_seq = events[-1].seq
+
+    def wait_4_cell_stop(self, cell_index):
         cell_options = self.get_cell_options(cell_index)
-        self.wait(cell_options.max_run_seconds).until(wait_condition)
+        max_run_seconds = cell_options.max_run_seconds or 120
+        deadline = time.monotonic() + max_run_seconds
+        while True:
+            self.reconnect_vm_if_disconnected_message_pops_up(0)
+            event_seq = self._mark_cell_events()
+            if is_cell_status_stopped(self._get_cell_status(cell_index)):
+                break
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                raise TimeoutException(f"Cell {cell_index} doesn't stop in {max_run_seconds} seconds")
+            # wake up once the cell stops, or check the reconnect dialog again 10 seconds later
+            self._wait_4_cell_classes(
+                cell_index, lambda cell_classes: is_code_cell_from_cell_classes(cell_classes) and
+                is_cell_status_stopped(cell_status_from_cell_classes(cell_classes)), min(remaining_seconds, 10),
+                event_seq)
 
         cell_status = self._get_cell_status(cell_index)
         print(f"{self.title} - Cell {cell_index} stopped with {cell_status}")
@@ -394,7 +643,7 @@ class ColabNotebook(WebPage):
             else:
                 curr_retry_times = curr_retry_times + 1
                 print(f"{self.title} - Connect VM failed. Retry {curr_retry_times}")
-                time.sleep(5)
+                self._sleep(5)
                 return curr_retry_times
 
         retry_times = 0
@@ -414,13 +663,18 @@ class ColabNotebook(WebPage):
                         self._check_failed_to_assign_backend()
                     raise RuntimeError(f"Unexpected VM status: {connect_text}")
 
-    def reconnect_vm_if_disconnected_message_pops_up(self):
+    def reconnect_vm_if_disconnected_message_pops_up(self, wait_seconds: int = 10):
+        """:param wait_seconds: for the dialog to pop up, 0 checks it once"""
         # check if there is an OK button whose title is RECONNECT
-        try:
-            el_ok = self.wait(10).until(EC.element_to_be_clickable((By.ID, "ok")))
-            found_ok_button = True
-        except TimeoutException:
-            found_ok_button = False
+        if wait_seconds > 0:
+            try:
+                el_ok = self.wait(wait_seconds).until(EC.element_to_be_clickable((By.ID, "ok")))
+                found_ok_button = True
+            except TimeoutException:
+                found_ok_button = False
+        else:
+            el_ok = self._find_ok_button()
+            found_ok_button = el_ok is not None
 
         if found_ok_button and "RECONNECT" == el_ok.text.strip().upper():
             from datetime import datetime
@@ -440,7 +694,7 @@ class ColabNotebook(WebPage):
 
             self._run_cell(cell_index)
 
-            time.sleep(10)  # wait for the iframe to be fully loaded, this is required in release mode
+            self._sleep(10)  # wait for the iframe to be fully loaded, this is required in release mode
 
             # don't know why but it is a must for attaching driver to reattach to get content inside iframe
             self._recreate_driver()
@@ -543,18 +797,27 @@ class ColabNotebook(WebPage):
         return self._get_cell(cell_index) is not None
 
     def get_current_running_cell_index(self) -> Optional[int]:
-        cell_index = 1
+        # a cell can appear not running for a while when vm is busy, so wait for cells turning running till the
+        # longest stop checking seconds of the cells elapse, refer to _get_cell_status
+        event_seq = self._mark_cell_events()
+        page_state = self.get_page_state()
+        running_cell_index = page_state.running_cell_index()
+        if running_cell_index is not None:
+            return running_cell_index
+
+        stop_checking_seconds = max((self._get_stop_checking_seconds(cell.index, page_state)
+                                     for cell in page_state.cells if cell.is_code), default=0)
+        deadline = time.monotonic() + stop_checking_seconds
         while True:
-            try:
-                cell_status = self._get_cell_status(cell_index)
-                if cell_status is None:
-                    return None  # cell index out of boundary, no more cell
-                elif CellStatus.running == cell_status:
-                    return cell_index
-                else:
-                    cell_index = cell_index + 1
-            except TimeoutException:
-                raise RuntimeError("Time out when checking cell status, please make sure chrome zoom is set to 100%")
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                return None
+            events = self.wait_cell_events(remaining_seconds, event_seq)
+            if len(events) > 0:
+                event_seq = events[-1].seq
+            running_cell_indexes = [event.index for event in events if CellStatus.running == event.status]
+            if len(running_cell_indexes) > 0:
+                return min(running_cell_indexes)
 
     def restart_runtime(self):
         print(f"{self.title} - restart runtime")
@@ -569,7 +832,7 @@ class ColabNotebook(WebPage):
         el_restart_menu_item.click()
         print(f"{self.title} - restart menu item clicked")
 
-        time.sleep(10)  # wait for the button doesn't move anymore. this is required in release mode
+        self._sleep(10)  # wait for the button doesn't move anymore. this is required in release mode
         self.js_click((By.ID, "ok"))
         print(f"{self.title} - runtime restart confirmed")
         self._wait_4_vm_running(60 * 5, VMStatus.running_statuses_after_restart)
@@ -589,7 +852,7 @@ class ColabNotebook(WebPage):
         el_menu_item.click()
         print(f"{self.title} - factory reset runtime menu item clicked")
 
-        time.sleep(10)  # wait for the button doesn't move anymore. this is required in release mode
+        self._sleep(10)  # wait for the button doesn't move anymore. this is required in release mode
         self.js_click((By.ID, "ok"))  # this still works even if the dialog is in shadow DOM
         print(f"{self.title} - factory reset runtime confirmed")
         self._wait_4_vm_running(60 * 5, (VMStatus.reconnect,))
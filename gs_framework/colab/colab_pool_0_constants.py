@@ -5,6 +5,17 @@ class Configuration:
 
     pool_name = "colab_env_pool_0"
 
+    # notebooks submitted are kept in this file, and submitted again when the pool env restarts
+    journal_path = f"/opt/gsfaust/{pool_name}.journal"
+    # full output of each notebook run is kept here as gzip files, None means only the latest lines are kept
+    output_spool_dir = None
+
+    # (rate_per_second, burst) of notebook launches by "global", "proxy", "account", or "proxy.<proxy>" /
+    # "account.<google account>" for one of them. Can be changed at runtime by ColabPoolClient.set_launch_rate_limit
+    notebook_launch_rate_limits = {"global": (1 / (3 * 60), 1)}
+    # proxy each google account goes through, accounts not listed share one proxy
+    proxy_by_google_account = {}
+
     pool_env_status_topic = faust.types.TP(topic="colab_pool_env", partition=1)
     pool_env_rpc_callee_topic = pool_env_status_topic
 
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Tuple
 
 import faust
 from gs_framework.utilities import generate_uuid
@@ -84,6 +84,20 @@ class ColabPoolClient(RPCCaller, ServiceUnit):
                      chrome_service_name: str = None) -> str:
         return await self._pool_env_rpc_stub.submit(notebook_id, task_group, chrome_debug_port, chrome_service_name)
 
+    async def get_task_output(self, task_id: str, max_lines: int = 100) -> List[str]:
+        return await self._pool_env_rpc_stub.get_task_output(task_id, max_lines)
+
+    async def set_launch_rate_limit(self, scope: str, rate_per_second: Optional[float], burst: float = 1,
+                                    key: str = None):
+        """refer to ColabPoolEnv.set_launch_rate_limit"""
+        return await self._pool_env_rpc_stub.set_launch_rate_limit(scope, rate_per_second, burst, key)
+
+    async def get_launch_rate_limits(self) -> Dict[str, Tuple[float, float]]:
+        return await self._pool_env_rpc_stub.get_launch_rate_limits()
+
+    async def set_google_account_proxy(self, google_acct: str, proxy: Optional[str]):
+        return await self._pool_env_rpc_stub.set_google_account_proxy(google_acct, proxy)
+
     async def cancel_task(self, task_id: str) -> bool:
         return await self._pool_env_rpc_stub.cancel_task(task_id)
 
@@ -7,17 +7,19 @@
 
 """
 import logging
+import os
 import sys
 import functools
 import time
 import asyncio
 
-from typing import List, Dict, Any, Iterable, NamedTuple
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple
 
 from gs_framework.colab.colab_notebook import BackendNotAvailableError
 from gs_framework.colab.webpage import WebPage
 
 from gs_framework.pool import Pool
+from gs_framework.rate_limit import KeyedRateLimiter
 from gs_framework.state_stream import ObjectStateStream
 
 from gs_framework.state_var_change_dispatcher import state_var_change_handler, pick_one_change
@@ -29,11 +31,15 @@ from gs_framework.activatable_stateful_service import Env, Activatable
 
 from gs_framework.stateful_object import read_stateful_object, MessageAsStateReader, create_stateful_object
 from gs_framework.sub_process_executor import AsyncSubProcessProtocol, SubProcessExecInfo, run_sub_process, \
-    SubProcessExecutor, IDGrouping, TaskRetry
+    SubProcessExecutor, IDGrouping, TaskRetry, SubProcessZygote
 from gs_framework.utilities import to_para
 
 logger = logging.getLogger(__name__)
 
+LAUNCH_SCOPE_GLOBAL = "global"
+LAUNCH_SCOPE_PROXY = "proxy"
+LAUNCH_SCOPE_ACCOUNT = "account"
+
 
 def run_notebook_process(google_acct: str, notebook_id: str, chrome_debug_port: int, chrome_service_name: str):
     chrome_service_name = f"chrome-{google_acct.replace('.', '-dot-')}" if chrome_service_name is None \
@@ -67,12 +73,14 @@ def run_notebook_process(google_acct: str, notebook_id: str, chrome_debug_port:
             print(f"{running_notebook.title} - VM is busy but no cell is running.")
             running_notebook.factory_reset_runtime()
 
-        cell_index = 1 if running_cell_index is None else running_cell_index + 1
-        while running_notebook.cell_exists(cell_index):
-            running_notebook.run_cell(cell_index)
-            cell_index = cell_index + 1
+        # cells are read in one round trip instead of finding them one by one
+        page_state = running_notebook.get_page_state()
+        first_cell_index = 1 if running_cell_index is None else running_cell_index + 1
+        for cell_state in page_state.cells:
+            if cell_state.index >= first_cell_index:
+                running_notebook.run_cell(cell_state.index, cell_state)
 
-        print(f"{running_notebook.title} - run notebook done")
+        print(f"{running_notebook.title} - run notebook done, {running_notebook.page_state_overhead()}")
 
         # try:
         #     WebPage('about:blank', chrome_service_name, chrome_debug_port)
@@ -84,15 +92,15 @@ def run_notebook_process(google_acct: str, notebook_id: str, chrome_debug_port:
 
 
 class RunColabNotebookProtocol(AsyncSubProcessProtocol):
-    def __init__(self, google_account: str, notebook_id: str):
-        super().__init__()
+    def __init__(self, google_account: str, notebook_id: str, spool_path: str = None):
+        super().__init__(spool_path)
         self._google_account = google_account
         self._notebook_id = notebook_id
 
-    def pipe_data_received(self, fd, data):
-        output = f"{self._google_account} {self._notebook_id}: {data.decode('ascii').rstrip()}"
+    def emit_line(self, fd: int, line: str):
+        output = f"{self._google_account} {self._notebook_id}: {line}"
         if fd == 2:
-            logger.error(output, file=sys.stderr)
+            logger.error(output)
         else:
             logger.info(output)
 
@@ -100,30 +108,41 @@ class RunColabNotebookProtocol(AsyncSubProcessProtocol):
 class NotebookRunData(NamedTuple):
     notebook_id: str
     task_group: str
+    chrome_debug_port: int = 9222
+    chrome_service_name: str = None
 
 
 class ColabPoolEnv(ColabPoolEnvState, Env):
 
     pool_env_state_stream: ObjectStateStream = ObjectStateStream.bind_at_runtime()
 
+    # run next note book at least 3 minute after the previous one, to avoid proxy bandwidth jam for mount google drive
+    DEFAULT_LAUNCH_RATE_LIMITS = {LAUNCH_SCOPE_GLOBAL: (1 / (3 * 60), 1)}
+
     def __init__(self, name: str, google_accounts: Iterable[str] = None):
         super().__init__()
 
-        pool = Pool[str]()
+        pool = Pool[str](name="google_accounts")
         if google_accounts is not None:
             for google_account in google_accounts:
                 pool.add_object(google_account)
 
         self._pool = pool
         self._executor: SubProcessExecutor[str, NotebookRunData] = SubProcessExecutor(pool)
-        self._last_notebook_run_time_in_seconds: int = None
+        self._proxy_by_google_account: Dict[str, str] = dict()
+        self._launch_limiter = KeyedRateLimiter("notebook_launch")
+        self.set_launch_rate_limits(ColabPoolEnv.DEFAULT_LAUNCH_RATE_LIMITS)
         self._task_id_grouping: IDGrouping[SubProcessExecutor.TASK_ID] = IDGrouping()
+        # notebook runner processes are forked from a warm process which has imported this module
+        self._zygote = SubProcessZygote([__name__])
+        self._output_spool_dir: Optional[str] = None
 
         def cb_post_start():
             # these state variables are all memory only.
             self.name.VALUE = name
             # to ensure these changes will be broadcasted when active
             self.mark_all_state_variable_changed()
+            self._resubmit_recovered_tasks()
 
         self._cb_post_start = cb_post_start
 
@@ -148,31 +167,69 @@ class ColabPoolEnv(ColabPoolEnvState, Env):
             await pool_state_response_message.commit_state_var_changes(self.pool_env_state_stream)
             print(f"on_query_pool_state_message: poll name published")
 
+    def set_journal_path(self, journal_path: str):
+        """
+        keep the notebooks submitted in journal_path, they are submitted again after restart. Without it notebooks
+        waiting or running are lost on restart. Call it before start, it's not a constructor argument since it's
+        not part of the identity of the pool env
+        """
+        self._executor = SubProcessExecutor(self._pool, journal_path)
+
+    def set_output_spool_dir(self, output_spool_dir: Optional[str]):
+        """
+        keep the full output of each notebook run started afterwards in a gzip file under output_spool_dir. None means
+        only the latest lines are kept, refer to get_task_output
+        """
+        self._output_spool_dir = output_spool_dir
+
+    def set_launch_rate_limit(self, scope: str, rate_per_second: Optional[float], burst: float = 1,
+                              key: str = None):
+        """
+        change the rate limit of notebook launches at runtime
+        :param scope: LAUNCH_SCOPE_GLOBAL, LAUNCH_SCOPE_PROXY or LAUNCH_SCOPE_ACCOUNT
+        :param rate_per_second: None removes the limit
+        :param key: the proxy or the google account, None sets the limit of all the keys without their own limits
+        """
+        self._launch_limiter.set_limit(scope, rate_per_second, burst, key)
+        print(f"launch rate limit of {scope if key is None else f'{scope}.{key}'} set to {rate_per_second} per "
+              f"second with burst {burst}")
+
+    def set_launch_rate_limits(self, launch_rate_limits: Dict[str, Tuple[float, float]]):
+        """
+        :param launch_rate_limits: (rate_per_second, burst) of notebook launches by scope "global", "proxy" or
+        "account", or by "scope.key" for one proxy or account. Limits not listed are kept
+        """
+        for scope_key, (rate_per_second, burst) in launch_rate_limits.items():
+            scope, _, key = scope_key.partition(".")
+            self.set_launch_rate_limit(scope, rate_per_second, burst, key or None)
+
+    def get_launch_rate_limits(self) -> Dict[str, Tuple[float, float]]:
+        return self._launch_limiter.get_limits()
+
+    def set_google_account_proxy(self, google_acct: str, proxy: Optional[str]):
+        if proxy is None:
+            self._proxy_by_google_account.pop(google_acct, None)
+        else:
+            self._proxy_by_google_account[google_acct] = proxy
+
     async def run_notebook(self, google_acct: str, notebook_id: str, chrome_debug_port: int,
                            chrome_service_name: str) -> SubProcessExecInfo:
-        #  run next note book at least 3 minute after the previous one,
-        #  to avoid proxy bandwidth jam for mount google drive
-        run_note_book_interval_seconds = 3 * 60  # 10 change the interval for running on gcloud
-        now_in_seconds = int(time.time())
-
-        # print(f"{google_acct}: now_in_seconds: {now_in_seconds} last_run: {self._last_notebook_run_time_in_seconds}")
-
-        wait_seconds = 0 if self._last_notebook_run_time_in_seconds is None \
-            else max(0, self._last_notebook_run_time_in_seconds + run_note_book_interval_seconds - now_in_seconds)
-        self._last_notebook_run_time_in_seconds = now_in_seconds + wait_seconds
-
-        # print(f"{google_acct}: now_in_seconds: {now_in_seconds} wait_seconds: {wait_seconds} "
-        #       f"last_run: {self._last_notebook_run_time_in_seconds}")
-
-        if wait_seconds > 0:
-            print(f"{google_acct} wait {wait_seconds} seconds before run notebook {notebook_id}")
-            await asyncio.sleep(wait_seconds)
-            print(f"{google_acct} waited {wait_seconds} seconds. start run notebook {notebook_id}")
+        # launches are limited globally, by proxy and by account, e.g. to avoid proxy bandwidth jam for mount google
+        # drive. Accounts without proxy configured share one proxy bucket
+        launch_keys = {LAUNCH_SCOPE_GLOBAL: "all",
+                       LAUNCH_SCOPE_PROXY: self._proxy_by_google_account.get(google_acct, ""),
+                       LAUNCH_SCOPE_ACCOUNT: google_acct}
+        wait_seconds = await self._launch_limiter.acquire(launch_keys)
+        if wait_seconds >= 1:
+            print(f"{google_acct} waited {wait_seconds:.0f} seconds. start run notebook {notebook_id}")
 
         code = f"from gs_framework.colab.colab_pool_env import run_notebook_process; " \
                f"run_notebook_process({to_para(google_acct)}, {to_para(notebook_id)}, {to_para(chrome_debug_port)}, " \
                f"{to_para(chrome_service_name)})"
-        return await run_sub_process(code, lambda: RunColabNotebookProtocol(google_acct, notebook_id))
+        spool_path = None if self._output_spool_dir is None else \
+            os.path.join(self._output_spool_dir, f"{notebook_id}_{google_acct}_{int(time.time())}.log.gz")
+        return await run_sub_process(code, lambda: RunColabNotebookProtocol(google_acct, notebook_id, spool_path),
+                                     self._zygote)
 
     @staticmethod
     def _on_notebook_run(task_id: SubProcessExecutor.TASK_ID, sub_process_exec_info: SubProcessExecInfo,
@@ -186,7 +243,7 @@ class ColabPoolEnv(ColabPoolEnvState, Env):
         notebook_id = task_data.notebook_id
         print(f"Task {task_id} for notebook {notebook_id} of group {task_group} with google "
               f"account {google_acct} ended with exit code {sub_process_exec_info.transport.get_returncode()}, "
-              f"{task_retry}")
+              f"{task_retry}, {self._executor.get_task_usage(task_id)}")
         if task_group is not None:
             self._task_id_grouping.drop_id(task_id, task_group)
 
@@ -195,26 +252,43 @@ class ColabPoolEnv(ColabPoolEnvState, Env):
         task_group = task_data.task_group
         notebook_id = task_data.notebook_id
         print(f"Task {task_id} for notebook {notebook_id} of group {task_group} with google account {google_acct} "
-              f"timeout and ended with exit code {sub_process_exec_info.transport.get_returncode()}, {task_retry}")
+              f"timeout and ended with exit code {sub_process_exec_info.transport.get_returncode()}, {task_retry}, "
+              f"{self._executor.get_task_usage(task_id)}")
         if task_group is not None:
             self._task_id_grouping.drop_id(task_id, task_group)
 
     def submit(self, notebook_id: str, task_group: str, chrome_debug_port: int = 9222, chrome_service_name: str = None,
                # 超过 16H colab 还在运行，可以认为没有正确的回收资源，清理 env，重新标记为 idle 等待新任务的指派
-               time_out_seconds: int = 16 * 3600) -> SubProcessExecutor.TASK_ID:
+               time_out_seconds: int = 16 * 3600, priority: int = 0,
+               deadline: float = None, task_id: SubProcessExecutor.TASK_ID = None,
+               retry_times: int = 0) -> SubProcessExecutor.TASK_ID:
+        """notebooks waiting for google accounts are run by priority, fair share among task groups and deadline"""
         task_id = self._executor.submit(functools.partial(self.run_notebook, notebook_id=notebook_id,
                                                           chrome_debug_port=chrome_debug_port,
                                                           chrome_service_name=chrome_service_name),
-                                        task_data=NotebookRunData(notebook_id=notebook_id, task_group=task_group),
+                                        task_data=NotebookRunData(notebook_id=notebook_id, task_group=task_group,
+                                                                  chrome_debug_port=chrome_debug_port,
+                                                                  chrome_service_name=chrome_service_name),
                                         time_out_seconds=time_out_seconds,
                                         cb_on_process_created=ColabPoolEnv._on_notebook_run,
                                         cb_on_process_ended=self._on_notebook_run_ended,
-                                        cb_on_process_timeout=self._on_notebook_run_timeout)
+                                        cb_on_process_timeout=self._on_notebook_run_timeout,
+                                        task_group=task_group, priority=priority, deadline=deadline,
+                                        task_id=task_id, retry_times=retry_times)
         print(f"Notebook {notebook_id} of group {task_group} submitted with task id {task_id}")
         if task_group is not None:
             self._task_id_grouping.add_id_2_group(task_id, task_group)
         return task_id
 
+    def _resubmit_recovered_tasks(self):
+        for record in self._executor.recover():
+            task_data: NotebookRunData = record.task_data
+            print(f"Notebook {task_data.notebook_id} of group {task_data.task_group} recovered with task id "
+                  f"{record.task_id}, {'was running' if record.pid is not None else 'was waiting'}")
+            self.submit(task_data.notebook_id, task_data.task_group, task_data.chrome_debug_port,
+                        task_data.chrome_service_name, record.time_out_seconds, record.priority, record.deadline,
+                        record.task_id, record.retry_times)
+
     def _on_notebook_run_cancelled(self, task_id: SubProcessExecutor.TASK_ID, sub_process_exec_info: SubProcessExecInfo,
                                    google_acct: str, task_data: NotebookRunData, task_retry: TaskRetry):
         task_group = task_data.task_group
@@ -228,6 +302,10 @@ class ColabPoolEnv(ColabPoolEnvState, Env):
         if task_group is not None:
             self._task_id_grouping.drop_id(task_id, task_group)
 
+    def get_task_output(self, task_id: str, max_lines: int = 100) -> List[str]:
+        """latest lines of output of a notebook run, None if the task is not running nor finished lately"""
+        return self._executor.get_task_output(task_id, max_lines)
+
     async def cancel_task(self, task_id: str) -> bool:
         cancelled = await self._executor.cancel_task(task_id,
                                                      cb_on_process_cancelled=self._on_notebook_run_cancelled)
@@ -243,6 +321,13 @@ class ColabPoolEnv(ColabPoolEnvState, Env):
     @staticmethod
     async def run_with_rpc_enabled(configuration: Any):
         pool_env = ColabPoolEnv(configuration.pool_name, configuration.init_google_accounts)
+        journal_path = getattr(configuration, "journal_path", None)
+        if journal_path is not None:
+            pool_env.set_journal_path(journal_path)
+        pool_env.set_output_spool_dir(getattr(configuration, "output_spool_dir", None))
+        pool_env.set_launch_rate_limits(getattr(configuration, "notebook_launch_rate_limits", dict()))
+        for google_acct, proxy in getattr(configuration, "proxy_by_google_account", dict()).items():
+            pool_env.set_google_account_proxy(google_acct, proxy)
         pool_env.bind(topic_define=configuration.pool_env_status_topic)
         pool_env.pool_env_state_stream.bind(topic_define=configuration.pool_env_status_topic)
 
@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+"""
+One timer for all the deadlines of a process, instead of one sleeping coroutine for each of them
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import time
+from typing import Callable, Awaitable, Optional, Any, Dict, List, Tuple, Hashable
+
+from .utilities import ensure_await
+
+logger = logging.getLogger(__name__)
+
+FUNC_DEADLINE_CALLBACK = Callable[[], Optional[Awaitable[None]]]
+
+
+class _DeadlineEntry:
+
+    __slots__ = ("key", "deadline", "callback", "state", "persist", "cancelled")
+
+    def __init__(self, key: Hashable, deadline: float, callback: FUNC_DEADLINE_CALLBACK, state: Any, persist: bool):
+        super().__init__()
+        self.key = key
+        self.deadline = deadline
+        self.callback = callback
+        self.state = state
+        self.persist = persist
+        self.cancelled = False
+
+
+class DeadlineScheduler:
+    """
+    Callbacks are called when their deadlines (time.time()) are reached. Entries are kept in a heap with one timer
+    armed for the earliest deadline, schedule, reschedule and cancel take O(log n). Cancelled entries are dropped
+    lazily when they reach the top of the heap.
+
+    Entries scheduled with persist=True are saved with their state into persist_path (a short while after changes),
+    and can be taken back after restart by pop_restored, since callbacks can't be saved.
+    """
+
+    _default: Optional["DeadlineScheduler"] = None
+
+    def __init__(self, persist_path: Optional[str] = None, flush_delay_seconds: float = 1.0):
+        super().__init__()
+        self._entries: Dict[Hashable, _DeadlineEntry] = dict()
+        self._heap: List[Tuple[float, int, _DeadlineEntry]] = list()
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_deadline: Optional[float] = None
+
+        self._persist_path = persist_path
+        self._flush_delay_seconds = flush_delay_seconds
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._restored: Dict[Hashable, Tuple[float, Any]] = dict()
+        if persist_path is not None and os.path.exists(persist_path):
+            try:
+                with open(persist_path, "rb") as persist_file:
+                    self._restored = pickle.load(persist_file)
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logger.error(f"fail to load deadlines from {persist_path}: {e}")
+
+    @staticmethod
+    def default() -> "DeadlineScheduler":
+        """the scheduler shared by the ones not given a scheduler, it doesn't persist"""
+        if DeadlineScheduler._default is None:
+            DeadlineScheduler._default = DeadlineScheduler()
+        return DeadlineScheduler._default
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get_deadline(self, key: Hashable) -> Optional[float]:
+        entry = self._entries.get(key, None)
+        return entry.deadline if entry is not None else None
+
+    def schedule(self, key: Hashable, deadline: float, callback: FUNC_DEADLINE_CALLBACK, state: Any = None,
+                 persist: bool = False):
+        """the entry of the same key scheduled before is replaced"""
+        self._remove(key)
+        entry = self._entries[key] = _DeadlineEntry(key, deadline, callback, state, persist)
+        heapq.heappush(self._heap, (deadline, next(self._seq), entry))
+        self._arm_timer()
+        if persist:
+            self._schedule_flush()
+
+    def reschedule(self, key: Hashable, deadline: float) -> bool:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return False
+        self.schedule(key, deadline, entry.callback, entry.state, entry.persist)
+        return True
+
+    def cancel(self, key: Hashable) -> bool:
+        entry = self._remove(key)
+        if entry is None:
+            return False
+        if entry.persist:
+            self._schedule_flush()
+        return True
+
+    def _remove(self, key: Hashable) -> Optional[_DeadlineEntry]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.cancelled = True
+        return entry
+
+    async def sleep_until(self, deadline: float, key: Optional[Hashable] = None):
+        """
+        asyncio.sleep served by the scheduler. Cancelling the caller cancels the entry
+        :param key: refer to reschedule and cancel, a new key if None
+        """
+        if key is None:
+            key = ("sleep", next(self._seq))
+        future = asyncio.get_event_loop().create_future()
+
+        def wake_up():
+            if not future.done():
+                future.set_result(None)
+
+        self.schedule(key, deadline, wake_up)
+        try:
+            await future
+        finally:
+            if not future.done():
+                self.cancel(key)
+
+    def _arm_timer(self):
+        heap = self._heap
+        while len(heap) > 0 and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        if len(heap) == 0:
+            return
+
+        deadline = heap[0][0]
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        self._timer = asyncio.get_event_loop().call_later(max(0.0, deadline - time.time()), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_deadline = None
+        heap = self._heap
+        now = time.time()
+        has_persisted = False
+        while len(heap) > 0 and heap[0][0] <= now:
+            _, _, entry = heapq.heappop(heap)
+            if entry.cancelled:
+                continue
+            self._entries.pop(entry.key, None)
+            has_persisted = has_persisted or entry.persist
+            try:
+                asyncio.ensure_future(ensure_await(entry.callback()))
+            except Exception as e:
+                logger.exception(f"callback of deadline {entry.key} fails: {e}")
+
+        if has_persisted:
+            self._schedule_flush()
+        self._arm_timer()
+
+    def pop_restored(self, key_filter: Callable[[Hashable], bool]) -> List[Tuple[Hashable, float, Any]]:
+        """return (key, deadline, state) of the entries saved before restart and accepted by key_filter"""
+        restored = [(key, deadline, state) for key, (deadline, state) in self._restored.items() if key_filter(key)]
+        for key, _, _ in restored:
+            del self._restored[key]
+        return restored
+
+    def _schedule_flush(self):
+        if self._persist_path is not None and self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_delay_seconds, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._persist_path is None:
+            return
+
+        # entries restored but not taken yet are kept for a later pop_restored
+        persisted = dict(self._restored)
+        persisted.update({entry.key: (entry.deadline, entry.state)
+                          for entry in self._entries.values() if entry.persist})
+        temp_path = f"{self._persist_path}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            pickle.dump(persisted, temp_file)
+        os.replace(temp_path, self._persist_path)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
@@ -2,7 +2,7 @@ import asyncio
 import logging
 import os
 import time
-from typing import Tuple, Any, Mapping, Dict
+from typing import Tuple, Any, Mapping, Dict, NamedTuple, Optional, List
 
 import dns
 import faust
@@ -18,8 +18,55 @@ from .utilities import bytes_2_object, object_2_bytes
 logger = logging.getLogger(__name__)
 
 
+class TopicConfig(NamedTuple):
+    """
+    the settings applied when a topic is created by FaustUtilities.Admin.check_and_create_topic, and checked against
+    when the topic already exists. configs are kafka topic level configs, like {"cleanup.policy": "compact"}
+    """
+
+    replication_factor: int = 1
+    configs: Mapping[str, str] = {}
+
+    @staticmethod
+    def compacted(*, replication_factor: int = 1, segment_ms: Optional[int] = None,
+                  min_compaction_lag_ms: Optional[int] = None, delete_retention_ms: Optional[int] = None,
+                  min_cleanable_dirty_ratio: Optional[float] = None) -> 'TopicConfig':
+        """
+        config of a log compacted topic: kafka keeps at least the last message of each key, and drops a key
+        after its tombstone (refer to ObjectStateStream.delete_object) is kept for delete_retention_ms.
+
+        Note that compaction only keeps the last message of each object pk, so it's only suitable for streams whose
+        messages carry all the state vars of the object, for example streams written by publish_all_state_variables.
+        Streams carrying partial changes of objects would lose the state vars not in the last message.
+        """
+        configs = {"cleanup.policy": "compact"}
+        for name, value in (("segment.ms", segment_ms), ("min.compaction.lag.ms", min_compaction_lag_ms),
+                            ("delete.retention.ms", delete_retention_ms),
+                            ("min.cleanable.dirty.ratio", min_cleanable_dirty_ratio)):
+            if value is not None:
+                configs[name] = str(value)
+        return TopicConfig(replication_factor=replication_factor, configs=configs)
+
+
 class FaustUtilities:
 
+    DEFAULT_TOPIC_CONFIG = TopicConfig()
+    """settings of topics created without config registered, which are kafka's default settings"""
+
+    _topic_configs: Dict[str, TopicConfig] = dict()
+
+    @staticmethod
+    def set_topic_config(topic_name: str, topic_config: TopicConfig):
+        """
+        Register the config used when the topic is created. Register it before any stream on the topic is initialized
+        """
+        FaustUtilities._topic_configs[topic_name] = topic_config
+
+    @staticmethod
+    def get_topic_config(topic_name: str) -> Optional[TopicConfig]:
+        """None if no config is registered for the topic"""
+        return FaustUtilities._topic_configs.get(topic_name, None)
+
     # The topic parameter settings hardcoded here match logic in functions decode_message and send_message below
     # It seems that faust allow multiple TopicT objects be created for same topic name, it's not like agent names
     # which are unique for same app
@@ -44,7 +91,9 @@ class FaustUtilities:
 
     @staticmethod
     def send_message(topic: TopicT, *, key: Any = None, key_bytes: bytes = None, value: Any = None,
-                     value_bytes: bytes = None, headers: Mapping[str, Any] = None) -> asyncio.Future:
+                     value_bytes: bytes = None, headers: Mapping[str, Any] = None,
+                     partition: Optional[int] = None) -> asyncio.Future:
+        """partition is chosen by key if not given"""
         # The headers we add:
         #   header[MSG_HEADER_GS_SERIALIZER_FUNC] 转成bytes的序列，目前固定为 "gs_func" 即使用 utilities 下的
         #                                                               object_2_bytes() / bytes_2_object()
@@ -60,15 +109,60 @@ class FaustUtilities:
         serialized_headers = [(k, object_2_bytes(v)) for k, v in headers.items()] if headers is not None else None
         return asyncio.ensure_future(topic.send(key=object_2_bytes(key) if key_bytes is None else key_bytes,
                                                 value=object_2_bytes(value) if value_bytes is None else value_bytes,
-                                                headers=serialized_headers,
+                                                headers=serialized_headers, partition=partition,
+                                                value_serializer="raw", key_serializer="raw", force=True))
+
+    @staticmethod
+    def send_tombstone(topic: TopicT, *, key: Any = None, key_bytes: bytes = None,
+                       headers: Mapping[str, Any] = None) -> asyncio.Future:
+        """
+        send a message whose value is null, which means the object identified by key is removed from the stream.
+        decode_message returns None as value for such a message, since bytes_2_object(None) is None
+        """
+        serialized_headers = [(k, object_2_bytes(v)) for k, v in headers.items()] if headers is not None else None
+        return asyncio.ensure_future(topic.send(key=object_2_bytes(key) if key_bytes is None else key_bytes,
+                                                value=None, headers=serialized_headers,
                                                 value_serializer="raw", key_serializer="raw", force=True))
 
     @staticmethod
     def get_kafka_broker_address():
 		# your kafka server address
         return ''
+
+    _in_process_broker_name: Optional[str] = None
+
+    @staticmethod
+    def use_in_process_broker(broker_name: Optional[str] = ""):
+        """
+        Make apps created afterwards run on the in process broker of the name instead of kafka, refer to
+        in_process_broker.InProcessBroker. Services started in the same process with same broker name exchange messages
+        in memory. Pass None to switch back to kafka
+        """
+        if broker_name is not None:
+            from .in_process_broker import register_transport
+            register_transport()
+        FaustUtilities._in_process_broker_name = broker_name
+
+    @staticmethod
+    def get_in_process_broker():
+        """return the in process broker in use, None if kafka is used"""
+        broker_name = FaustUtilities._in_process_broker_name
+        if broker_name is None:
+            return None
+        from .in_process_broker import InProcessBroker
+        return InProcessBroker.get(broker_name)
         
 
+    _data_dir_suffix: str = ""
+
+    @staticmethod
+    def set_data_dir_suffix(suffix: str):
+        """
+        Apps created afterwards keep their tables in /opt/gsfaust/{app_id}{suffix}. Processes running apps of same id
+        on one node must use different suffixes, since a rocksdb db can only be opened by one process
+        """
+        FaustUtilities._data_dir_suffix = suffix
+
     _DNS_PROBE_RETRIES = 10
 
     @staticmethod
@@ -87,7 +181,14 @@ class FaustUtilities:
 
     @staticmethod
     def create_faust_app(app_id: str) -> App:
-        data_dir = f"/opt/gsfaust/{app_id}"
+        in_process_broker = FaustUtilities.get_in_process_broker()
+        if in_process_broker is not None:
+            from .in_process_broker import InProcessBroker
+            # tables are kept in memory too, they are recovered from changelog topics kept by the broker
+            return faust.App(app_id, broker=f"{InProcessBroker.TRANSPORT_SCHEME}://{in_process_broker.name}",
+                             store="memory://", web_enabled=False)
+
+        data_dir = f"/opt/gsfaust/{app_id}{FaustUtilities._data_dir_suffix}"
         os.makedirs(data_dir, exist_ok=True)
         return faust.App(app_id, broker=f"kafka://{FaustUtilities.get_kafka_broker_address()}",
                          store="rocksdb://", datadir=data_dir, web_enabled=False)
@@ -196,8 +297,10 @@ class FaustUtilities:
         #             print("Failed to create topic {}: {}".format(topic, e))
 
         @staticmethod
-        def create_topic(a: AdminClient, topic: str, num_partitions: int, replication_factor=1):
-            new_topic = [NewTopic(topic, num_partitions=num_partitions, replication_factor=replication_factor)]
+        def create_topic(a: AdminClient, topic: str, num_partitions: int, replication_factor=1,
+                         config: Mapping[str, str] = None):
+            new_topic = [NewTopic(topic, num_partitions=num_partitions, replication_factor=replication_factor,
+                                  config=dict(config) if config is not None else {})]
             fs = a.create_topics(new_topic)
 
             for topic, f in fs.items():
@@ -232,11 +335,41 @@ class FaustUtilities:
             md = a.list_topics(topic, timeout=10)
             return md.topics[topic].error is None
 
+        @staticmethod
+        def find_topic_config_mismatches(a: AdminClient, topic_details, topic_config: TopicConfig) -> List[str]:
+            """ return descriptions of settings of an existing topic which differ from topic_config """
+            mismatches = list()
+
+            replication_factors = set(map(lambda p: len(p.replicas), topic_details.partitions.values()))
+            if replication_factors and replication_factors != {topic_config.replication_factor}:
+                mismatches.append(f"replication factor {sorted(replication_factors)} != "
+                                  f"{topic_config.replication_factor}")
+
+            if len(topic_config.configs) > 0:
+                topic_name = str(topic_details)
+                fs = a.describe_configs([ConfigResource(ConfigResource.Type.TOPIC, topic_name)])
+                for _, f in fs.items():
+                    existing_configs = f.result()
+                    for name, value in topic_config.configs.items():
+                        existing_config = existing_configs.get(name, None)
+                        existing_value = None if existing_config is None else existing_config.value
+                        if existing_value != str(value):
+                            mismatches.append(f"{name}={existing_value} != {value}")
+
+            return mismatches
+
         @staticmethod
         def check_and_create_topic(topic: TP):
+            in_process_broker = FaustUtilities.get_in_process_broker()
+            if in_process_broker is not None:
+                if in_process_broker.create_topic(topic.topic, topic.partition):
+                    logger.info(f"in process topic '{topic.topic}' created with {topic.partition} partitions")
+                return
+
             try:
                 kafka_url = FaustUtilities.get_kafka_broker_address()
                 a = AdminClient({'bootstrap.servers': kafka_url})
+                topic_config = FaustUtilities.get_topic_config(topic.topic)
 
                 # debugging code to delete the topic
                 # if FaustUtilities.Admin.is_topic_existed(a, topic.topic):
@@ -245,9 +378,20 @@ class FaustUtilities:
                 topic_details = a.list_topics(topic.topic, timeout=10).topics[topic.topic]
                 if topic_details.error is None:
                     assert topic.partition == len(topic_details.partitions)
+
+                    # topics without config registered are not checked, they may be created with any settings
+                    mismatches = list() if topic_config is None else \
+                        FaustUtilities.Admin.find_topic_config_mismatches(a, topic_details, topic_config)
+                    if len(mismatches) > 0:
+                        logger.error(f"topic '{topic.topic}' exists with settings different from its config: "
+                                     f"{', '.join(mismatches)}")
                 else:
-                    logger.info(f"topic not exist, create topic '{topic.topic}' with {topic.partition} partitions")
-                    FaustUtilities.Admin.create_topic(a, topic.topic, topic.partition)
+                    if topic_config is None:
+                        topic_config = FaustUtilities.DEFAULT_TOPIC_CONFIG
+                    logger.info(f"topic not exist, create topic '{topic.topic}' with {topic.partition} partitions, "
+                                f"{topic_config}")
+                    FaustUtilities.Admin.create_topic(a, topic.topic, topic.partition,
+                                                      topic_config.replication_factor, topic_config.configs)
             except Exception as e:
                 logger.error(e)
                 print(f"{e}")
@@ -258,8 +402,12 @@ class FaustUtilities:
             if table is not None:
                 table.reset_state()
 
+                change_log_topic_name = table.changelog_topic.get_topic_name()
+                in_process_broker = FaustUtilities.get_in_process_broker()
+                if in_process_broker is not None:
+                    in_process_broker.delete_topic(change_log_topic_name)
+                    return
+
                 kafka_url = FaustUtilities.get_kafka_broker_address()
                 a = AdminClient({'bootstrap.servers': kafka_url})
-
-                change_log_topic_name = table.changelog_topic.get_topic_name()
                 FaustUtilities.Admin.delete_topics(a, [change_log_topic_name])
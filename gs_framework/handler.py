@@ -1,8 +1,16 @@
 import asyncio
+import concurrent.futures
+import functools
 import inspect
-from typing import Iterable, Union, Callable, Any, Dict, List, Awaitable, NamedTuple
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Iterable, Union, Callable, Any, Dict, List, Awaitable, NamedTuple, Optional, Tuple
 
 from gs_framework.state_stream import ObjectStateStream
+from gs_framework.state_variable import StateVariableCommitter
 from gs_framework.stateful_object import StatefulObject
 
 
@@ -40,4 +48,136 @@ async def process_handler_sync_result(res: CHANGE_HANDLER_SYNC_RESULT):
             if len(async_tasks) > 0:
                 await asyncio.wait(async_tasks, return_when=asyncio.ALL_COMPLETED)
         else:
-            raise RuntimeError(f"Unexpected handler return type: {res.__class__.__qualname__}")
\ No newline at end of file
+            raise RuntimeError(f"Unexpected handler return type: {res.__class__.__qualname__}")
+
+
+class _CommitRecorder:
+    """stand-in of the commit stream in handler executor processes, records the changes committed"""
+
+    __slots__ = ("commit_stream_name", "object_pk_bytes", "object_state_vars")
+
+    def __init__(self, commit_stream_name: str):
+        super().__init__()
+        self.commit_stream_name = commit_stream_name
+        self.object_pk_bytes: Optional[bytes] = None
+        self.object_state_vars: Optional[Dict[str, Any]] = None
+
+    def upsert_object_state(self, *, object_pk_bytes: bytes = None, object_state_vars: Dict[str, Any] = None,
+                            partition: Optional[int] = None, **kwargs):
+        self.object_pk_bytes = object_pk_bytes
+        self.object_state_vars = object_state_vars
+
+
+class HandlerExecutor:
+    """
+    Run sync state var change handlers in a thread or process pool instead of on the event loop, so that CPU heavy
+    handlers don't delay the handling of other messages. Refer to the executor parameter of state_var_change_handler.
+
+    Handlers run in a thread pool share the memory of the service. The state var changes they make are recorded on
+    the event loop (refer to StateVariableCommitter.record_changes_on), and their results are committed on the loop.
+
+    Handlers run in a process pool run on a copy of the service forked when the handler is wrapped, i.e. when the
+    service is initialized and before the app starts, so that the processes don't inherit the consumer threads and
+    sockets of the app. They should only depend on their parameters, which are passed by value. Each handler has its
+    own pool since the handler must exist before the pool processes are forked. The changes of the stateful objects
+    returned are sent back and committed to the commit streams, which must be members of the service, on the loop.
+    """
+
+    THREAD = "thread"
+    PROCESS = "process"
+
+    _thread_pools: Dict[Optional[int], ThreadPoolExecutor] = dict()
+    """thread pools by max_workers, shared by the handlers"""
+
+    _process_handlers: Dict[int, Callable] = dict()
+    _handler_ids = itertools.count()
+
+    @staticmethod
+    def _get_thread_pool(max_workers: Optional[int]) -> ThreadPoolExecutor:
+        thread_pool = HandlerExecutor._thread_pools.get(max_workers, None)
+        if thread_pool is None:
+            thread_pool = HandlerExecutor._thread_pools[max_workers] = \
+                ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="state_var_change_handler")
+        return thread_pool
+
+    @staticmethod
+    def _run_in_process(handler_id: int, state_var_owner_pk: Any, state_vars: Dict[str, Any],
+                        triggering_state_var_names: List[str]) -> List[Tuple[str, bytes, Dict[str, Any]]]:
+        """return commit stream member name, object pk bytes and changes of each stateful object returned"""
+        handler = HandlerExecutor._process_handlers[handler_id]
+        res = handler(state_var_owner_pk, state_vars, triggering_state_var_names)
+        if res is None:
+            return list()
+        if inspect.isawaitable(res):
+            raise RuntimeError(f"handler {handler.__qualname__} run in process executor must be sync")
+
+        handlers_owner = handler.__self__
+        commits = list()
+        for item in ((res, ) if isinstance(res, StatefulObjectAndCommitStream) else res):
+            assert isinstance(item, StatefulObjectAndCommitStream)
+            commit_stream_name = next((name for name in dir(handlers_owner)
+                                       if getattr(handlers_owner, name, None) is item.commit_stream), None)
+            if commit_stream_name is None:
+                raise RuntimeError(f"commit stream returned by {handler.__qualname__} is not a member of the service")
+
+            commit_recorder = _CommitRecorder(commit_stream_name)
+            item.stateful_object.commit_state_var_changes(commit_recorder)
+            if commit_recorder.object_state_vars is not None:
+                commits.append((commit_stream_name, commit_recorder.object_pk_bytes, commit_recorder.object_state_vars))
+        return commits
+
+    @staticmethod
+    def wrap(handler: FUNC_STATE_VAR_CHANGE_HANDLER, executor: str, max_workers: Optional[int]) \
+            -> Callable[[Any, Dict[str, Any], List[str]], Awaitable[CHANGE_HANDLER_SYNC_RESULT]]:
+        """return an async function calling the bound method handler in the executor"""
+
+        if executor == HandlerExecutor.THREAD:
+            thread_pool = HandlerExecutor._get_thread_pool(max_workers)
+
+            def call_handler(loop: asyncio.AbstractEventLoop, state_var_owner_pk: Any, state_vars: Dict[str, Any],
+                             triggering_state_var_names: List[str]):
+                StateVariableCommitter.record_changes_on(loop)
+                try:
+                    return handler(state_var_owner_pk, state_vars, triggering_state_var_names)
+                finally:
+                    StateVariableCommitter.record_changes_on(None)
+
+            @functools.wraps(handler)
+            async def run_in_thread(state_var_owner_pk: Any, state_vars: Dict[str, Any],
+                                    triggering_state_var_names: List[str]):
+                loop = asyncio.get_event_loop()
+                # the changes recorded on the loop are scheduled before the result is, so they are all recorded when
+                # the handlers called are notified
+                res = await loop.run_in_executor(thread_pool, call_handler, loop, state_var_owner_pk, dict(state_vars),
+                                                 triggering_state_var_names)
+                if inspect.isawaitable(res):
+                    raise RuntimeError(f"handler {handler.__qualname__} run in thread executor must be sync")
+                return res
+
+            return run_in_thread
+
+        assert executor == HandlerExecutor.PROCESS, f"unknown handler executor {executor}"
+        handler_id = next(HandlerExecutor._handler_ids)
+        HandlerExecutor._process_handlers[handler_id] = handler
+        handlers_owner = handler.__self__
+        # fork, so that the handler registered is in the pool processes. Pools may fork their processes on demand
+        # (python 3.9, 3.10), so all of them are forked now, before the app starts: a process is forked for each task
+        # submitted while no process is idle, and the tasks keep the processes busy till all are submitted
+        process_pool: Executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                     mp_context=multiprocessing.get_context("fork"))
+        concurrent.futures.wait([process_pool.submit(time.sleep, 0.1)
+                                 for _ in range(max_workers or os.cpu_count() or 1)])
+
+        @functools.wraps(handler)
+        async def run_in_process(state_var_owner_pk: Any, state_vars: Dict[str, Any],
+                                 triggering_state_var_names: List[str]):
+            commits = await asyncio.get_event_loop().run_in_executor(
+                process_pool, HandlerExecutor._run_in_process, handler_id, state_var_owner_pk, dict(state_vars),
+                triggering_state_var_names)
+            if len(commits) > 0:
+                await asyncio.wait([getattr(handlers_owner, commit_stream_name).upsert_object_state(
+                    object_pk_bytes=object_pk_bytes, object_state_vars=object_state_vars)
+                    for commit_stream_name, object_pk_bytes, object_state_vars in commits],
+                    return_when=asyncio.ALL_COMPLETED)
+
+        return run_in_process
@@ -0,0 +1,414 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process stand-in of the kafka broker, for running services without kafka
+
+InProcessBroker is a partition aware in memory log: each partition of a topic is a list of records whose index is the
+offset. Consumers of same group id (faust app id) share the partitions of the topics they subscribe, and the offsets
+they commit are kept per group, so a faust app restarted in the same process resumes from its committed offsets and
+tables recover from their changelog topics.
+
+Transport plugs the broker into faust as the transport of scheme "inprocess", e.g. inprocess://broker_name.
+Apps using the same broker name in one process exchange messages at memory speed.
+FaustUtilities.use_in_process_broker switches FaustUtilities.create_faust_app to it.
+"""
+import asyncio
+import logging
+import time
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+from faust.transport import base
+from faust.transport.consumer import Consumer as FaustConsumer
+from faust.transport.producer import Producer as FaustProducer
+from faust.types import ConsumerMessage, RecordMetadata, TP
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessRecord(NamedTuple):
+
+    topic: str
+    partition: int
+    offset: int
+    timestamp: int
+    """milliseconds, like kafka"""
+    key: Optional[bytes]
+    value: Optional[bytes]
+    headers: List[Tuple[str, bytes]]
+
+
+class InProcessBroker:
+
+    TRANSPORT_SCHEME = "inprocess"
+    DEFAULT_NUM_PARTITIONS = 1
+    """number of partitions of a topic used before it's created explicitly"""
+
+    _brokers: Dict[str, 'InProcessBroker'] = dict()
+
+    @staticmethod
+    def get(name: str = "") -> 'InProcessBroker':
+        broker = InProcessBroker._brokers.get(name, None)
+        if broker is None:
+            broker = InProcessBroker(name)
+            InProcessBroker._brokers[name] = broker
+        return broker
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+        self._topics: Dict[str, List[List[InProcessRecord]]] = dict()
+        self._committed_offsets: Dict[Tuple[str, TP], int] = dict()
+        self._group_members: Dict[str, List['Consumer']] = defaultdict(list)
+        self._round_robin_counters: Dict[str, int] = defaultdict(int)
+        self._records_appended: Optional[asyncio.Future] = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    # topics
+
+    def create_topic(self, topic: str, num_partitions: int) -> bool:
+        """return False if the topic exists already"""
+        partitions = self._topics.get(topic, None)
+        if partitions is not None:
+            if len(partitions) != num_partitions:
+                logger.error(f"topic '{topic}' exists with {len(partitions)} partitions, {num_partitions} required")
+            return False
+
+        self._topics[topic] = [list() for _ in range(num_partitions)]
+        self._rebalance_groups_subscribing(topic)
+        return True
+
+    def delete_topic(self, topic: str):
+        if self._topics.pop(topic, None) is not None:
+            for group_and_tp in [group_and_tp for group_and_tp in self._committed_offsets
+                                 if group_and_tp[1].topic == topic]:
+                del self._committed_offsets[group_and_tp]
+            self._rebalance_groups_subscribing(topic)
+
+    def is_topic_existed(self, topic: str) -> bool:
+        return topic in self._topics
+
+    def _partitions_of(self, topic: str) -> List[List[InProcessRecord]]:
+        partitions = self._topics.get(topic, None)
+        if partitions is None:
+            self.create_topic(topic, InProcessBroker.DEFAULT_NUM_PARTITIONS)
+            partitions = self._topics[topic]
+        return partitions
+
+    def num_partitions(self, topic: str) -> Optional[int]:
+        partitions = self._topics.get(topic, None)
+        return None if partitions is None else len(partitions)
+
+    def key_partition(self, topic: str, key: Optional[bytes]) -> int:
+        num_partitions = len(self._partitions_of(topic))
+        if key is None:
+            counter = self._round_robin_counters[topic]
+            self._round_robin_counters[topic] = counter + 1
+            return counter % num_partitions
+        return zlib.crc32(key) % num_partitions
+
+    # log
+
+    def append(self, topic: str, partition: Optional[int], key: Optional[bytes], value: Optional[bytes],
+               headers: Optional[Iterable[Tuple[str, bytes]]] = None, timestamp: Optional[float] = None) \
+            -> InProcessRecord:
+        """timestamp is in seconds, like faust"""
+        if partition is None:
+            partition = self.key_partition(topic, key)
+        records = self._partitions_of(topic)[partition]
+        if headers is not None and isinstance(headers, Mapping):
+            headers = headers.items()
+        record = InProcessRecord(topic, partition, len(records),
+                                 int((time.time() if timestamp is None else timestamp) * 1000),
+                                 key, value, list(headers) if headers is not None else [])
+        records.append(record)
+
+        records_appended = self._records_appended
+        if records_appended is not None:
+            self._records_appended = None
+            if not records_appended.done():
+                records_appended.set_result(None)
+        return record
+
+    def read(self, tp: TP, offset: int, max_records: int) -> List[InProcessRecord]:
+        partitions = self._topics.get(tp.topic, None)
+        if partitions is None or tp.partition >= len(partitions):
+            return []
+        return partitions[tp.partition][offset:offset + max_records]
+
+    def highwater(self, tp: TP) -> int:
+        partitions = self._topics.get(tp.topic, None)
+        return 0 if partitions is None or tp.partition >= len(partitions) else len(partitions[tp.partition])
+
+    async def wait_for_records(self, timeout: float):
+        """return when any record is appended to any topic or timeout"""
+        records_appended = self._records_appended
+        if records_appended is None:
+            records_appended = asyncio.get_event_loop().create_future()
+            self._records_appended = records_appended
+        try:
+            await asyncio.wait_for(asyncio.shield(records_appended), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # consumer groups
+
+    def commit(self, group_id: str, offsets: Mapping[TP, int]):
+        for tp, offset in offsets.items():
+            self._committed_offsets[(group_id, tp)] = offset
+
+    def committed_offset(self, group_id: str, tp: TP) -> Optional[int]:
+        return self._committed_offsets.get((group_id, tp), None)
+
+    def join_group(self, group_id: str, consumer: 'Consumer'):
+        members = self._group_members[group_id]
+        if consumer not in members:
+            members.append(consumer)
+        self._rebalance_group(group_id)
+
+    def leave_group(self, group_id: str, consumer: 'Consumer'):
+        members = self._group_members[group_id]
+        if consumer in members:
+            members.remove(consumer)
+            self._rebalance_group(group_id)
+
+    def _rebalance_groups_subscribing(self, topic: str):
+        for group_id, members in self._group_members.items():
+            if any(map(lambda member: topic in member.subscription, members)):
+                self._rebalance_group(group_id)
+
+    def _rebalance_group(self, group_id: str):
+        """assign partitions of each topic round robin among the members subscribing the topic"""
+        members = self._group_members[group_id]
+        assignments: Dict['Consumer', Set[TP]] = {member: set() for member in members}
+
+        topics = set()
+        for member in members:
+            topics.update(member.subscription)
+
+        for topic in sorted(topics):
+            subscribers = [member for member in members if topic in member.subscription]
+            for partition in range(len(self._partitions_of(topic))):
+                assignments[subscribers[partition % len(subscribers)]].add(TP(topic, partition))
+
+        for member, assignment in assignments.items():
+            member.schedule_assignment(assignment)
+
+
+class Consumer(FaustConsumer):
+    """faust consumer reading from an InProcessBroker"""
+
+    MAX_RECORDS_PER_PARTITION = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._broker: InProcessBroker = self.transport.broker
+        self._group_id = self.app.conf.id
+        self._subscription: Set[str] = set()
+        self._assigned_tps: Set[TP] = set()
+        self._positions: Dict[TP, int] = dict()
+        self._assignment_lock = asyncio.Lock()
+
+    @property
+    def subscription(self) -> Set[str]:
+        return self._subscription
+
+    async def subscribe(self, topics: Iterable[str]):
+        self._subscription = set(topics)
+        self._broker.join_group(self._group_id, self)
+
+    def schedule_assignment(self, assigned: Set[TP]):
+        # called by the broker, like kafka consumers are notified by the group coordinator
+        asyncio.ensure_future(self._on_assignment(assigned))
+
+    async def _on_assignment(self, assigned: Set[TP]):
+        async with self._assignment_lock:
+            revoked = self._assigned_tps - assigned
+            if assigned == self._assigned_tps and not revoked:
+                return
+            if revoked:
+                await self.on_partitions_revoked(revoked)
+            self._assigned_tps = set(assigned)
+            for tp in revoked:
+                self._positions.pop(tp, None)
+            self._update_assignor(assigned)
+            await self.on_partitions_assigned(set(assigned))
+
+    def _update_assignor(self, assigned: Set[TP]):
+        # faust tables find the partitions they serve and recover from the assignor which is normally fed by the
+        # kafka group protocol. With a single broker there are no standby replicas, all the partitions are actives
+        from faust.assignor.client_assignment import ClientAssignment
+
+        actives: Dict[str, List[int]] = defaultdict(list)
+        for tp in assigned:
+            actives[tp.topic].append(tp.partition)
+        assignor = self.app.assignor
+        assignor._assignment = ClientAssignment(actives=dict(actives), standbys={})
+        assignor._active_tps = set(assigned)
+        assignor._standby_tps = set()
+
+    def assignment(self) -> Set[TP]:
+        return set(self._assigned_tps)
+
+    def _new_topicpartition(self, topic: str, partition: int) -> TP:
+        return TP(topic, partition)
+
+    def _read(self, tps: Iterable[TP]) -> Dict[TP, List[InProcessRecord]]:
+        records = dict()
+        for tp in tps:
+            position = self._positions.get(tp, 0)
+            tp_records = self._broker.read(tp, position, Consumer.MAX_RECORDS_PER_PARTITION)
+            if tp_records:
+                records[tp] = tp_records
+                self._positions[tp] = tp_records[-1].offset + 1
+        return records
+
+    async def _getmany(self, active_partitions: Optional[Set[TP]], timeout: float) -> Mapping[TP, List[Any]]:
+        tps = self._assigned_tps if active_partitions is None else active_partitions
+        records = self._read(tps)
+        if not records:
+            await self._broker.wait_for_records(timeout)
+            records = self._read(tps)
+        return records
+
+    def _to_message(self, tp: TP, record: InProcessRecord) -> ConsumerMessage:
+        return ConsumerMessage(record.topic, record.partition, record.offset, record.timestamp / 1000.0, 0,
+                               record.headers, record.key, record.value, None,
+                               len(record.key) if record.key is not None else 0,
+                               len(record.value) if record.value is not None else 0, tp)
+
+    async def _commit(self, offsets: Mapping[TP, int]) -> bool:
+        self._broker.commit(self._group_id, offsets)
+        return True
+
+    async def seek_to_committed(self) -> Mapping[TP, int]:
+        # like auto.offset.reset=earliest, partitions never committed are read from the beginning
+        committed = dict()
+        for tp in self._assigned_tps:
+            offset = self._broker.committed_offset(self._group_id, tp)
+            self._positions[tp] = 0 if offset is None else offset
+            if offset is not None:
+                committed[tp] = offset
+        return committed
+
+    async def _seek(self, tp: TP, offset: int):
+        self._positions[tp] = offset
+
+    async def seek_to_beginning(self, *partitions: TP):
+        for tp in partitions:
+            self._positions[tp] = 0
+
+    async def seek_wait(self, partitions: Mapping[TP, int]):
+        for tp, offset in partitions.items():
+            await self._seek(tp, offset)
+
+    async def position(self, tp: TP) -> Optional[int]:
+        return self._positions.get(tp, None)
+
+    def highwater(self, tp: TP) -> int:
+        return self._broker.highwater(tp)
+
+    async def highwaters(self, *partitions: TP) -> Mapping[TP, int]:
+        return {tp: self._broker.highwater(tp) for tp in partitions}
+
+    async def earliest_offsets(self, *partitions: TP) -> Mapping[TP, int]:
+        # records are never deleted from the in memory log
+        return {tp: 0 for tp in partitions}
+
+    def topic_partitions(self, topic: str) -> Optional[int]:
+        return self._broker.num_partitions(topic)
+
+    def key_partition(self, topic: str, key: Optional[bytes], partition: int = None) -> Optional[int]:
+        return partition if partition is not None else self._broker.key_partition(topic, key)
+
+    async def create_topic(self, topic: str, partitions: int, replication: int, **kwargs):
+        self._broker.create_topic(topic, partitions)
+
+    def verify_event_path(self, now: float, tp: TP):
+        return None
+
+    def verify_recovery_event_path(self, now: float, tp: TP):
+        return None
+
+    def close(self):
+        self._broker.leave_group(self._group_id, self)
+
+    async def on_stop(self):
+        self.close()
+        await super().on_stop()
+
+
+class Producer(FaustProducer):
+    """faust producer appending to an InProcessBroker"""
+
+    def __init__(self, transport, loop=None, **kwargs):
+        super().__init__(transport, loop=loop, **kwargs)
+        self._broker: InProcessBroker = transport.broker
+
+    async def send(self, topic: str, key: Optional[bytes], value: Optional[bytes], partition: Optional[int],
+                   timestamp: Optional[float], headers: Any, *, transactional_id: str = None) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        fut.set_result(await self.send_and_wait(topic, key, value, partition, timestamp, headers,
+                                                transactional_id=transactional_id))
+        return fut
+
+    async def send_and_wait(self, topic: str, key: Optional[bytes], value: Optional[bytes], partition: Optional[int],
+                            timestamp: Optional[float], headers: Any, *, transactional_id: str = None) \
+            -> RecordMetadata:
+        record = self._broker.append(topic, partition, key, value, headers, timestamp)
+        return RecordMetadata(topic=topic, partition=record.partition,
+                              topic_partition=TP(topic, record.partition), offset=record.offset,
+                              timestamp=record.timestamp, timestamp_type=0)
+
+    async def create_topic(self, topic: str, partitions: int, replication: int, **kwargs):
+        self._broker.create_topic(topic, partitions)
+
+    def key_partition(self, topic: str, key: bytes) -> TP:
+        return TP(topic, self._broker.key_partition(topic, key))
+
+    def supports_headers(self) -> bool:
+        return True
+
+    # the log is appended synchronously, there is nothing to roll back, so transactions are no-op
+
+    async def begin_transaction(self, transactional_id: str):
+        pass
+
+    async def commit_transaction(self, transactional_id: str):
+        pass
+
+    async def abort_transaction(self, transactional_id: str):
+        pass
+
+    async def stop_transaction(self, transactional_id: str):
+        pass
+
+    async def maybe_begin_transaction(self, transactional_id: str):
+        pass
+
+    async def commit_transactions(self, tid_to_offset_map: Mapping[str, Mapping[TP, int]], group_id: str,
+                                  start_new_transaction: bool = True):
+        for offsets in tid_to_offset_map.values():
+            self._broker.commit(group_id, offsets)
+
+
+class Transport(base.Transport):
+
+    Consumer = Consumer
+    Producer = Producer
+
+    driver_version = "gs_framework in process broker"
+
+    def __init__(self, url, app, loop=None):
+        super().__init__(url, app, loop=loop)
+        self.broker = InProcessBroker.get(self.url[0].host or "")
+
+
+def register_transport():
+    """make faust resolve the inprocess:// broker url to Transport"""
+    from faust.transport.drivers import TRANSPORTS
+
+    TRANSPORTS[InProcessBroker.TRANSPORT_SCHEME] = f"{__name__}:Transport"
@@ -0,0 +1,107 @@
+# -*- coding: UTF-8 -*-
+"""
+Process wide metrics: counters, gauges and bounded samples with percentiles
+"""
+import math
+from collections import deque
+from typing import Dict, Any, Optional, Deque
+
+
+class Samples:
+    """keep the latest max_samples values for percentiles, and count / sum / max of all the values ever added"""
+
+    __slots__ = ("_values", "_count", "_sum", "_max")
+
+    def __init__(self, max_samples: int = 1024):
+        super().__init__()
+        self._values: Deque[float] = deque(maxlen=max_samples)
+        self._count = 0
+        self._sum = 0.0
+        self._max: Optional[float] = None
+
+    def add(self, value: float):
+        self._values.append(value)
+        self._count = self._count + 1
+        self._sum = self._sum + value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self._sum / self._count if self._count > 0 else None
+
+    def percentile(self, p: float) -> Optional[float]:
+        """p is in [0, 100], computed with nearest rank over the samples kept"""
+        if len(self._values) == 0:
+            return None
+        sorted_values = sorted(self._values)
+        rank = max(int(math.ceil(p / 100.0 * len(sorted_values))), 1)
+        return sorted_values[rank - 1]
+
+    def summary(self) -> Dict[str, Any]:
+        if len(self._values) == 0:
+            return {"count": self._count}
+        sorted_values = sorted(self._values)
+        num_values = len(sorted_values)
+
+        def nearest_rank(p: float) -> float:
+            return sorted_values[max(int(math.ceil(p / 100.0 * num_values)), 1) - 1]
+
+        return {"count": self._count, "mean": self.mean, "max": self._max,
+                "p50": nearest_rank(50), "p90": nearest_rank(90), "p99": nearest_rank(99)}
+
+
+class Metrics:
+    """
+    Named metrics of the process. Names are dot separated, like "rpc.calls.local".
+    snapshot() returns all of them in a dict, which is cheap enough to be logged or sent periodically
+    """
+
+    _counters: Dict[str, float] = dict()
+    _gauges: Dict[str, float] = dict()
+    _samples: Dict[str, Samples] = dict()
+
+    @staticmethod
+    def increase(name: str, value: float = 1):
+        Metrics._counters[name] = Metrics._counters.get(name, 0) + value
+
+    @staticmethod
+    def set_gauge(name: str, value: float):
+        Metrics._gauges[name] = value
+
+    @staticmethod
+    def observe(name: str, value: float):
+        samples = Metrics._samples.get(name, None)
+        if samples is None:
+            samples = Metrics._samples[name] = Samples()
+        samples.add(value)
+
+    @staticmethod
+    def get_counter(name: str) -> float:
+        return Metrics._counters.get(name, 0)
+
+    @staticmethod
+    def get_gauge(name: str) -> Optional[float]:
+        return Metrics._gauges.get(name, None)
+
+    @staticmethod
+    def get_samples(name: str) -> Optional[Samples]:
+        return Metrics._samples.get(name, None)
+
+    @staticmethod
+    def snapshot() -> Dict[str, Any]:
+        snapshot = dict(Metrics._counters)
+        snapshot.update(Metrics._gauges)
+        for name, samples in Metrics._samples.items():
+            snapshot[name] = samples.summary()
+        return snapshot
+
+    @staticmethod
+    def reset():
+        Metrics._counters.clear()
+        Metrics._gauges.clear()
+        Metrics._samples.clear()
@@ -1,7 +1,11 @@
-import collections
-import typing
-from typing import Set, TypeVar, Generic, List
 import heapq
+import itertools
+import random
+import time
+from collections import OrderedDict
+from typing import TypeVar, Generic, List, Dict, Tuple, Optional, Callable, Any
+
+from .metrics import Metrics
 
 # the pool interface is modified from
 # https://commons.apache.org/proper/commons-pool/api-1.6/org/apache/commons/pool/ObjectPool.html
@@ -9,129 +13,310 @@ import heapq
 POOL_ITEM_TYPE = TypeVar('POOL_ITEM_TYPE')
 
 
-class IdleObjectsHeap(Generic[POOL_ITEM_TYPE]):
+class PoolItem(Generic[POOL_ITEM_TYPE]):
+    """an object in pool and its usage"""
+
+    __slots__ = ("obj", "slots", "weight", "borrowed", "failures", "last_borrow_time", "seq", "available", "version")
+
+    def __init__(self, obj: POOL_ITEM_TYPE, slots: int, weight: float, seq: int):
+        super().__init__()
+        self.obj = obj
+        self.slots = slots
+        """number of borrowers the object can serve at the same time"""
+        self.weight = weight
+        self.borrowed = 0
+        self.failures = 0
+        self.last_borrow_time = 0.0
+        self.seq = seq
+        """unique among the items ever added to the pool, so it tells the object added again from the one removed"""
+        self.available = False
+        """True if the object has free slots, i.e. it's in the selection policy"""
+        self.version = 0
+        """increased when the item leaves or changes in the selection policy, to drop stale heap entries"""
+
+
+class SelectionPolicy(Generic[POOL_ITEM_TYPE]):
+    """decide which one of the objects having free slots is borrowed next"""
+
+    def add(self, item: PoolItem[POOL_ITEM_TYPE]):
+        raise NotImplementedError()
+
+    def remove(self, item: PoolItem[POOL_ITEM_TYPE]):
+        raise NotImplementedError()
+
+    def pop(self) -> Optional[PoolItem[POOL_ITEM_TYPE]]:
+        """None if no item is available"""
+        raise NotImplementedError()
+
+    def update(self, item: PoolItem[POOL_ITEM_TYPE]):
+        """called when failures of an available item change"""
+        pass
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def __len__(self) -> int:
+        raise NotImplementedError()
+
+
+class FIFOSelection(SelectionPolicy[POOL_ITEM_TYPE]):
+    """borrow the object which became available earliest, O(1)"""
 
     def __init__(self):
         super().__init__()
-        self._heap: List[POOL_ITEM_TYPE] = []
+        self._items: Dict[Any, PoolItem[POOL_ITEM_TYPE]] = OrderedDict()
 
-    # return true means truly added, otherwise false
-    def add_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        if obj not in self._heap:
-            heapq.heappush(self._heap, obj)
-            return True
-        else:
-            return False
+    def add(self, item: PoolItem[POOL_ITEM_TYPE]):
+        self._items[item.obj] = item
 
-    # return true means truly deleted, otherwise false
-    def remove_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        try:
-            self._heap.remove(obj)
-            remove_from_idle_objects = True
-        except ValueError:
-            remove_from_idle_objects = False
+    def remove(self, item: PoolItem[POOL_ITEM_TYPE]):
+        self._items.pop(item.obj, None)
 
-        if remove_from_idle_objects:
-            heapq.heapify(self._heap)
+    def pop(self) -> Optional[PoolItem[POOL_ITEM_TYPE]]:
+        return self._items.popitem(last=False)[1] if len(self._items) > 0 else None
 
-        return remove_from_idle_objects
+    def clear(self):
+        self._items.clear()
 
-    def borrow_object(self) -> POOL_ITEM_TYPE:
-        try:
-            obj = heapq.heappop(self._heap)
-            print(f"{obj} has been borrowed from pool")
-            return obj
-        except IndexError:
-            raise RuntimeError("No more idle object")
+    def __len__(self) -> int:
+        return len(self._items)
 
-    def return_object(self, obj: POOL_ITEM_TYPE):
-        assert obj not in self._heap
-        heapq.heappush(self._heap, obj)
-        print(f"{obj} has been returned to pool")
+
+class _HeapSelection(SelectionPolicy[POOL_ITEM_TYPE]):
+    """borrow the object of the smallest key, O(log n). Entries of removed or updated items are dropped lazily"""
+
+    def __init__(self, key: Callable[[PoolItem[POOL_ITEM_TYPE]], Any]):
+        super().__init__()
+        self._key = key
+        self._heap: List[Tuple[Any, int, int, PoolItem[POOL_ITEM_TYPE]]] = list()
+        self._size = 0
+
+    def add(self, item: PoolItem[POOL_ITEM_TYPE]):
+        item.version = item.version + 1
+        heapq.heappush(self._heap, (self._key(item), item.seq, item.version, item))
+        self._size = self._size + 1
+
+    def remove(self, item: PoolItem[POOL_ITEM_TYPE]):
+        item.version = item.version + 1
+        self._size = self._size - 1
+
+    def update(self, item: PoolItem[POOL_ITEM_TYPE]):
+        self.remove(item)
+        self.add(item)
+
+    def pop(self) -> Optional[PoolItem[POOL_ITEM_TYPE]]:
+        heap = self._heap
+        while len(heap) > 0:
+            _, _, version, item = heapq.heappop(heap)
+            if version == item.version:
+                item.version = item.version + 1
+                self._size = self._size - 1
+                return item
+        return None
 
     def clear(self):
         self._heap.clear()
+        self._size = 0
 
-    def get_num(self) -> int:
-        return len(self._heap)
+    def __len__(self) -> int:
+        return self._size
 
 
-class IdleObjectsFIFO(Generic[POOL_ITEM_TYPE]):
+class LRUSelection(_HeapSelection[POOL_ITEM_TYPE]):
+    """borrow the object borrowed least recently"""
 
     def __init__(self):
-        super().__init__()
-        self._dict: typing.OrderedDict[POOL_ITEM_TYPE, int] = collections.OrderedDict()
+        super().__init__(lambda item: item.last_borrow_time)
 
-    # return true means truly added, otherwise false
-    def add_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        len_before_add = len(self._dict)
-        self._dict[obj] = 1
-        return len(self._dict) > len_before_add
 
-    # return true means truly deleted, otherwise false
-    def remove_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        return self._dict.pop(obj, 0) != 0
+class LeastFailedSelection(_HeapSelection[POOL_ITEM_TYPE]):
+    """borrow the object with fewest failures reported, refer to Pool.report_failure"""
 
-    def borrow_object(self) -> POOL_ITEM_TYPE:
-        try:
-            obj, _ = self._dict.popitem(last=False)
-            print(f"{obj} has been borrowed from pool")
-            return obj
-        except KeyError:
-            raise RuntimeError("No more idle object")
+    def __init__(self):
+        super().__init__(lambda item: item.failures)
 
-    def return_object(self, obj: POOL_ITEM_TYPE):
-        assert obj not in self._dict
-        self._dict[obj] = 1
-        print(f"{obj} has been returned to pool")
+
+class WeightedSelection(SelectionPolicy[POOL_ITEM_TYPE]):
+    """
+    borrow objects randomly in proportion to their weights. Sampled by rejection against the max weight, which takes
+    O(1) expected when weights are of same magnitude
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._items: List[PoolItem[POOL_ITEM_TYPE]] = list()
+        self._index_by_obj: Dict[Any, int] = dict()
+        self._max_weight = 0.0
+
+    def add(self, item: PoolItem[POOL_ITEM_TYPE]):
+        self._index_by_obj[item.obj] = len(self._items)
+        self._items.append(item)
+        self._max_weight = max(self._max_weight, item.weight)
+
+    def remove(self, item: PoolItem[POOL_ITEM_TYPE]):
+        index = self._index_by_obj.pop(item.obj, None)
+        if index is None:
+            return
+        # move the last item into the hole
+        last_item = self._items.pop()
+        if last_item is not item:
+            self._items[index] = last_item
+            self._index_by_obj[last_item.obj] = index
+
+    def pop(self) -> Optional[PoolItem[POOL_ITEM_TYPE]]:
+        items = self._items
+        if len(items) == 0:
+            return None
+        while True:
+            item = items[random.randrange(len(items))]
+            if random.random() * self._max_weight < item.weight:
+                self.remove(item)
+                return item
 
     def clear(self):
-        self._dict.clear()
+        self._items.clear()
+        self._index_by_obj.clear()
+        self._max_weight = 0.0
 
-    def get_num(self) -> int:
-        return len(self._dict)
+    def __len__(self) -> int:
+        return len(self._items)
 
 
 class Pool(Generic[POOL_ITEM_TYPE]):
+    """
+    Objects are borrowed by the selection policy among the ones having free slots. All the operations are O(1) or
+    O(log n) except get_active_items. Counters "pool.{name}.borrowed / returned / exhausted" and gauges
+    "pool.{name}.active / available" are kept in Metrics
+    """
 
-    def __init__(self):
+    def __init__(self, policy: Optional[SelectionPolicy[POOL_ITEM_TYPE]] = None, name: str = "pool"):
         super().__init__()
-        self._active_objects: Set[POOL_ITEM_TYPE] = set()
-        # self._idle_objects: IdleObjectsHeap[POOL_ITEM_TYPE] = IdleObjectsHeap()
-        self._idle_objects: IdleObjectsFIFO[POOL_ITEM_TYPE] = IdleObjectsFIFO()
+        self._policy: SelectionPolicy[POOL_ITEM_TYPE] = policy if policy is not None else FIFOSelection()
+        self._items: Dict[POOL_ITEM_TYPE, PoolItem[POOL_ITEM_TYPE]] = dict()
+        self._num_active = 0
+        self._seq = itertools.count()
+        self._stale_borrows: Dict[POOL_ITEM_TYPE, int] = dict()
+        """number of borrows not returned yet of each object removed, which may have been added again"""
+        self._metrics_prefix = f"pool.{name}"
+
+    def _update_gauges(self):
+        Metrics.set_gauge(f"{self._metrics_prefix}.active", self._num_active)
+        Metrics.set_gauge(f"{self._metrics_prefix}.available", len(self._policy))
+
+    def _set_available(self, item: PoolItem[POOL_ITEM_TYPE], available: bool):
+        if item.available != available:
+            item.available = available
+            if available:
+                self._policy.add(item)
+            else:
+                self._policy.remove(item)
 
     # return true means truly added, otherwise false
-    def add_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        self._active_objects.discard(obj)
-        return self._idle_objects.add_object(obj)
+    def add_object(self, obj: POOL_ITEM_TYPE, slots: int = 1, weight: float = 1.0) -> bool:
+        assert slots > 0 and weight > 0
+        if obj in self._items:
+            return False
+        item = self._items[obj] = PoolItem(obj, slots, weight, next(self._seq))
+        self._set_available(item, True)
+        self._update_gauges()
+        return True
 
-    # return true means truly deleted, otherwise false
+    # return true means truly deleted, otherwise false. Slots borrowed are dropped when returned
     def remove_object(self, obj: POOL_ITEM_TYPE) -> bool:
-        remove_from_idle_objects = self._idle_objects.remove_object(obj)
-
-        len_of_active_objects = len(self._active_objects)
-        self._active_objects.discard(obj)
-
-        return remove_from_idle_objects or len(self._active_objects) != len_of_active_objects
+        item = self._items.pop(obj, None)
+        if item is None:
+            return False
+        self._set_available(item, False)
+        if item.borrowed > 0:
+            self._num_active = self._num_active - 1
+            self._stale_borrows[obj] = self._stale_borrows.get(obj, 0) + item.borrowed
+        self._update_gauges()
+        return True
 
     def borrow_object(self) -> POOL_ITEM_TYPE:
-        obj = self._idle_objects.borrow_object()
-        self._active_objects.add(obj)
-        return obj
-
-    def return_object(self, obj: POOL_ITEM_TYPE):
-        self._active_objects.remove(obj)
-        self._idle_objects.return_object(obj)
+        item = self._policy.pop()
+        if item is None:
+            Metrics.increase(f"{self._metrics_prefix}.exhausted")
+            raise RuntimeError("No more idle object")
+        item.available = False
+
+        if item.borrowed == 0:
+            self._num_active = self._num_active + 1
+        item.borrowed = item.borrowed + 1
+        item.last_borrow_time = time.monotonic()
+        if item.borrowed < item.slots:
+            self._set_available(item, True)
+
+        Metrics.increase(f"{self._metrics_prefix}.borrowed")
+        self._update_gauges()
+        return item.obj
+
+    def get_generation(self, obj: POOL_ITEM_TYPE) -> Optional[int]:
+        """
+        generation of the object in pool, which changes when the object is removed and added again. Borrowers pass it
+        to return_object, so that borrows made before removal are never returned to the object added again
+        """
+        item = self._items.get(obj, None)
+        return None if item is None else item.seq
+
+    def return_object(self, obj: POOL_ITEM_TYPE, generation: Optional[int] = None):
+        """
+        :param generation: of the object when borrowed, refer to get_generation. Without it, returns of the object
+        removed are told only while the object added again is not borrowed
+        """
+        item = self._items.get(obj, None)
+        num_stale_borrows = self._stale_borrows.get(obj, 0)
+        if item is None or (generation is not None and generation != item.seq) or \
+                (generation is None and item.borrowed == 0 and num_stale_borrows > 0):
+            # removed while borrowed, and maybe added again
+            if num_stale_borrows > 1:
+                self._stale_borrows[obj] = num_stale_borrows - 1
+            else:
+                self._stale_borrows.pop(obj, None)
+            Metrics.increase(f"{self._metrics_prefix}.returned_after_removed")
+            return
+
+        assert item.borrowed > 0, f"{obj} is not borrowed"
+        item.borrowed = item.borrowed - 1
+        if item.borrowed == 0:
+            self._num_active = self._num_active - 1
+        self._set_available(item, True)
+
+        Metrics.increase(f"{self._metrics_prefix}.returned")
+        self._update_gauges()
+
+    def report_failure(self, obj: POOL_ITEM_TYPE):
+        """count a failure of the object, which LeastFailedSelection takes into account"""
+        item = self._items.get(obj, None)
+        if item is not None:
+            item.failures = item.failures + 1
+            if item.available:
+                self._policy.update(item)
+            Metrics.increase(f"{self._metrics_prefix}.failures")
 
     def clear(self):
-        self._active_objects.clear()
-        self._idle_objects.clear()
+        for obj, item in self._items.items():
+            if item.borrowed > 0:
+                self._stale_borrows[obj] = self._stale_borrows.get(obj, 0) + item.borrowed
+        self._items.clear()
+        self._policy.clear()
+        self._num_active = 0
+        self._update_gauges()
+
+    def __contains__(self, obj: POOL_ITEM_TYPE) -> bool:
+        return obj in self._items
+
+    def get_item(self, obj: POOL_ITEM_TYPE) -> Optional[PoolItem[POOL_ITEM_TYPE]]:
+        return self._items.get(obj, None)
 
     def get_num_active(self) -> int:
-        return len(self._active_objects)
+        return self._num_active
 
     def get_active_items(self) -> str:
-        return ' | '.join(self._active_objects) if self.get_num_active() > 0 else 'None'
+        """for debugging, it iterates all the objects"""
+        active_objects = [str(item.obj) for item in self._items.values() if item.borrowed > 0]
+        return ' | '.join(active_objects) if len(active_objects) > 0 else 'None'
 
     def get_num_idle(self) -> int:
-        return self._idle_objects.get_num()
+        """number of objects having free slots"""
+        return len(self._policy)
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+"""
+Resource usage sampling and limits of the sub processes running tasks
+"""
+import asyncio
+import logging
+import time
+from typing import NamedTuple, Optional, Dict, Callable, Hashable
+
+import psutil
+
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessLimits(NamedTuple):
+    """None means no limit"""
+
+    max_rss_bytes: Optional[int] = None
+    max_cpu_seconds: Optional[float] = None
+
+
+class ProcessUsage(NamedTuple):
+    """usage of a process and its children"""
+
+    samples: int = 0
+    peak_cpu_percent: float = 0.0
+    avg_cpu_percent: float = 0.0
+    peak_rss_bytes: int = 0
+    avg_rss_bytes: float = 0.0
+    rss_bytes: int = 0
+    """of the latest sample"""
+    cpu_seconds: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    limit_exceeded: Optional[str] = None
+    """ProcessMonitor.EXIT_REASON_* if the process is killed by the monitor"""
+
+
+class _WatchedProcess:
+
+    __slots__ = ("process", "limits", "on_limit_exceeded", "usage", "last_sample_time", "sum_cpu_percent",
+                 "sum_rss_bytes")
+
+    def __init__(self, process: psutil.Process, limits: ProcessLimits, on_limit_exceeded: Callable[[str], None]):
+        super().__init__()
+        self.process = process
+        self.limits = limits
+        self.on_limit_exceeded = on_limit_exceeded
+        self.usage = ProcessUsage()
+        self.last_sample_time = time.monotonic()
+        self.sum_cpu_percent = 0.0
+        self.sum_rss_bytes = 0
+
+
+class ProcessMonitor:
+    """
+    One coroutine samples all the processes watched every interval_seconds, and kills the ones over their limits
+    with on_limit_exceeded. The usage of a process is kept till it's unwatched
+    """
+
+    EXIT_REASON_MEMORY_LIMIT = "memory_limit"
+    EXIT_REASON_CPU_LIMIT = "cpu_time_limit"
+
+    def __init__(self, interval_seconds: float = 5):
+        super().__init__()
+        self._interval_seconds = interval_seconds
+        self._watched: Dict[Hashable, _WatchedProcess] = dict()
+        self._sampling: Optional[asyncio.Future] = None
+
+    def watch(self, key: Hashable, pid: int, limits: Optional[ProcessLimits] = None,
+              on_limit_exceeded: Optional[Callable[[str], None]] = None):
+        try:
+            process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+        self._watched[key] = _WatchedProcess(process, limits or ProcessLimits(),
+                                             on_limit_exceeded or (lambda reason: None))
+        if self._sampling is None or self._sampling.done():
+            self._sampling = asyncio.ensure_future(self._sample_periodically())
+
+    def unwatch(self, key: Hashable) -> Optional[ProcessUsage]:
+        """stop watching and return the usage collected"""
+        watched = self._watched.pop(key, None)
+        if watched is None:
+            return None
+        usage = watched.usage
+        if usage.samples > 0:
+            Metrics.observe("sub_process.peak_rss_mb", usage.peak_rss_bytes / (1024 * 1024))
+            Metrics.observe("sub_process.cpu_seconds", usage.cpu_seconds)
+        return usage
+
+    def usage(self, key: Hashable) -> Optional[ProcessUsage]:
+        watched = self._watched.get(key, None)
+        return watched.usage if watched is not None else None
+
+    def __len__(self) -> int:
+        return len(self._watched)
+
+    def rss_bytes(self):
+        """iterate the latest rss of the processes watched"""
+        return (watched.usage.rss_bytes for watched in self._watched.values())
+
+    async def _sample_periodically(self):
+        while len(self._watched) > 0:
+            await asyncio.sleep(self._interval_seconds)
+            for watched in list(self._watched.values()):
+                try:
+                    self._sample(watched)
+                except psutil.NoSuchProcess:
+                    pass  # the process has exited, it will be unwatched
+                except psutil.Error as e:
+                    logger.warning(f"fail to sample process {watched.process.pid}: {e}")
+
+    @staticmethod
+    def _sample(watched: _WatchedProcess):
+        process = watched.process
+        cpu_times = process.cpu_times()
+        cpu_seconds = cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system
+        rss_bytes = process.memory_info().rss
+        read_bytes, write_bytes = ProcessMonitor._io_bytes(process)
+        for child in process.children(recursive=True):
+            try:
+                child_cpu_times = child.cpu_times()
+                cpu_seconds = cpu_seconds + child_cpu_times.user + child_cpu_times.system
+                rss_bytes = rss_bytes + child.memory_info().rss
+                child_read_bytes, child_write_bytes = ProcessMonitor._io_bytes(child)
+                read_bytes = read_bytes + child_read_bytes
+                write_bytes = write_bytes + child_write_bytes
+            except psutil.NoSuchProcess:
+                pass
+
+        now = time.monotonic()
+        usage = watched.usage
+        # cpu time of children exited and not waited is lost, never let it go backwards
+        cpu_seconds = max(cpu_seconds, usage.cpu_seconds)
+        elapsed_seconds = now - watched.last_sample_time
+        cpu_percent = (cpu_seconds - usage.cpu_seconds) * 100 / elapsed_seconds if elapsed_seconds > 0 else 0.0
+        watched.last_sample_time = now
+        watched.sum_cpu_percent = watched.sum_cpu_percent + cpu_percent
+        watched.sum_rss_bytes = watched.sum_rss_bytes + rss_bytes
+        samples = usage.samples + 1
+        usage = watched.usage = ProcessUsage(
+            samples=samples, peak_cpu_percent=max(usage.peak_cpu_percent, cpu_percent),
+            avg_cpu_percent=watched.sum_cpu_percent / samples, peak_rss_bytes=max(usage.peak_rss_bytes, rss_bytes),
+            avg_rss_bytes=watched.sum_rss_bytes / samples, rss_bytes=rss_bytes, cpu_seconds=cpu_seconds,
+            read_bytes=max(read_bytes, usage.read_bytes), write_bytes=max(write_bytes, usage.write_bytes),
+            limit_exceeded=usage.limit_exceeded)
+
+        if usage.limit_exceeded is None:
+            limits = watched.limits
+            if limits.max_rss_bytes is not None and rss_bytes > limits.max_rss_bytes:
+                ProcessMonitor._kill(watched, ProcessMonitor.EXIT_REASON_MEMORY_LIMIT)
+            elif limits.max_cpu_seconds is not None and cpu_seconds > limits.max_cpu_seconds:
+                ProcessMonitor._kill(watched, ProcessMonitor.EXIT_REASON_CPU_LIMIT)
+
+    @staticmethod
+    def _io_bytes(process: psutil.Process):
+        try:
+            io_counters = process.io_counters()
+            return io_counters.read_bytes, io_counters.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            return 0, 0  # not supported by the platform
+
+    @staticmethod
+    def _kill(watched: _WatchedProcess, reason: str):
+        usage = watched.usage
+        logger.warning(f"kill process {watched.process.pid} for {reason}, rss {usage.rss_bytes} bytes, "
+                       f"cpu {usage.cpu_seconds:.1f} seconds")
+        watched.usage = usage._replace(limit_exceeded=reason)
+        Metrics.increase(f"sub_process.killed.{reason}")
+        watched.on_limit_exceeded(reason)
@@ -0,0 +1,162 @@
+# -*- coding: UTF-8 -*-
+"""
+Token bucket rate limiting
+"""
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from .metrics import Metrics
+
+
+class TokenBucket:
+    """
+    Tokens are refilled at rate_per_second up to burst. Refilling is computed on demand from the time elapsed,
+    so a bucket costs nothing while idle.
+
+    Tokens can be reserved for a later time, the ones taken after are available only after it. So waiters get their
+    tokens in the order they reserved them instead of racing for each token refilled
+    """
+
+    __slots__ = ("_rate_per_second", "_burst", "_tokens", "_last_refill_time")
+
+    def __init__(self, rate_per_second: float, burst: float):
+        super().__init__()
+        assert rate_per_second > 0 and burst >= 1
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._tokens = burst
+        self._last_refill_time = time.monotonic()
+        """time.monotonic() _tokens is computed at, later than now if tokens are reserved for later"""
+
+    def reconfigure(self, rate_per_second: float, burst: float):
+        assert rate_per_second > 0 and burst >= 1
+        self._refill()
+        self._rate_per_second = rate_per_second
+        self._burst = burst
+        self._tokens = min(self._tokens, burst)
+
+    @property
+    def rate_per_second(self) -> float:
+        return self._rate_per_second
+
+    @property
+    def burst(self) -> float:
+        return self._burst
+
+    def _refill(self, till_time: Optional[float] = None):
+        if till_time is None:
+            till_time = time.monotonic()
+        if till_time > self._last_refill_time:
+            self._tokens = min(self._burst,
+                               self._tokens + (till_time - self._last_refill_time) * self._rate_per_second)
+            self._last_refill_time = till_time
+
+    @property
+    def tokens(self) -> float:
+        """tokens left after the ones reserved"""
+        self._refill()
+        return self._tokens
+
+    def available_time(self, tokens: float = 1) -> float:
+        """time.monotonic() tokens are available at, after the ones reserved"""
+        self._refill()
+        return self._last_refill_time + max(0.0, (tokens - self._tokens) / self._rate_per_second)
+
+    def seconds_to_wait(self, tokens: float = 1) -> float:
+        """till tokens are available, 0 if they are available now"""
+        return max(0.0, self.available_time(tokens) - time.monotonic())
+
+    def reserve(self, at_time: float, tokens: float = 1):
+        """take tokens at time.monotonic() at_time, which is not before available_time(tokens)"""
+        self._refill(at_time)
+        self._tokens = self._tokens - tokens
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        available_time = self.available_time(tokens)
+        now = time.monotonic()
+        if available_time <= now:
+            self.reserve(now, tokens)
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        reserved_time = max(time.monotonic(), self.available_time(tokens))
+        self.reserve(reserved_time, tokens)
+        await asyncio.sleep(reserved_time - time.monotonic())
+
+
+class KeyedRateLimiter:
+    """
+    Token buckets by scope and key, e.g. scope "account" with a bucket for each account. Acquiring takes a token from
+    the bucket of each scope given, so the strictest bucket decides. Limits are set for a whole scope or for one key of
+    it, and can be changed at any time. Scopes without limit set are not limited.
+
+    Callers get their tokens in the order they call acquire: each reserves the earliest time all its buckets have a
+    token, so one waiting for a busy key doesn't lose its turn to later callers. A reservation is kept when its caller
+    is cancelled, and limits changed apply to the reservations made afterwards.
+
+    Time each bucket makes a caller wait is observed as samples "rate_limit.wait_ms.{name}.{scope}.{key}" in Metrics
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+        self._limits: Dict[Tuple[str, Optional[str]], Tuple[float, float]] = dict()
+        """(rate_per_second, burst) by (scope, key), key None for the keys of scope without their own limits"""
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = dict()
+
+    def _limit_of(self, scope: str, key: str) -> Optional[Tuple[float, float]]:
+        limit = self._limits.get((scope, key), None)
+        return limit if limit is not None else self._limits.get((scope, None), None)
+
+    def set_limit(self, scope: str, rate_per_second: Optional[float], burst: float = 1, key: Optional[str] = None):
+        """:param rate_per_second: None removes the limit"""
+        if rate_per_second is None:
+            self._limits.pop((scope, key), None)
+        else:
+            self._limits[(scope, key)] = (rate_per_second, burst)
+
+        # buckets created are updated, they keep the tokens left
+        for bucket_scope, bucket_key in list(self._buckets.keys()):
+            if bucket_scope == scope and (key is None or key == bucket_key):
+                limit = self._limit_of(bucket_scope, bucket_key)
+                if limit is None:
+                    del self._buckets[(bucket_scope, bucket_key)]
+                else:
+                    self._buckets[(bucket_scope, bucket_key)].reconfigure(*limit)
+
+    def get_limits(self) -> Dict[str, Tuple[float, float]]:
+        """(rate_per_second, burst) by scope, or by scope.key for the limits of one key"""
+        return {scope if key is None else f"{scope}.{key}": limit for (scope, key), limit in self._limits.items()}
+
+    def _bucket(self, scope: str, key: str) -> Optional[TokenBucket]:
+        bucket = self._buckets.get((scope, key), None)
+        if bucket is None:
+            limit = self._limit_of(scope, key)
+            if limit is not None:
+                bucket = self._buckets[(scope, key)] = TokenBucket(*limit)
+        return bucket
+
+    async def acquire(self, keys: Dict[str, str]) -> float:
+        """
+        :param keys: key of each scope, e.g. {"global": "all", "account": account}
+        :return: seconds waited
+        """
+        buckets = [(scope_key, self._bucket(*scope_key)) for scope_key in keys.items()]
+        available_time_by_bucket: Dict[Tuple[str, str], float] = \
+            {scope_key: bucket.available_time() for scope_key, bucket in buckets if bucket is not None}
+        now = time.monotonic()
+        available_time_by_bucket = {scope_key: max(now, t) for scope_key, t in available_time_by_bucket.items()}
+        reserved_time = max(available_time_by_bucket.values(), default=now)
+        for scope_key, bucket in buckets:
+            if bucket is not None:
+                bucket.reserve(reserved_time)
+
+        for scope, key in keys.items():
+            Metrics.observe(f"rate_limit.wait_ms.{self._name}.{scope}.{key}",
+                            (available_time_by_bucket.get((scope, key), now) - now) * 1000)
+        seconds_to_wait = reserved_time - now
+        if seconds_to_wait > 0:
+            await asyncio.sleep(seconds_to_wait)
+        return seconds_to_wait
@@ -1,36 +1,39 @@
-import asyncio
+import logging
 import time
-from typing import Callable, Awaitable, Iterable, Dict, Any, Optional
+from typing import Callable, Awaitable, Iterable, Dict, Any, Optional, List
 
-from gs_framework.utilities import ensure_await
+from gs_framework.deadline_scheduler import DeadlineScheduler
 
 
+logger = logging.getLogger(__name__)
+
 FUNC_TEST_USAGE = Callable[[], Optional[Awaitable[None]]]
 
 
 class UsageControlData:
 
-    __slots__ = ["_resource", "_it_wait_seconds", "_wait_seconds", "_start_control_seconds"]
+    __slots__ = ["_resource", "_wait_seconds_in_turn", "_wait_index", "_start_control_seconds"]
 
     # reuse the last item of wait_seconds_in_turn
-    def __init__(self, resource: Any, wait_seconds_in_turn: Iterable[int]):
+    def __init__(self, resource: Any, wait_seconds_in_turn: List[int], wait_index: int = 0,
+                 start_control_seconds: Optional[int] = None):
         super().__init__()
         self._resource = resource
-        self._it_wait_seconds = wait_seconds_in_turn.__iter__()
-        self._wait_seconds = next(self._it_wait_seconds)
-        self._start_control_seconds = int(time.time())
+        self._wait_seconds_in_turn = wait_seconds_in_turn
+        self._wait_index = wait_index
+        self._start_control_seconds = int(time.time()) if start_control_seconds is None else start_control_seconds
 
-    async def stop_usage(self, cb_test_usage: FUNC_TEST_USAGE):
-        print(f"Stop {self._resource} from using for {self._wait_seconds} seconds")
-        await asyncio.sleep(self._wait_seconds)
-        print(f"{self._resource} has been stopped from using for {self._wait_seconds} seconds. Try it.")
+    @property
+    def wait_seconds(self) -> int:
+        return self._wait_seconds_in_turn[min(self._wait_index, len(self._wait_seconds_in_turn) - 1)]
 
-        try:
-            self._wait_seconds = next(self._it_wait_seconds)
-        except StopIteration:
-            pass  # leave self._wait_seconds with the last value
+    def next_wait(self):
+        self._wait_index = self._wait_index + 1
 
-        asyncio.ensure_future(ensure_await(cb_test_usage()))
+    @property
+    def state(self):
+        """saved with the deadline, refer to ResourceUsageControl.restore"""
+        return self._wait_index, self._start_control_seconds
 
     def __repr__(self):
         return f"{self._resource} {self.controlled_seconds} seconds"
@@ -41,24 +44,78 @@ class UsageControlData:
 
 
 class ResourceUsageControl:
+    """
+    Resources stopped from using are tested again after waiting in turn. The waits are served by a DeadlineScheduler,
+    which saves them when it persists, so that resources stay in cooldown after restart, refer to restore
+    """
 
-    __slots__ = ["_wait_seconds_in_turn", "_usage_control_data_by_resource"]
+    __slots__ = ["_wait_seconds_in_turn", "_usage_control_data_by_resource", "_scheduler", "_name",
+                 "_cooldown_until_by_resource"]
 
-    def __init__(self, wait_seconds_in_turn: Iterable[int]):
+    def __init__(self, wait_seconds_in_turn: Iterable[int], scheduler: Optional[DeadlineScheduler] = None,
+                 name: str = "resource"):
+        """:param name: tells the deadlines of this control from others in the same scheduler"""
         super().__init__()
-        self._wait_seconds_in_turn = wait_seconds_in_turn
+        self._wait_seconds_in_turn = list(wait_seconds_in_turn)
         self._usage_control_data_by_resource: Dict[Any, UsageControlData] = dict()
+        self._scheduler = scheduler if scheduler is not None else DeadlineScheduler.default()
+        self._name = name
+        self._cooldown_until_by_resource: Dict[Any, float] = dict()
+
+    def _start_cooldown(self, usage_control_data: UsageControlData, resource: Any, until: float,
+                        cb_test_usage: FUNC_TEST_USAGE):
+        self._cooldown_until_by_resource[resource] = until
+
+        def end_cooldown():
+            self._cooldown_until_by_resource.pop(resource, None)
+            logger.info(f"{resource} has been stopped from using for {usage_control_data.wait_seconds} seconds. "
+                        f"Try it.")
+            usage_control_data.next_wait()
+            return cb_test_usage()
+
+        self._scheduler.schedule((self._name, resource), until, end_cooldown, usage_control_data.state, persist=True)
 
     async def stop_usage(self, resource: Any, cb_test_usage: FUNC_TEST_USAGE):
+        """cb_test_usage is called once the resource waited, this returns at once"""
         usage_control_data = \
             self._usage_control_data_by_resource.setdefault(resource,
                                                             UsageControlData(resource, self._wait_seconds_in_turn))
-        await usage_control_data.stop_usage(cb_test_usage)
+        logger.info(f"Stop {resource} from using for {usage_control_data.wait_seconds} seconds")
+        self._start_cooldown(usage_control_data, resource, time.time() + usage_control_data.wait_seconds,
+                             cb_test_usage)
+
+    def restore(self, cb_test_usage_factory: Callable[[Any], FUNC_TEST_USAGE]) -> List[Any]:
+        """
+        put the resources in cooldown before restart in cooldown again, till the deadlines saved.
+        return the resources restored, which shouldn't be used by the caller before cb_test_usage is called
+        """
+        resources = list()
+        for (_, resource), until, (wait_index, start_control_seconds) in \
+                self._scheduler.pop_restored(lambda key: isinstance(key, tuple) and key[0] == self._name):
+            usage_control_data = self._usage_control_data_by_resource[resource] = \
+                UsageControlData(resource, self._wait_seconds_in_turn, wait_index, start_control_seconds)
+            self._start_cooldown(usage_control_data, resource, until, cb_test_usage_factory(resource))
+            resources.append(resource)
+        return resources
 
     def resume_resource(self, resource: Any) -> bool:
+        if self._scheduler.cancel((self._name, resource)):
+            self._cooldown_until_by_resource.pop(resource, None)
         return self._usage_control_data_by_resource.pop(resource, None) is not None
 
+    def resources_in_cooldown(self) -> Dict[Any, float]:
+        """resources waiting to be tested again and the time.time() they are tested, not sorted"""
+        return dict(self._cooldown_until_by_resource)
+
+    def get_num_in_cooldown(self) -> int:
+        return len(self._cooldown_until_by_resource)
+
     def get_usage_control_repr(self):
+        """cheap enough for each log line, refer to get_usage_control_details for the resources"""
+        return f"{len(self._usage_control_data_by_resource)} resources are in control, " \
+               f"{len(self._cooldown_until_by_resource)} in cooldown"
+
+    def get_usage_control_details(self):
         controlled_resources = sorted(self._usage_control_data_by_resource.values(),
                                       key=lambda r: r.controlled_seconds, reverse=True)
         return f"{len(self._usage_control_data_by_resource)} resources are in control: " \
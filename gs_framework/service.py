@@ -22,6 +22,7 @@ from .faust_utilities import FaustUtilities
 from .stateful_object import StatefulObject
 from .timer_handler import TimerHandler
 from .crontab_handler import CrontabHandler
+from .table_snapshot import TableSnapshot, StartupPhases
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +47,26 @@ class StateVarSources:
     state_var_source_name: name of state_var_source
     """
 
+    FUNC_OBJECT_REMOVED_DISPATCHER = Callable[[Any, str], Awaitable[None]]
+    """
+    The parameters are (from left to right):
+    object_pk: pk of object removed
+    state_var_source_name: name of state_var_source
+    """
+
     source_types = (ObjectStateStream, StateStreamStorage, ObjectRef)
 
     @staticmethod
     def initialize(app: AppT, service_object: object,
-                   state_var_change_dispatcher: FUNC_STATE_VAR_CHANGE_DISPATCHER):
+                   state_var_change_dispatcher: FUNC_STATE_VAR_CHANGE_DISPATCHER,
+                   object_removed_dispatcher: Optional[FUNC_OBJECT_REMOVED_DISPATCHER] = None,
+                   name_prefix: str = ""):
         """
         All the instance StreamComponents object members should be initialized by explicitly call this function
+
+        name_prefix is prepended to the names of agents and tables created for the members, so that services hosted
+        by one app (refer to ServiceHost) don't conflict. The state var source names passed to the dispatchers are
+        the member names without prefix
         """
 
         async def state_var_change_observer(state_var_source_name: Optional[str], object_pk: Any,
@@ -60,6 +74,8 @@ class StateVarSources:
                                             object_pk_bytes: bytes):
             if object_state_vars is not None:
                 await state_var_change_dispatcher(object_pk, object_state_vars, state_var_source_name)
+            elif object_removed_dispatcher is not None:
+                await object_removed_dispatcher(object_pk, state_var_source_name)
 
         for member_name, member in filter(lambda name_and_member:
                                           isinstance(name_and_member[1], StateVarSources.source_types),
@@ -67,11 +83,12 @@ class StateVarSources:
                                               (attr_name, getattr(service_object, attr_name)),
                                               dir(service_object))):
             if isinstance(member, (StateStreamStorage, ObjectRef)):
-                member.initialize(app, member_name, functools.partial(state_var_change_observer, member_name))
+                member.initialize(app, f"{name_prefix}{member_name}",
+                                  functools.partial(state_var_change_observer, member_name))
             else:
                 assert isinstance(member, ObjectStateStream)
                 member.initialize(app, functools.partial(state_var_change_observer, member_name),
-                                  f"agent_of_member_{member_name}")
+                                  f"agent_of_member_{name_prefix}{member_name}")
 
 
 class ServiceUnit:
@@ -85,40 +102,114 @@ class ServiceUnit:
     def app(self) -> App:
         return self._app
 
-    def initialize(self, app: App, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]]):
+    def initialize(self, app: App, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]],
+                   name_prefix: str = ""):
         self._app = app
 
         from .state_var_change_dispatcher import StateVarChangeDispatcher
 
         state_var_change_dispatcher = StateVarChangeDispatcher(self, on_handlers_called)
-        StateVarSources.initialize(app, self, state_var_change_dispatcher.on_state_var_changes)
+        StateVarSources.initialize(app, self, state_var_change_dispatcher.on_state_var_changes,
+                                   state_var_change_dispatcher.on_object_removed, name_prefix)
 
         CrontabHandler.init_faust_crontabs(app, self, on_handlers_called)
         TimerHandler.init_faust_timers(app, self, on_handlers_called)
 
+    def on_stop(self):
+        """called when the app the unit is initialized on stops"""
+        pass
+
 
 class Service(ServiceUnit):
 
     def __init__(self):
         super().__init__()
         self._service_add_ons: List[ServiceUnit] = None
+        self._table_snapshot: Optional[TableSnapshot] = None
+        self._startup_phases: Optional[StartupPhases] = None
 
     def add_service_units(self, *add_ons: ServiceUnit):
         if self._service_add_ons is None:
             self._service_add_ons = list()
         self._service_add_ons.extend(add_ons)
 
-    async def _start(self, app_id: str, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]]):
-        app = FaustUtilities.create_faust_app(app_id)
-        super().initialize(app, on_handlers_called)
+    def enable_table_snapshot(self, snapshot_dir: str, interval_seconds: float = 600):
+        """
+        Periodically snapshot the tables of this service into snapshot_dir. When started on a node without local
+        table data, tables are restored from the snapshot and only the changelog after the snapshot is replayed.
+        Must be called before start.
+        """
+        self._table_snapshot = TableSnapshot(snapshot_dir, interval_seconds)
+
+    @property
+    def startup_phases(self) -> Optional[StartupPhases]:
+        return self._startup_phases
+
+    def _end_startup_phase(self, phase: str):
+        # services hosted by a ServiceHost don't measure their own startup
+        if self._startup_phases is not None:
+            self._startup_phases.end_phase(phase)
+
+    def _get_app_id(self) -> str:
+        """
+        id of the app the service starts alone on, and the prefix of its agents and tables when hosted by a
+        ServiceHost. Services of which more instances run at the same time must override it to tell them apart
+        """
+        cls = self.__class__
+        return f"app-{cls.__module__}.{cls.__qualname__}"
+
+    def _get_on_handlers_called(self) -> Optional[Callable[[], Union[Awaitable[None], None]]]:
+        return None
+
+    def _initialize_on_app(self, app: App, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]],
+                           name_prefix: str = ""):
+        super().initialize(app, on_handlers_called, name_prefix)
 
         if self._service_add_ons is not None:
             for add_on in self._service_add_ons:
-                add_on.initialize(app, on_handlers_called)
+                add_on.initialize(app, on_handlers_called, name_prefix)
+
+    async def _post_start(self):
+        """called after the app is started"""
+        pass
+
+    async def _start(self, app_id: str, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]]):
+        startup_phases = self._startup_phases = StartupPhases(app_id)
+
+        app = FaustUtilities.create_faust_app(app_id)
+        self._initialize_on_app(app, on_handlers_called)
+        startup_phases.end_phase("initialize")
+
+        table_snapshot = self._table_snapshot
+        if table_snapshot is not None:
+            table_snapshot.restore(app)
+            table_snapshot.initialize(app)
+            startup_phases.end_phase("restore snapshot")
 
         await app.start()
+        startup_phases.end_phase("start app")
+
+        if table_snapshot is not None:
+            await Service._wait_for_table_recovery(app)
+            startup_phases.end_phase("replay changelog")
+
+    @staticmethod
+    async def _wait_for_table_recovery(app: App):
+        # tables are recovered in background after partitions are assigned
+        recovery = getattr(app.tables, "recovery", None)
+        recovery_completed = getattr(recovery, "completed", None)
+        if recovery_completed is not None:
+            await recovery_completed.wait()
+
+    def on_stop(self):
+        super().on_stop()
+        if self._service_add_ons is not None:
+            for add_on in self._service_add_ons:
+                add_on.on_stop()
 
     async def stop(self):
+        """stop the app the service runs on. For a service hosted by a ServiceHost, all the hosted services stop"""
+        self.on_stop()
         await self._app.stop()
 
 
@@ -163,8 +254,19 @@ class StatefulService(Service, StatefulObject):
                                      stateful_transformer=self_state_var_transformer,
                                      forward_through_in_mem_channel=True)
 
+    def _get_app_id(self) -> str:
+        return f"app-{self.pk}"
+
+    def _get_on_handlers_called(self) -> Optional[Callable[[], Union[Awaitable[None], None]]]:
+        return self.commit_state_var_changes
+
     async def start(self):
-        await super()._start(f"app-{self.pk}", self.commit_state_var_changes)
+        await super()._start(self._get_app_id(), self._get_on_handlers_called())
+        await self._post_start()
+        self._startup_phases.report()
+
+    async def _post_start(self):
+        await super()._post_start()
 
         # note that self._state_var_committer.initialize has to be called after StateVarSources.initialize
         # because self.state_var_storage.stream is initialized by StateVarSources.initialize
@@ -175,16 +277,23 @@ class StatefulService(Service, StatefulObject):
             return state_vars_storage.storage.read_state_var(pk, name, default_val)
 
         super().initialize_state(get_state_var)
+        self._end_startup_phase("initialize state")
 
         if self._cb_post_start is not None:
             res = self._cb_post_start()
             if inspect.isawaitable(res):
                 await res
+            self._end_startup_phase("post start")
 
     def commit_state_var_changes(self) -> asyncio.Future:
         state_vars_storage = self.state_vars_storage
         return super().commit_state_var_changes(state_vars_storage.stream, state_vars_storage.in_mem_channel_stream)
 
+    def delete_object(self) -> asyncio.Future:
+        """remove the state of this service from its state vars storage, so that the rows can be reclaimed"""
+        state_vars_storage = self.state_vars_storage
+        return super().delete_object(state_vars_storage.stream, state_vars_storage.in_mem_channel_stream)
+
     def publish_all_state_variables(self) -> asyncio.Future:
         self.mark_all_state_variable_changed()
         return self.commit_state_var_changes()
@@ -198,6 +307,73 @@ class StatelessService(Service, AppIdMixin):
         setattr(self, '_app_id', f"app-{inst_hash}")
         return self
 
+    def _get_app_id(self) -> str:
+        return self.app_id
+
     async def start(self):
         assert self.app_id is not None
         await super()._start(self.app_id, None)
+        await self._post_start()
+        self._startup_phases.report()
+
+
+class ServiceHost:
+    """
+    Host many services in one faust app, so that they share one consumer, producer and one member in the consumer
+    group, instead of creating an app for each of them.
+
+    The agents and tables of each hosted service are named with the app id the service would have if started alone
+    as prefix, and agents of different services reading same topic are multiplexed into one agent (refer to
+    TopicWrapper.set_message_handler).
+
+    Note that the consumer group is the host id. Hosts of same id on different nodes share the partitions of the topics
+    like services of same app id do. Use different host ids for hosts whose services should read all the partitions.
+    """
+
+    def __init__(self, host_id: str):
+        super().__init__()
+        self._host_id = host_id
+        self._app: App = None
+        self._services: List[Service] = list()
+        self._startup_phases: Optional[StartupPhases] = None
+
+    @property
+    def app(self) -> App:
+        return self._app
+
+    @property
+    def services(self) -> List[Service]:
+        return self._services
+
+    @property
+    def startup_phases(self) -> Optional[StartupPhases]:
+        return self._startup_phases
+
+    def add_services(self, *services: Service):
+        """services can only be added before the host starts, since faust doesn't start agents added later"""
+        assert self._app is None, f"service host {self._host_id} has started"
+        self._services.extend(services)
+
+    async def start(self):
+        assert self._app is None, f"service host {self._host_id} has started"
+        startup_phases = self._startup_phases = StartupPhases(self._host_id)
+
+        app = self._app = FaustUtilities.create_faust_app(self._host_id)
+        for service in self._services:
+            app_id = service._get_app_id()
+            service._initialize_on_app(app, service._get_on_handlers_called(), f"{app_id}_")
+        startup_phases.end_phase("initialize")
+
+        await app.start()
+        startup_phases.end_phase("start app")
+
+        for service in self._services:
+            await service._post_start()
+        startup_phases.end_phase("post start")
+
+        startup_phases.report()
+
+    async def stop(self):
+        for service in self._services:
+            service.on_stop()
+        await self._app.stop()
@@ -0,0 +1,320 @@
+# -*- coding: UTF-8 -*-
+"""
+Shared memory fast path for large state var values
+
+For topics enabled by SharedMemoryValues.enable, state var values whose serialized size is over the threshold are
+written once into a shared memory segment by the sender, and only a SharedValueHandle travels in the kafka message.
+Receivers on the same host map the segment and deserialize the value from it, so the bytes don't go through the
+broker; the value is still deserialized, and decompressed if it was gzipped by object_2_bytes. Receivers on other
+hosts fetch the bytes from the value server of the sender, which requires the secret given to enable.
+
+The segments only live in the sender's arena, which keeps the latest values up to arena_max_bytes in total, while the
+handles stay in the topic as long as kafka retains the messages. Resolving a handle whose segment is dropped, or whose
+sender exited, raises SharedValueLostError, which stops the agent of the topic. So only enable it for topics
+consumed as the messages arrive, never for topics replayed later, for example by new consumer groups.
+
+Shared memory requires python 3.8+. On older versions enable raises RuntimeError, and handles received are fetched
+from the value server of the sender even on the same host.
+"""
+import asyncio
+import atexit
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import struct
+from collections import OrderedDict
+from typing import NamedTuple, Tuple, Dict, Any, Optional, Union
+
+from .metrics import Metrics
+from .utilities import object_2_bytes, bytes_2_object, generate_uuid
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # python < 3.8
+    resource_tracker = None
+    SharedMemory = None
+
+logger = logging.getLogger(__name__)
+
+
+class SharedValueHandle(NamedTuple):
+    """sent in place of a state var value written into shared memory"""
+
+    host_id: str
+    segment_name: str
+    size: int
+    server_address: Optional[Tuple[str, int]]
+    """None if the sender doesn't serve values to other hosts"""
+
+
+class SharedValueLostError(RuntimeError):
+    """the value of a handle can't be read anymore"""
+    pass
+
+
+def _get_host_id() -> str:
+    """processes with same host id share /dev/shm"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot_id_file:
+            boot_id = boot_id_file.read().strip()
+    except OSError:
+        boot_id = ""
+    return f"{socket.gethostname()}-{boot_id}"
+
+
+class SharedMemoryArena:
+    """shared memory segments of the values written by this process, the oldest ones are unlinked when full"""
+
+    __slots__ = ("_max_bytes", "_total_bytes", "_segments")
+
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self._max_bytes = max_bytes
+        self._total_bytes = 0
+        self._segments: Dict[str, SharedMemory] = OrderedDict()
+
+    def put(self, data: bytes) -> Tuple[str, int]:
+        """return segment name and size"""
+        size = len(data)
+        segment = SharedMemory(name=f"gs_{generate_uuid()}", create=True, size=size)
+        segment.buf[:size] = data
+        self._segments[segment.name] = segment
+        self._total_bytes = self._total_bytes + size
+
+        segments = self._segments
+        while self._total_bytes > self._max_bytes and len(segments) > 1:
+            _, oldest_segment = segments.popitem(last=False)
+            self._total_bytes = self._total_bytes - oldest_segment.size
+            oldest_segment.close()
+            oldest_segment.unlink()
+        return segment.name, size
+
+    def get(self, segment_name: str) -> Optional[memoryview]:
+        segment = self._segments.get(segment_name, None)
+        return segment.buf if segment is not None else None
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+            segment.unlink()
+        self._segments.clear()
+        self._total_bytes = 0
+
+
+class SharedMemoryValues:
+    """
+    Opt in per topic, senders and receivers of the topic must both enable it. Given a secret, senders also serve the
+    values to receivers on other hosts having the same secret, on a port of the advertised host bound when enabled.
+
+    Connections to the value server are authenticated by challenge: the server sends a random nonce, and the client
+    answers with the hmac of the nonce keyed by the secret
+    """
+
+    MAX_ATTACHED_SEGMENTS = 64
+    NONCE_BYTES = 16
+
+    _threshold_bytes_by_topic: Dict[str, int] = dict()
+    _arena: Optional[SharedMemoryArena] = None
+    _secret: Optional[bytes] = None
+    _host_id: str = _get_host_id()
+    _server_address: Optional[Tuple[str, int]] = None
+    _server_socket: Optional[socket.socket] = None
+    _server: Optional[asyncio.Future] = None
+    _attached_segments: Dict[str, SharedMemory] = OrderedDict()
+    """segments of other processes mapped, kept mapped since deserialized values may refer to their buffers"""
+
+    @staticmethod
+    def enable(topic_name: str, threshold_bytes: int = 64 * 1024, arena_max_bytes: int = 1024 * 1024 * 1024,
+               secret: Optional[str] = None, advertised_host: Optional[str] = None, port: int = 0):
+        """
+        :param secret: shared by the senders and receivers on different hosts. None means values are only passed to
+        receivers on the same host, and no port is bound
+        :param advertised_host: the address the value server binds and receivers on other hosts connect to, the ip of
+        the host name if None
+        :param port: the port of the value server, a free port if 0. Only the first call binds the port
+        """
+        if SharedMemory is None:
+            raise RuntimeError("shared memory values require python 3.8+")
+        SharedMemoryValues._threshold_bytes_by_topic[topic_name] = threshold_bytes
+        if secret is not None:
+            SharedMemoryValues._secret = secret.encode()
+        if SharedMemoryValues._arena is None:
+            SharedMemoryValues._arena = SharedMemoryArena(arena_max_bytes)
+            atexit.register(SharedMemoryValues.close)
+
+        if SharedMemoryValues._secret is not None and SharedMemoryValues._server_socket is None:
+            # bind and listen at once so that the address is known before the event loop runs, connections are
+            # queued in the backlog until the server starts serving
+            host = advertised_host or socket.gethostbyname(socket.gethostname())
+            server_socket = SharedMemoryValues._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind((host, port))
+            server_socket.listen(128)
+            SharedMemoryValues._server_address = (host, server_socket.getsockname()[1])
+
+    @staticmethod
+    def is_enabled(topic_name: str) -> bool:
+        return topic_name in SharedMemoryValues._threshold_bytes_by_topic
+
+    @staticmethod
+    def _answer_challenge(nonce: bytes) -> bytes:
+        return hmac.new(SharedMemoryValues._secret, nonce, hashlib.sha256).digest()
+
+    @staticmethod
+    async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            nonce = os.urandom(SharedMemoryValues.NONCE_BYTES)
+            writer.write(nonce)
+            await writer.drain()
+            answer = await reader.readexactly(hashlib.sha256().digest_size)
+            if not hmac.compare_digest(answer, SharedMemoryValues._answer_challenge(nonce)):
+                Metrics.increase("shm.server.unauthorized")
+                logger.warning(f"unauthorized connection to shared memory value server from "
+                               f"{writer.get_extra_info('peername')}")
+                return
+
+            while True:
+                segment_name = (await reader.readline()).decode().strip()
+                if len(segment_name) == 0:
+                    break
+                data = SharedMemoryValues._arena.get(segment_name)
+                if data is None:
+                    writer.write(struct.pack(">Q", 0))
+                else:
+                    writer.write(struct.pack(">Q", len(data)))
+                    writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _ensure_server_started():
+        if SharedMemoryValues._server is None and SharedMemoryValues._server_socket is not None:
+            SharedMemoryValues._server = asyncio.ensure_future(
+                asyncio.start_server(SharedMemoryValues._serve, sock=SharedMemoryValues._server_socket))
+
+    @staticmethod
+    def externalize_state_vars(topic_name: str, state_vars: Union[Dict[str, Any], Tuple[Dict[str, Any], ...]],
+                               message_size: int) -> Union[Dict[str, Any], Tuple[Dict[str, Any], ...]]:
+        """
+        return state_vars with large values replaced by handles, state_vars itself is not modified.
+        state_vars can also be a tuple of state var dicts, refer to StateStreamStorage.
+        message_size is the size of state_vars serialized. No value is serialized again to measure its size unless the
+        whole message is over the threshold
+        """
+        threshold_bytes = SharedMemoryValues._threshold_bytes_by_topic.get(topic_name, None)
+        if threshold_bytes is None or state_vars is None or message_size <= threshold_bytes:
+            return state_vars
+        if isinstance(state_vars, tuple):
+            return tuple(SharedMemoryValues.externalize_state_vars(topic_name, item, message_size)
+                         for item in state_vars)
+
+        externalized = None
+        for name, value in state_vars.items():
+            if value is None or isinstance(value, (bool, int, float)):
+                continue
+            value_bytes = object_2_bytes(value)
+            if len(value_bytes) <= threshold_bytes:
+                continue
+
+            SharedMemoryValues._ensure_server_started()
+            segment_name, size = SharedMemoryValues._arena.put(value_bytes)
+            if externalized is None:
+                externalized = dict(state_vars)
+            externalized[name] = SharedValueHandle(host_id=SharedMemoryValues._host_id, segment_name=segment_name,
+                                                   size=size, server_address=SharedMemoryValues._server_address)
+            Metrics.increase("shm.values.externalized")
+            Metrics.increase("shm.bytes.externalized", size)
+        return externalized if externalized is not None else state_vars
+
+    @staticmethod
+    def _attach(segment_name: str) -> SharedMemory:
+        attached_segments = SharedMemoryValues._attached_segments
+        segment = attached_segments.get(segment_name, None)
+        if segment is None:
+            segment = SharedMemory(name=segment_name)
+            # the segment is owned by the sender, don't let the resource tracker unlink it when this process exits
+            resource_tracker.unregister(segment._name, "shared_memory")
+            attached_segments[segment_name] = segment
+            while len(attached_segments) > SharedMemoryValues.MAX_ATTACHED_SEGMENTS:
+                _, oldest_segment = attached_segments.popitem(last=False)
+                try:
+                    oldest_segment.close()
+                except BufferError:
+                    pass  # still referred by values deserialized, unmapped when they are collected
+        else:
+            attached_segments.move_to_end(segment_name)
+        return segment
+
+    @staticmethod
+    async def _fetch(handle: SharedValueHandle) -> Optional[bytes]:
+        if handle.server_address is None:
+            raise SharedValueLostError(f"host {handle.host_id} doesn't serve shared memory values to other hosts")
+        if SharedMemoryValues._secret is None:
+            raise SharedValueLostError(f"no secret to fetch shared memory values from host {handle.host_id}")
+
+        host, port = handle.server_address
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            nonce = await reader.readexactly(SharedMemoryValues.NONCE_BYTES)
+            writer.write(SharedMemoryValues._answer_challenge(nonce))
+            writer.write(f"{handle.segment_name}\n".encode())
+            await writer.drain()
+            size = struct.unpack(">Q", await reader.readexactly(8))[0]
+            return await reader.readexactly(size) if size > 0 else None
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def resolve_value(handle: SharedValueHandle) -> Any:
+        """raise SharedValueLostError if the value can't be read anymore"""
+        try:
+            if handle.host_id == SharedMemoryValues._host_id and SharedMemory is not None:
+                arena = SharedMemoryValues._arena
+                data = arena.get(handle.segment_name) if arena is not None else None
+                if data is None:
+                    data = SharedMemoryValues._attach(handle.segment_name).buf
+                Metrics.increase("shm.values.resolved.local")
+            else:
+                data = await SharedMemoryValues._fetch(handle)
+                if data is None:
+                    raise FileNotFoundError(handle.segment_name)
+                Metrics.increase("shm.values.resolved.remote")
+            return bytes_2_object(data[:handle.size])
+        except (OSError, asyncio.IncompleteReadError, SharedValueLostError) as e:
+            Metrics.increase("shm.values.lost")
+            raise SharedValueLostError(f"value in shared memory {handle.segment_name} of host {handle.host_id} is "
+                                       f"lost: {e}") from e
+
+    @staticmethod
+    def has_handles(state_vars: Union[Dict[str, Any], Tuple[Dict[str, Any], ...]]) -> bool:
+        if isinstance(state_vars, tuple):
+            return any(map(SharedMemoryValues.has_handles, state_vars))
+        return isinstance(state_vars, dict) and \
+            any(isinstance(value, SharedValueHandle) for value in state_vars.values())
+
+    @staticmethod
+    async def resolve_state_vars(state_vars: Union[Dict[str, Any], Tuple[Dict[str, Any], ...]]) \
+            -> Union[Dict[str, Any], Tuple[Dict[str, Any], ...]]:
+        """replace the handles in state_vars with values, in place"""
+        if isinstance(state_vars, tuple):
+            for item in state_vars:
+                await SharedMemoryValues.resolve_state_vars(item)
+        elif isinstance(state_vars, dict):
+            for name, value in state_vars.items():
+                if isinstance(value, SharedValueHandle):
+                    state_vars[name] = await SharedMemoryValues.resolve_value(value)
+        return state_vars
+
+    @staticmethod
+    def close():
+        """unlink the segments written by this process"""
+        if SharedMemoryValues._arena is not None:
+            SharedMemoryValues._arena.close()
+
@@ -1,9 +1,10 @@
 import inspect
-from typing import Dict, Any, Mapping, Union, Tuple, Iterable, Optional, NamedTuple
+from typing import Dict, Any, Mapping, Union, Tuple, Iterable, Optional, NamedTuple, FrozenSet
 
 from faust import ChannelT
 from faust.types import AppT, TP
 
+from .blob_store import BlobStore
 from .state_stream import STATE_OBSERVER, ObjectStateStream, StreamBinder
 from .stateful_interfaces import STATEFUL_STATE_TRANSFORMER, Clone2InstanceAttr
 from .utilities import bytes_2_object, object_2_bytes
@@ -21,8 +22,18 @@ class StorageKey(NamedTuple):
 class StateStorage(STATE_OBSERVER):
     """
     Create one table for each property name.
+
+    Besides the state vars, the names of state vars saved for each object are kept in the row whose state var name is
+    StateStorage.VAR_NAMES_INDEX, so that all the rows of an object can be dropped at once when the object is removed.
+    The index of recently saved objects is cached so that saving state vars doesn't read the index row each time. The
+    cache is dropped when partitions are assigned, as rows of the partitions may have been changed by other workers.
     """
-    __slots__ = ("_app", "_name", "_num_of_partitions", "_table")
+    __slots__ = ("_app", "_name", "_num_of_partitions", "_table", "_var_names_cache", "_var_names_index_migrated")
+
+    VAR_NAMES_INDEX = ""
+    """state var names are always in format of 'class.member', so an empty name never conflicts with them"""
+
+    VAR_NAMES_CACHE_SIZE = 100000
 
     def __init__(self, app: AppT, name: str, num_of_partitions: int):
         super().__init__()
@@ -30,27 +41,112 @@ class StateStorage(STATE_OBSERVER):
         table_help = table_name.replace('_', ' ')
         self._table = app.Table(name=table_name, default=lambda: None, key_type=bytes, value_type=bytes,
                                 help=table_help, partitions=num_of_partitions)
+        self._var_names_cache: Dict[Any, FrozenSet[str]] = dict()
+        self._var_names_index_migrated = False
+        app.on_partitions_assigned.connect(self._on_partitions_assigned)
+
+    def _on_partitions_assigned(self, sender: Any, assigned: Any = None, **kwargs):
+        self._var_names_cache.clear()
+        self._var_names_index_migrated = False
 
     def __call__(self, object_pk: Any, object_state_vars: Mapping[str, Any], headers_not_used: Mapping[str, Any],
                  object_pk_bytes_not_used: bytes):
-        state_vars_to_be_saved = None if object_state_vars is None else object_state_vars.items()
-        if state_vars_to_be_saved is not None:
-            self.save_state_vars(object_pk, *state_vars_to_be_saved)
+        if object_state_vars is None:
+            self.delete_object(object_pk)
+        else:
+            self.save_state_vars(object_pk, *object_state_vars.items())
 
     def contains_state_var(self, object_pk: Any, state_var_name: str) -> bool:
         return StorageKey(object_pk, state_var_name).to_bytes() in self._table
 
     def read_state_var(self, object_pk: Any, state_var_name: str, default_val: Any = None) -> Any:
         bytes_read = self._table.get(StorageKey(object_pk, state_var_name).to_bytes(), default_val)
-        return default_val if bytes_read == default_val else bytes_2_object(bytes_read)
+        # large values are saved as BlobRef, refer to BlobStore
+        return default_val if bytes_read == default_val else BlobStore.resolve(bytes_2_object(bytes_read))
+
+    def read_state_var_names(self, object_pk: Any) -> FrozenSet[str]:
+        var_names_cache = self._var_names_cache
+        var_names = var_names_cache.get(object_pk, None)
+        if var_names is None:
+            var_names = self.read_state_var(object_pk, StateStorage.VAR_NAMES_INDEX, frozenset())
+            self._cache_state_var_names(object_pk, var_names)
+        return var_names
+
+    def _cache_state_var_names(self, object_pk: Any, var_names: Optional[FrozenSet[str]]):
+        var_names_cache = self._var_names_cache
+        if var_names is None:
+            var_names_cache.pop(object_pk, None)
+        else:
+            if object_pk not in var_names_cache and len(var_names_cache) >= StateStorage.VAR_NAMES_CACHE_SIZE:
+                # dict keeps the insertion order, drop the earliest cached one
+                del var_names_cache[next(iter(var_names_cache))]
+            var_names_cache[object_pk] = var_names
 
     def save_state_vars(self, object_pk: Any, *state_vars: (str, Any)):
+        table = self._table
         for var_name, var_value in state_vars:
-            self._table[StorageKey(object_pk, var_name).to_bytes()] = object_2_bytes(var_value)
+            table[StorageKey(object_pk, var_name).to_bytes()] = object_2_bytes(var_value)
+
+        var_names_saved = self.read_state_var_names(object_pk)
+        if any(map(lambda name_and_value: name_and_value[0] not in var_names_saved, state_vars)):
+            self._save_state_var_names(object_pk, var_names_saved.union(map(lambda name_and_value: name_and_value[0],
+                                                                            state_vars)))
 
     def delete_state_vars(self, object_pk: Any, *state_var_names: str):
+        table = self._table
         for var_name in state_var_names:
-            self._table.pop(StorageKey(object_pk, var_name).to_bytes(), None)
+            table.pop(StorageKey(object_pk, var_name).to_bytes(), None)
+
+        var_names_saved = self.read_state_var_names(object_pk)
+        if not var_names_saved.isdisjoint(state_var_names):
+            self._save_state_var_names(object_pk, var_names_saved.difference(state_var_names))
+
+    def delete_object(self, object_pk: Any) -> bool:
+        """
+        drop all the rows saved for the object. return False if nothing is saved for the object
+        """
+        var_names_saved = self.read_state_var_names(object_pk)
+        if len(var_names_saved) == 0 and not self._var_names_index_migrated:
+            # rows may be saved before the index was introduced
+            self.migrate_var_names_index()
+            var_names_saved = self.read_state_var_names(object_pk)
+
+        if len(var_names_saved) > 0:
+            table = self._table
+            for var_name in var_names_saved:
+                table.pop(StorageKey(object_pk, var_name).to_bytes(), None)
+            table.pop(StorageKey(object_pk, StateStorage.VAR_NAMES_INDEX).to_bytes(), None)
+            self._cache_state_var_names(object_pk, frozenset())
+            return True
+        else:
+            return False
+
+    def migrate_var_names_index(self):
+        """
+        build the index rows missing for the objects saved in the partitions assigned, by scanning the table once.
+        Done on the first removal of an object without index after partitions are assigned
+        """
+        var_names_by_object: Dict[Any, set] = dict()
+        objects_indexed = set()
+        for key_bytes in list(self._table.keys()):
+            object_pk, var_name = bytes_2_object(key_bytes)
+            if var_name == StateStorage.VAR_NAMES_INDEX:
+                objects_indexed.add(object_pk)
+            else:
+                var_names_by_object.setdefault(object_pk, set()).add(var_name)
+
+        for object_pk, var_names in var_names_by_object.items():
+            if object_pk not in objects_indexed:
+                self._save_state_var_names(object_pk, frozenset(var_names))
+        self._var_names_index_migrated = True
+
+    def _save_state_var_names(self, object_pk: Any, var_names: FrozenSet[str]):
+        index_key = StorageKey(object_pk, StateStorage.VAR_NAMES_INDEX).to_bytes()
+        if len(var_names) > 0:
+            self._table[index_key] = object_2_bytes(frozenset(var_names))
+        else:
+            self._table.pop(index_key, None)
+        self._cache_state_var_names(object_pk, frozenset(var_names))
 
 
 class StateStreamStorage(StreamBinder, Clone2InstanceAttr):
@@ -146,11 +242,23 @@ class StateStreamStorage(StreamBinder, Clone2InstanceAttr):
                 if inspect.isawaitable(res):
                     await res
 
+        async def process_object_removal(object_pk: Any, headers: Dict[str, Any], object_pk_bytes: bytes):
+            # the transformer is bypassed for tombstones: only the objects having rows in this storage are reported
+            # to the observer as removed, which also filters out objects the transformer never let through
+            if state_storage.delete_object(object_pk) and observer is not None:
+                res = observer(object_pk, None, headers, object_pk_bytes)
+                if inspect.isawaitable(res):
+                    await res
+
         if self._forward_through_in_mem_channel:
             async def in_mem_channel_observer(object_pk: Any,
                                               object_state_vars: Union[Dict[str, Any],
                                                                        Tuple[Dict[str, Any], Dict[str, Any]]],
                                               headers: Dict[str, Any], object_pk_bytes: bytes):
+                if object_state_vars is None:
+                    await process_object_removal(object_pk, headers, object_pk_bytes)
+                    return
+
                 if isinstance(object_state_vars, tuple):
                     object_state_vars_2_save, object_state_vars_4_observer = object_state_vars
                 else:
@@ -168,6 +276,10 @@ class StateStreamStorage(StreamBinder, Clone2InstanceAttr):
 
             def state_stream_observer(object_pk: Any, object_state_vars: Mapping[str, Any],
                                       headers: Dict[str, Any], object_pk_bytes: bytes):
+                if object_state_vars is None:
+                    in_mem_channel_stream.delete_object(object_pk=object_pk, headers=headers)
+                    return
+
                 object_state_vars_2_save, object_state_vars_4_observer = \
                     do_transform(object_pk, object_state_vars, headers, object_pk_bytes)
 
@@ -181,6 +293,10 @@ class StateStreamStorage(StreamBinder, Clone2InstanceAttr):
         else:
             async def state_stream_observer(object_pk: Any, object_state_vars: Mapping[str, Any],
                                             headers: Dict[str, Any], object_pk_bytes: bytes):
+                if object_state_vars is None:
+                    await process_object_removal(object_pk, headers, object_pk_bytes)
+                    return
+
                 object_state_vars_2_save, object_state_vars_4_observer = \
                     do_transform(object_pk, object_state_vars, headers, object_pk_bytes)
 
@@ -8,8 +8,11 @@ from faust.types import AppT, TP
 
 from .stateful_interfaces import Clone2InstanceAttr, STATE_TRANSFORMER
 
+from .blob_store import BlobStore
 from .faust_utilities import FaustUtilities
+from .shared_memory_values import SharedMemoryValues
 from .topic_channel_wrapper import TopicWrapper, InMemoryChannelWrapper
+from .utilities import object_2_bytes
 
 STATE_OBSERVER = Callable[[Any, Union[Dict[str, Any], Tuple[Dict[str, Any], Dict[str, Any]]], Dict[str, Any], bytes],
                           Union[None, Awaitable[None]]]
@@ -86,19 +89,47 @@ class ObjectStateStream(Clone2InstanceAttr):
     def upsert_object_state(self, *, object_pk: Any = None, object_pk_bytes: bytes = None,
                             # StateStreamStorage.initialize.state_stream_observer sends a tuple
                             object_state_vars: Union[Dict[str, Any], Tuple[Dict[str, Any], Dict[str, Any]]] = None,
-                            headers: Mapping[str, Any] = None) -> asyncio.Future:
+                            headers: Mapping[str, Any] = None, partition: Optional[int] = None) -> asyncio.Future:
+        """partition of the topic to send to, chosen by object pk if not given. Ignored by in memory channel"""
         channel_wrapper = self._channel_wrapper
         assert channel_wrapper is not None, "stream not initialized"
 
         if isinstance(channel_wrapper, TopicWrapper):
-            return FaustUtilities.send_message(channel_wrapper.topic, key=object_pk, key_bytes=object_pk_bytes,
-                                               value=object_state_vars, headers=headers)
+            topic = channel_wrapper.topic
+            # the message is serialized once, values are only measured one by one if the whole message is large
+            value_bytes = object_2_bytes(object_state_vars)
+            externalized_state_vars = SharedMemoryValues.externalize_state_vars(topic.get_topic_name(),
+                                                                                object_state_vars, len(value_bytes))
+            externalized_state_vars = BlobStore.externalize_state_vars(topic.get_topic_name(), externalized_state_vars,
+                                                                       len(value_bytes))
+            if externalized_state_vars is not object_state_vars:
+                value_bytes = object_2_bytes(externalized_state_vars)
+            return FaustUtilities.send_message(topic, key=object_pk, key_bytes=object_pk_bytes,
+                                               value_bytes=value_bytes, headers=headers, partition=partition)
         else:
             assert isinstance(channel_wrapper, InMemoryChannelWrapper), f"channel_wrapper:{channel_wrapper}"
             assert object_pk is not None
             return asyncio.ensure_future(
                 channel_wrapper.channel.send(key=object_pk, value=object_state_vars, headers=headers, force=True))
 
+    def delete_object(self, *, object_pk: Any = None, object_pk_bytes: bytes = None,
+                      headers: Mapping[str, Any] = None) -> asyncio.Future:
+        """
+        publish a tombstone for the object, i.e. a message whose value is None. Observers receive None as
+        object_state_vars, stream storages drop all the state vars saved for the object
+        """
+        channel_wrapper = self._channel_wrapper
+        assert channel_wrapper is not None, "stream not initialized"
+
+        if isinstance(channel_wrapper, TopicWrapper):
+            return FaustUtilities.send_tombstone(channel_wrapper.topic, key=object_pk, key_bytes=object_pk_bytes,
+                                                 headers=headers)
+        else:
+            assert isinstance(channel_wrapper, InMemoryChannelWrapper), f"channel_wrapper:{channel_wrapper}"
+            assert object_pk is not None
+            return asyncio.ensure_future(
+                channel_wrapper.channel.send(key=object_pk, value=None, headers=headers, force=True))
+
 
 class StreamTemplate(NamedTuple):
     """
@@ -5,8 +5,10 @@ import re
 from typing import List, Optional, Union, Dict, Iterable, Callable, Any, Awaitable, Pattern
 
 from dataclasses import dataclass
-from gs_framework.handler import CHANGE_HANDLER_RESULT, process_handler_sync_result, FUNC_STATE_VAR_CHANGE_HANDLER
+from gs_framework.handler import CHANGE_HANDLER_RESULT, process_handler_sync_result, FUNC_STATE_VAR_CHANGE_HANDLER, \
+    HandlerExecutor
 
+from .blob_store import BlobStore
 from .stateful_object import State
 from .service import StatefulService
 from .state_stream import ObjectStateStream
@@ -29,6 +31,13 @@ StateVarSource = Union[str, ObjectRef, StateStreamStorage, ObjectStateStream]
 class StateVarSubscriptionDetail:
     state_var_or_names: Iterable[Union[str, StateVariable]]
     state_var_source: StateVarSource
+    executor: Optional[str] = None
+    max_workers: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class ObjectRemovalSubscriptionDetail:
+    state_var_source: StateVarSource
 
 
 @dataclass(frozen=True)
@@ -57,17 +66,27 @@ class StateVarChangeDispatcher:
     state_var_value: the value of the first found state var triggering the handler
     """
 
+    FUNC_OBJECT_REMOVED_HANDLER = Callable[[Any], CHANGE_HANDLER_RESULT]
+    """
+    The parameter is: pk of the object removed
+    """
+
     FUNC_ON_HANDLERS_CALLED = Callable[[], Union[Awaitable[None], None]]
 
     ATTR_STATE_VAR_SUBSCRIPTION_DETAIL = "_state_var_subscription_detail"
 
-    __slots__ = ("_func_on_handlers_called", "_state_var_2_handlers")
+    ATTR_OBJECT_REMOVAL_SUBSCRIPTION_DETAIL = "_object_removal_subscription_detail"
+
+    __slots__ = ("_func_on_handlers_called", "_state_var_2_handlers", "_source_name_2_removed_handlers")
 
     def __init__(self, handlers_owner: object, func_on_handlers_called: FUNC_ON_HANDLERS_CALLED):
         super().__init__()
         self._func_on_handlers_called = func_on_handlers_called
         self._state_var_2_handlers: Dict[StateVarReference, List[FUNC_STATE_VAR_CHANGE_HANDLER]] = dict()
+        self._source_name_2_removed_handlers: Dict[str, List[StateVarChangeDispatcher.FUNC_OBJECT_REMOVED_HANDLER]] \
+            = dict()
         self._collect_variable_change_handlers(handlers_owner)
+        self._collect_object_removed_handlers(handlers_owner)
 
     def _collect_variable_change_handlers(self, handlers_owner: object):
 
@@ -91,6 +110,8 @@ class StateVarChangeDispatcher:
             subscribed_state_var_names: Iterable[str] = subscribed_state_var_or_names
             state_var_source: StateVarSource = subscription_detail.state_var_source
             state_var_source_name = state_var_source if isinstance(state_var_source, str) else state_var_source.name
+            if subscription_detail.executor is not None:
+                handler = HandlerExecutor.wrap(handler, subscription_detail.executor, subscription_detail.max_workers)
 
             for state_var_reference in map(
                     lambda state_var_name: StateVarReference(state_var_name, state_var_source_name),
@@ -98,6 +119,16 @@ class StateVarChangeDispatcher:
                 state_var_handlers = self._state_var_2_handlers.setdefault(state_var_reference, list())
                 state_var_handlers.append(handler)
 
+    def _collect_object_removed_handlers(self, handlers_owner: object):
+        for name, handler in inspect.getmembers(handlers_owner, inspect.ismethod):
+            subscription_detail: ObjectRemovalSubscriptionDetail = \
+                getattr(handler, StateVarChangeDispatcher.ATTR_OBJECT_REMOVAL_SUBSCRIPTION_DETAIL, None)
+            if subscription_detail is not None:
+                state_var_source = subscription_detail.state_var_source
+                state_var_source_name = state_var_source if isinstance(state_var_source, str) \
+                    else state_var_source.name
+                self._source_name_2_removed_handlers.setdefault(state_var_source_name, list()).append(handler)
+
     _regex_matching_top_level_state_var_names: Pattern = re.compile("(?i)^[a-z_0-9]+\\.([a-z_0-9]+)$")
     """
     the first capture group of this returns the member name of the state variable
@@ -105,6 +136,11 @@ class StateVarChangeDispatcher:
 
     async def on_state_var_changes(self, state_var_owner_pk: Any, state_vars: Dict[str, Any],
                                    state_var_source_name: Optional[str]):
+        # names are added to the dict below, and the caller may keep using it, e.g. stream storages, so it's copied.
+        # handlers get the values kept in the blob store
+        state_vars = {name: BlobStore.resolve(value) for name, value in state_vars.items()} \
+            if BlobStore.has_refs(state_vars) else dict(state_vars)
+
         # if the incoming state var name is not a name of state variable defined in nested class, for example,
         # like "class.member", not "class1.class2.member",
         # the handler might refer to it with string "member" instead of "class.member", so add additional
@@ -134,6 +170,17 @@ class StateVarChangeDispatcher:
             if inspect.isawaitable(res):
                 await res
 
+    async def on_object_removed(self, object_pk: Any, state_var_source_name: Optional[str]):
+        handlers = self._source_name_2_removed_handlers.get(state_var_source_name, None)
+        if handlers is not None:
+            for handler in handlers:
+                await process_handler_sync_result(handler(object_pk))
+
+            if self._func_on_handlers_called is not None:
+                res = self._func_on_handlers_called()
+                if inspect.isawaitable(res):
+                    await res
+
 
 def _state_vars_2_iterable(state_vars: Union[StateVariableOrStateOrName, Iterable[StateVariableOrStateOrName]]):
     # NOTE：不能使用 isiterable() 的方法判断， 因为 str 对象也是 iterable 的
@@ -148,7 +195,8 @@ def _state_vars_2_iterable(state_vars: Union[StateVariableOrStateOrName, Iterabl
 
 def state_var_change_handler(
         state_vars: Union[StateVariableOrStateOrName, Iterable[StateVariableOrStateOrName]],
-        state_var_source: Optional[StateVarSource] = StatefulService.state_vars_storage):
+        state_var_source: Optional[StateVarSource] = StatefulService.state_vars_storage,
+        executor: Optional[str] = None, max_workers: Optional[int] = None):
     """
     decorator to define state var change handler
 
@@ -156,15 +204,41 @@ def state_var_change_handler(
     ----------
     state_vars:  the watched properties
     state_var_source: the class member where the changed object comes from, or the name of the class member. None for self
+    executor: None to run the handler on the event loop, "thread" or "process" to run the sync handler in a pool,
+        refer to HandlerExecutor
+    max_workers: size of the pool, default size of concurrent.futures executors if None
     -------
     """
+    assert executor in (None, HandlerExecutor.THREAD, HandlerExecutor.PROCESS), f"unknown executor {executor}"
 
     def decorator(func):
+        assert executor is None or not inspect.iscoroutinefunction(func), \
+            f"async handler {func.__qualname__} can't run in executor"
         if state_vars is not None:
             state_var_or_names = list(_state_vars_2_iterable(state_vars))
             setattr(func, StateVarChangeDispatcher.ATTR_STATE_VAR_SUBSCRIPTION_DETAIL,
                     StateVarSubscriptionDetail(state_var_or_names=state_var_or_names,
-                                               state_var_source=state_var_source))
+                                               state_var_source=state_var_source, executor=executor,
+                                               max_workers=max_workers))
+        return func
+
+    return decorator
+
+
+def object_removed_handler(state_var_source: Optional[StateVarSource] = StatefulService.state_vars_storage):
+    """
+    decorator to define handler called when an object is removed from the state var source, i.e. a tombstone of the
+    object is received. The handler accepts the pk of object removed, and returns the same as state var change handlers
+
+    Parameters
+    ----------
+    state_var_source: the class member where the removed object comes from, or the name of the class member
+    -------
+    """
+
+    def decorator(func):
+        setattr(func, StateVarChangeDispatcher.ATTR_OBJECT_REMOVAL_SUBSCRIPTION_DETAIL,
+                ObjectRemovalSubscriptionDetail(state_var_source=state_var_source))
         return func
 
     return decorator
@@ -178,6 +252,6 @@ def pick_one_change(handler: StateVarChangeDispatcher.FUNC_PICK_ONE_CHANGE_HANDL
                                     map(lambda var_name: (var_name, get_item(state_vars, var_name)),
                                         triggering_state_var_names)))
         picked_var_name, (_, picked_var_value) = picked_change
-        return handler(self, state_var_owner_pk, picked_var_name, picked_var_value)
+        return handler(self, state_var_owner_pk, picked_var_name, BlobStore.resolve(picked_var_value))
 
     return change_handler_4_multiple_vars
@@ -4,7 +4,8 @@ State Variable 对象
 """
 import asyncio
 import logging
-from typing import TypeVar, Generic, Callable, Any, Dict
+import threading
+from typing import TypeVar, Generic, Callable, Any, Dict, Optional
 
 from .state_stream import ObjectStateStream
 from .stateful_interfaces import CloneableT, SINGLE_OBJECT_STATE_READER
@@ -108,6 +109,12 @@ class StateVariableCommitter:
 
     __slots__ = ("_state_vars_changes", )
 
+    _loop_of_changes = threading.local()
+    """
+    event loop the changes made in the current thread are recorded on, set in threads running state var change
+    handlers off the loop, refer to record_changes_on
+    """
+
     def __init__(self):
         super().__init__()
         """ changed state variable and values since last commit"""
@@ -123,7 +130,9 @@ class StateVariableCommitter:
 
     def commit_state_var_changes(self, *, object_pk: Any, object_pk_bytes: bytes,
                                  stream_publishing_changes: ObjectStateStream,
-                                 stream_saving_changes: ObjectStateStream) -> asyncio.Future:
+                                 stream_saving_changes: ObjectStateStream,
+                                 partition: Optional[int] = None) -> asyncio.Future:
+        """partition only applies to stream_publishing_changes"""
         state_vars_changes = self._state_vars_changes
         if len(state_vars_changes) > 0:
             # move the changed variable out in case it's modified during sending changes
@@ -132,7 +141,8 @@ class StateVariableCommitter:
             stream_saving_changes = stream_saving_changes or stream_publishing_changes
             if id(stream_saving_changes) == id(stream_publishing_changes):
                 return stream_publishing_changes.upsert_object_state(object_pk_bytes=object_pk_bytes,
-                                                                     object_state_vars=state_vars_changes)
+                                                                     object_state_vars=state_vars_changes,
+                                                                     partition=partition)
             else:
                 changes_4_publish = dict()
                 changes_4_save = dict()
@@ -144,7 +154,8 @@ class StateVariableCommitter:
                 async_tasks = list()
                 if len(changes_4_publish) > 0:
                     async_tasks.append(stream_publishing_changes.upsert_object_state(object_pk_bytes=object_pk_bytes,
-                                                                                     object_state_vars=changes_4_publish))
+                                                                                     object_state_vars=changes_4_publish,
+                                                                                     partition=partition))
                 if len(changes_4_save) > 0:
                     async_tasks.append(stream_saving_changes.upsert_object_state(object_pk=object_pk,
                                                                                  object_state_vars=changes_4_save))
@@ -152,5 +163,34 @@ class StateVariableCommitter:
         else:
             return asyncio.ensure_future(asyncio.sleep(0))
 
-    def _on_state_var_changed(self, state_var_name: str, state_var_value: Any):
+    def delete_object(self, *, object_pk: Any, object_pk_bytes: bytes, stream_publishing_changes: ObjectStateStream,
+                      stream_saving_changes: ObjectStateStream) -> asyncio.Future:
+        # changes not committed yet are meaningless once the object is removed
+        self._state_vars_changes = dict()
+
+        stream_saving_changes = stream_saving_changes or stream_publishing_changes
+        if id(stream_saving_changes) == id(stream_publishing_changes):
+            return stream_publishing_changes.delete_object(object_pk=object_pk, object_pk_bytes=object_pk_bytes)
+        else:
+            async_tasks = [stream_publishing_changes.delete_object(object_pk=object_pk, object_pk_bytes=object_pk_bytes),
+                           stream_saving_changes.delete_object(object_pk=object_pk)]
+            return asyncio.ensure_future(asyncio.wait(async_tasks, return_when=asyncio.ALL_COMPLETED))
+
+    @staticmethod
+    def record_changes_on(loop: Optional[asyncio.AbstractEventLoop]):
+        """
+        called in a thread other than the one running the loop, before and after running code changing state vars.
+        The changes are recorded on the loop, in the order they are made, so that commits on the loop don't race with
+        them
+        """
+        StateVariableCommitter._loop_of_changes.loop = loop
+
+    def _record_state_var_change(self, state_var_name: str, state_var_value: Any):
         self._state_vars_changes[state_var_name] = state_var_value
+
+    def _on_state_var_changed(self, state_var_name: str, state_var_value: Any):
+        loop = getattr(StateVariableCommitter._loop_of_changes, "loop", None)
+        if loop is None:
+            self._state_vars_changes[state_var_name] = state_var_value
+        else:
+            loop.call_soon_threadsafe(self._record_state_var_change, state_var_name, state_var_value)
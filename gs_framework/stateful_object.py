@@ -1,9 +1,10 @@
 import asyncio
 import itertools
-from typing import List, Tuple, Iterable, Union, Any, Dict
+from typing import List, Tuple, Iterable, Union, Any, Dict, Optional
 
 from dataclasses import dataclass
 
+from .blob_store import BlobStore
 from .stateful_interfaces import PkMixin
 from .state_storage import StateStorage
 from .stateful_interfaces import SINGLE_OBJECT_STATE_READER, OBJECT_STATE_READER
@@ -202,11 +203,20 @@ class StatefulObject(PkMixin, State):
             stat_var.mark_changed()
 
     def commit_state_var_changes(self, stream_publishing_changes: ObjectStateStream,
-                                 stream_saving_changes: ObjectStateStream = None) -> asyncio.Future:
+                                 stream_saving_changes: ObjectStateStream = None,
+                                 partition: Optional[int] = None) -> asyncio.Future:
         return self._state_var_committer.commit_state_var_changes(object_pk=self.pk,
                                                                   object_pk_bytes=self._object_pk_bytes,
                                                                   stream_publishing_changes=stream_publishing_changes,
-                                                                  stream_saving_changes=stream_saving_changes)
+                                                                  stream_saving_changes=stream_saving_changes,
+                                                                  partition=partition)
+
+    def delete_object(self, stream_publishing_changes: ObjectStateStream,
+                      stream_saving_changes: ObjectStateStream = None) -> asyncio.Future:
+        """publish a tombstone of this object, uncommitted changes are dropped"""
+        return self._state_var_committer.delete_object(object_pk=self.pk, object_pk_bytes=self._object_pk_bytes,
+                                                       stream_publishing_changes=stream_publishing_changes,
+                                                       stream_saving_changes=stream_saving_changes)
 
 
 def read_stateful_object(pk: Any, state: StateMeta, *object_state_readers: OBJECT_STATE_READER) -> StatefulObject:
@@ -255,7 +265,8 @@ class MessageAsStateReader:
     state_vars: Dict[str, Any]
 
     def __call__(self, object_pk: Any, name: str, default_val: Any = None):
-        return self.state_vars.get(name, default_val) if object_pk == self.pk else default_val
+        # large values in messages are BlobRefs, refer to BlobStore
+        return BlobStore.resolve(self.state_vars.get(name, default_val)) if object_pk == self.pk else default_val
 
 
 class PropertiesAsStateReader:
@@ -4,17 +4,25 @@
 """
 import logging
 import asyncio
+import heapq
 import inspect
+import itertools
 import faust
 import traceback
 import sys
+import time
+from collections import OrderedDict, defaultdict
+from weakref import WeakValueDictionary
 
-from typing import NamedTuple, Optional, Any, Mapping, Sequence, Dict, Union, Tuple
+from typing import NamedTuple, Optional, Any, Mapping, Sequence, Dict, Union, Tuple, Callable, Awaitable, List, \
+    AsyncGenerator, AsyncIterator
 from gs_framework.stateful_interfaces import PkMixin
 
 from .service import StatelessService, ServiceUnit
 
-from .utilities import generate_uuid
+from .instance_hash_calculation import HashCalculation
+from .metrics import Metrics
+from .utilities import generate_uuid, object_2_bytes, bytes_2_object, md5_str
 from .state_var_change_dispatcher import state_var_change_handler, pick_one_change
 from .state_stream import ObjectStateStream
 from .state_variable import StateVariable
@@ -43,6 +51,9 @@ class RPCEndPoint:
     def __eq__(self, other):
         return isinstance(other, RPCEndPoint) and self.pk == other.pk and self.cls_full_name == other.cls_full_name
 
+    def __hash__(self):
+        return hash((self.pk, self.cls_full_name))
+
     # define __iter__ so HashCalculation.value_to_hash_str can work with RPCEndPoint
     def __iter__(self):
         return (self.pk, self.cls_full_name).__iter__()
@@ -60,6 +71,30 @@ class RPCReq(NamedTuple):
     args: Sequence[Any] = []
     kwargs: Mapping[str, Any] = {}
 
+    timeout_seconds: Optional[float] = None
+    """
+    time left before the caller stops waiting for the result, when the request is sent. None means no deadline.
+    The callee counts it from the time it receives the request, so that clocks of the hosts don't need to agree
+    """
+
+    priority: int = 0
+    """when the callee is busy, waiting requests of smaller priority value are executed first"""
+
+    stream_window: int = 0
+    """
+    for calls of async generator functions, the number of items the callee can send before it receives credits from
+    the caller, refer to RPCMethodStub.stream
+    """
+
+
+class RPCCalleeLoad(NamedTuple):
+    """load of an instance serving a class endpoint, advertised in its responses"""
+    topic: str
+    partitions: Tuple[int, ...]
+    """partitions of the topic consumed by the instance"""
+    load: int
+    """number of calls running or waiting in the instance"""
+
 
 class RPCResp(NamedTuple):
     call_uuid: str
@@ -68,12 +103,35 @@ class RPCResp(NamedTuple):
     ret_error: Optional[str] = None
     """exception"""
 
+    seq: Optional[int] = None
+    """sequence number of the response of a call to an async generator function, None for other calls"""
+    end_of_stream: bool = True
+    """the last response of a call to an async generator function, which doesn't carry an item"""
+
+    callee_load: Optional[RPCCalleeLoad] = None
+    """set by callees of class endpoints, refer to RPCLoadBalancer"""
+
+
+class RPCControl(NamedTuple):
+    """sent by the caller to the callee about a call in progress"""
+    call_uuid: str
+    endpoint: RPCEndPoint
+    cancel: bool = False
+    """the caller stops waiting for the result, the callee should stop executing the call"""
+    credits: int = 0
+    """number of more items the callee of an async generator function can send"""
+
 
 # the pk of this message is endpoint of the callee
 class RPCReqMessage(State):
     req = StateVariable(dtype=RPCReq, default_val=None, help="rpc request message")
 
 
+# the pk of this message is endpoint of the callee
+class RPCControlMessage(State):
+    control = StateVariable(dtype=RPCControl, default_val=None, help="rpc control message")
+
+
 # the pk of this message is endpoint of the callee
 class RPCRespMessage(State):
     resp = StateVariable(dtype=RPCResp, default_val=None, help="rpc response message")
@@ -88,7 +146,207 @@ class RPCStubData(NamedTuple):
 
 # region class for callee side
 
+class RPCLocalEndPoints:
+    """
+    Registry of the endpoints served in this process. Calls to them are executed directly instead of round tripping
+    through kafka. Calls of a class endpoint are executed here only when the load balancer picks a partition consumed by
+    this process, so that they are still spread among the instances of the consumer group, refer to RPCLoadBalancer.
+
+    With copy_on_call, args and return values are copied through serialization, like they were sent through kafka,
+    so that neither side sees modifications of the objects made by the other side afterwards.
+    """
+
+    enabled = True
+    copy_on_call = True
+
+    _end_point_units: 'WeakValueDictionary[Tuple[str, RPCEndPoint], RPCEndPointServiceUnit]' = WeakValueDictionary()
+
+    @staticmethod
+    def register(topic_name: str, endpoint: RPCEndPoint, end_point_unit: 'RPCEndPointServiceUnit'):
+        RPCLocalEndPoints._end_point_units[(topic_name, endpoint)] = end_point_unit
+
+    @staticmethod
+    def unregister(topic_name: str, endpoint: RPCEndPoint):
+        RPCLocalEndPoints._end_point_units.pop((topic_name, endpoint), None)
+
+    @staticmethod
+    def find(topic_name: str, endpoint: RPCEndPoint) -> Optional['RPCEndPointServiceUnit']:
+        if not RPCLocalEndPoints.enabled:
+            return None
+        return RPCLocalEndPoints._end_point_units.get((topic_name, endpoint), None)
+
+    @staticmethod
+    def copy(obj: Any) -> Any:
+        return bytes_2_object(object_2_bytes(obj)) if RPCLocalEndPoints.copy_on_call else obj
+
+
+class RPCAdmissionControl:
+    """
+    Limit the number of calls an endpoint executes concurrently. Calls beyond the limit wait in a queue per priority,
+    and are rejected immediately when the queue of their priority is full.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, max_queue_size: int):
+        super().__init__()
+        assert max_in_flight > 0
+        self._name = name
+        self._max_in_flight = max_in_flight
+        self._max_queue_size = max_queue_size
+        self._num_in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = list()
+        """heap of (priority, sequence, waiter). Waiters cancelled are left in the heap and skipped when popped"""
+        self._num_waiting_by_priority: Dict[int, int] = defaultdict(int)
+        self._num_waiting = 0
+        self._sequence = itertools.count()
+
+    @property
+    def num_in_flight(self) -> int:
+        return self._num_in_flight
+
+    @property
+    def num_waiting(self) -> int:
+        return self._num_waiting
+
+    def _set_num_waiting(self, priority: int, delta: int):
+        self._num_waiting_by_priority[priority] = self._num_waiting_by_priority[priority] + delta
+        self._num_waiting = self._num_waiting + delta
+        Metrics.set_gauge(f"rpc.queue_depth.{self._name}", self._num_waiting)
+
+    async def acquire(self, priority: int) -> bool:
+        """return False if the call is rejected. release must be called after the admitted call is executed"""
+        if self._num_in_flight < self._max_in_flight:
+            self._num_in_flight = self._num_in_flight + 1
+            Metrics.observe(f"rpc.queue_wait_ms.{self._name}", 0)
+            return True
+
+        if self._num_waiting_by_priority[priority] >= self._max_queue_size:
+            Metrics.increase(f"rpc.requests.shed.{self._name}")
+            return False
+
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        self._set_num_waiting(priority, 1)
+        start_time = time.monotonic()
+        try:
+            # the slot of the call released is handed over to the waiter, so _num_in_flight is not changed
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self._set_num_waiting(priority, -1)
+
+        Metrics.observe(f"rpc.queue_wait_ms.{self._name}", (time.monotonic() - start_time) * 1000)
+        return True
+
+    def release(self):
+        waiters = self._waiters
+        while waiters:
+            _, _, waiter = heapq.heappop(waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._num_in_flight = self._num_in_flight - 1
+
+
+class RPCResultCache:
+    """
+    Bounded cache of recent responses, the least recently used ones are evicted when full, and entries expire after
+    ttl_seconds.
+
+    Given to RPCEndPointServiceUnit, it makes calls idempotent: duplicate requests of a call_uuid, for example sent by
+    callers retrying, are answered from the cache without executing the method again. If persistent, the responses
+    are also kept in a faust table so that they survive restarts of the callee
+    """
+
+    __slots__ = ("_max_size", "_ttl_seconds", "_persistent", "_entries", "_table")
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 600, persistent: bool = False):
+        super().__init__()
+        assert max_size > 0
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._persistent = persistent
+        self._entries: Dict[str, Tuple[float, RPCResp]] = OrderedDict()
+        """key -> (time.time() when expired, response)"""
+        self._table = None
+
+    @property
+    def persistent(self) -> bool:
+        return self._persistent
+
+    def create_table(self, app: faust.App, table_name: str, num_of_partitions: int):
+        """must be called before the app starts"""
+        self._table = app.Table(name=table_name, default=lambda: None, key_type=bytes, value_type=bytes,
+                                help=table_name.replace('_', ' '), partitions=num_of_partitions)
+
+    def get(self, key: str) -> Optional[RPCResp]:
+        entries = self._entries
+        entry = entries.get(key, None)
+        if entry is None and self._table is not None:
+            entry_bytes = self._table.get(key.encode(), None)
+            entry = bytes_2_object(entry_bytes) if entry_bytes is not None else None
+
+        if entry is None:
+            return None
+
+        expire_time, rpc_resp = entry
+        if expire_time <= time.time():
+            entries.pop(key, None)
+            return None
+
+        # entries loaded from the table are counted in and evicted like the others
+        self._insert(key, entry)
+        return rpc_resp
+
+    def _insert(self, key: str, entry: Tuple[float, RPCResp]):
+        entries = self._entries
+        entries[key] = entry
+        entries.move_to_end(key)
+        while len(entries) > self._max_size:
+            entries.popitem(last=False)
+
+    def put(self, key: str, rpc_resp: RPCResp, ttl_seconds: Optional[float] = None, persist: bool = True):
+        """
+        :param persist: keep the response in the table as well. Responses of calls not from the callee topic, e.g.
+        local calls, are not, since the table can only be modified when processing events, and their callers don't
+        outlive the callee
+        """
+        entry = (time.time() + (self._ttl_seconds if ttl_seconds is None else ttl_seconds), rpc_resp)
+        self._insert(key, entry)
+
+        if persist and self._table is not None:
+            try:
+                self._table[key.encode()] = object_2_bytes(entry)
+            except Exception as e:
+                # faust tables can only be modified when processing events
+                logger.warning(f"failed to persist rpc result {key}: {e}")
+
+
+ATTR_RPC_CACHEABLE_TTL_SECONDS = "_rpc_cacheable_ttl_seconds"
+
+
+def rpc_cacheable(ttl_seconds: float = 600):
+    """
+    decorator of methods served through RPC whose results only depend on their arguments. Calls with arguments of
+    same hash (refer to HashCalculation.value_to_hash_str) within ttl_seconds are answered with the result memoized
+    """
+    def rpc_cacheable_decorator(func):
+        setattr(func, ATTR_RPC_CACHEABLE_TTL_SECONDS, ttl_seconds)
+        return func
+
+    return rpc_cacheable_decorator
+
+
 class RPCEndPointServiceUnit(ServiceUnit):
+    """
+    Serve an instance endpoint or a class endpoint.
+
+    Requests to a class endpoint are spread over the partitions of the callee topic, and each of them is handled by
+    the instance consuming its partition only. So a class endpoint must be served by instances of same consumer group,
+    i.e. RPCEndPointService of the class started in multiple processes, whose app ids are the same.
+    """
 
     rpc_callee_stream = ObjectStateStream.bind_at_runtime()
     """because after faust app started, new created agent cannot receive messages; new created topic can send message,
@@ -96,44 +354,341 @@ class RPCEndPointServiceUnit(ServiceUnit):
         sending messages
     """
 
+    MAX_CANCELLED_CALL_UUIDS = 1024
+    """cancel messages may arrive before the request is executed, remember this many of them"""
+
     # the service provider is either an instance having pk or a class
-    def __init__(self, service_provider: Union[PkMixin, type]):
+    def __init__(self, service_provider: Union[PkMixin, type], max_in_flight: Optional[int] = None,
+                 max_queue_size: int = 1000, result_cache: Optional[RPCResultCache] = None):
+        """
+        :param max_in_flight: max number of calls executed concurrently, None means no limit
+        :param max_queue_size: max number of calls of each priority waiting when max_in_flight calls are running
+        :param result_cache: cache of responses by call_uuid, which makes calls idempotent. None means duplicate
+        requests are executed again
+        """
         super().__init__()
         self._rpc_endpoint = RPCEndPoint(service_provider)
         self._rpc_service_provider = service_provider
+        endpoint = self._rpc_endpoint
+        self._admission_control: Optional[RPCAdmissionControl] = None if max_in_flight is None else \
+            RPCAdmissionControl(endpoint.cls_full_name if endpoint.pk is None else str(endpoint.pk),
+                                max_in_flight, max_queue_size)
+        self._running_calls: Dict[str, asyncio.Future] = dict()
+        self._cancelled_call_uuids: Dict[str, None] = OrderedDict()
+        self._stream_credits: Dict[str, asyncio.Semaphore] = dict()
+        self._result_cache = result_cache
+        self._memoized_results = RPCResultCache()
+        self._on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]] = None
 
     @property
     def rpc_stub_data(self) -> RPCStubData:
         return RPCStubData(self.rpc_callee_stream.topic_define, self._rpc_endpoint)
 
+    def initialize(self, app: faust.App, on_handlers_called: Optional[Callable[[], Union[Awaitable[None], None]]],
+                   name_prefix: str = ""):
+        super().initialize(app, on_handlers_called, name_prefix)
+        self._on_handlers_called = on_handlers_called
+        topic_define = self.rpc_callee_stream.topic_define
+        RPCLocalEndPoints.register(topic_define.topic, self._rpc_endpoint, self)
+
+        result_cache = self._result_cache
+        if result_cache is not None and result_cache.persistent:
+            endpoint = self._rpc_endpoint
+            endpoint_name = endpoint.cls_full_name if endpoint.pk is None else str(endpoint.pk)
+            result_cache.create_table(app, f"table_of_rpc_results_{name_prefix}{endpoint_name}",
+                                      topic_define.partition)
+
+    async def _execute(self, rpc_req: RPCReq) -> RPCResp:
+        """ret_val of the response is an async generator if the method called is an async generator function"""
+        try:
+            method = getattr(self._rpc_service_provider, rpc_req.method_name)
+            cacheable_ttl_seconds = getattr(method, ATTR_RPC_CACHEABLE_TTL_SECONDS, None)
+            if cacheable_ttl_seconds is not None:
+                memo_key = md5_str(f"{rpc_req.method_name}({HashCalculation.value_to_hash_str(rpc_req.args)},"
+                                   f"{HashCalculation.value_to_hash_str(rpc_req.kwargs)})")
+                memoized_resp = self._memoized_results.get(memo_key)
+                if memoized_resp is not None:
+                    Metrics.increase("rpc.requests.memoized")
+                    return memoized_resp._replace(call_uuid=rpc_req.call_uuid)
+
+            res = method(*rpc_req.args, **rpc_req.kwargs)
+            if inspect.isawaitable(res):
+                res = await res
+            rpc_resp = RPCResp(call_uuid=rpc_req.call_uuid, ret_val=res)
+
+            if cacheable_ttl_seconds is not None and not inspect.isasyncgen(res):
+                self._memoized_results.put(memo_key, rpc_resp, cacheable_ttl_seconds)
+            return rpc_resp
+        except asyncio.CancelledError:
+            # CancelledError is a subclass of Exception before python 3.8
+            raise
+        except Exception:
+            return RPCEndPointServiceUnit._error_resp(rpc_req.call_uuid)
+
+    @staticmethod
+    def _error_resp(call_uuid: str, seq: Optional[int] = None) -> RPCResp:
+        exception_type, exception, call_stack = sys.exc_info()
+        return RPCResp(call_uuid=call_uuid, seq=seq,
+                       ret_error='.'.join(traceback.format_exception(exception_type, exception, call_stack)))
+
+    async def _admit_and_execute(self, rpc_req: RPCReq, resp_stream: Optional[ObjectStateStream] = None) \
+            -> Optional[RPCResp]:
+        """
+        If the method called is an async generator function and the caller asks for a stream of items (refer to
+        RPCMethodStub.stream), the items are sent to resp_stream while the call keeps its admission, and None is
+        returned; without resp_stream the response carries an async generator which keeps the admission till it is
+        closed. If the caller doesn't ask for a stream, the response carries the list of all the items
+        """
+        admission_control = self._admission_control
+        if admission_control is not None and not await admission_control.acquire(rpc_req.priority):
+            return RPCResp(call_uuid=rpc_req.call_uuid,
+                           ret_error=f"call {rpc_req.call_uuid} rejected because the endpoint is overloaded")
+        try:
+            rpc_resp = await self._execute(rpc_req)
+            items = rpc_resp.ret_val
+            if inspect.isasyncgen(items):
+                if rpc_req.stream_window <= 0:
+                    try:
+                        return rpc_resp._replace(ret_val=[item async for item in items])
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        return RPCEndPointServiceUnit._error_resp(rpc_req.call_uuid)
+                elif resp_stream is not None:
+                    await self._send_resp_items(rpc_req, items, resp_stream)
+                    return None
+                else:
+                    # iterated by a caller in this process, the generator releases the admission when closed
+                    items = RPCEndPointServiceUnit._release_when_closed(items, admission_control)
+                    admission_control = None
+                    rpc_resp = rpc_resp._replace(ret_val=items)
+            return rpc_resp
+        finally:
+            if admission_control is not None:
+                admission_control.release()
+
+    @staticmethod
+    async def _release_when_closed(items: AsyncGenerator, admission_control: Optional[RPCAdmissionControl]):
+        try:
+            async for item in items:
+                yield item
+        finally:
+            try:
+                await items.aclose()
+            finally:
+                if admission_control is not None:
+                    admission_control.release()
+
+    async def _send_resp_items(self, rpc_req: RPCReq, items: AsyncGenerator, resp_stream: ObjectStateStream):
+        """
+        send each item generated as a response of seq 0, 1, 2 ..., followed by an end of stream response.
+        At most stream_window items are sent before the caller grants more credits
+        """
+        call_uuid = rpc_req.call_uuid
+        credits = self._stream_credits[call_uuid] = asyncio.Semaphore(rpc_req.stream_window)
+        seq = 0
+        try:
+            async for item in items:
+                await credits.acquire()
+                self._send_resp(rpc_req, RPCResp(call_uuid=call_uuid, ret_val=item, seq=seq, end_of_stream=False),
+                                resp_stream)
+                seq = seq + 1
+            end_of_stream = RPCResp(call_uuid=call_uuid, seq=seq)
+        except asyncio.CancelledError:
+            await items.aclose()
+            raise
+        except Exception:
+            end_of_stream = RPCEndPointServiceUnit._error_resp(call_uuid, seq)
+        finally:
+            self._stream_credits.pop(call_uuid, None)
+
+        self._send_resp(rpc_req, end_of_stream, resp_stream)
+
+    def get_callee_load(self) -> Optional[RPCCalleeLoad]:
+        if self._rpc_endpoint.pk is not None:
+            return None
+
+        topic_name = self.rpc_callee_stream.topic_define.topic
+        assigned_tps = self._app.assignor.assigned_actives()
+        partitions = tuple(sorted(tp.partition for tp in assigned_tps if tp.topic == topic_name))
+        return RPCCalleeLoad(topic=topic_name, partitions=partitions, load=len(self._running_calls))
+
+    def _send_resp(self, rpc_req: RPCReq, rpc_resp: RPCResp, resp_stream: ObjectStateStream):
+        callee_load = self.get_callee_load()
+        if callee_load is not None:
+            rpc_resp = rpc_resp._replace(callee_load=callee_load)
+        rpc_resp_message = create_stateful_object(rpc_req.endpoint, RPCRespMessage)
+        rpc_resp_message[RPCRespMessage.resp].VALUE = rpc_resp
+        rpc_resp_message.commit_state_var_changes(resp_stream)
+
+    def on_stop(self):
+        super().on_stop()
+        RPCLocalEndPoints.unregister(self.rpc_callee_stream.topic_define.topic, self._rpc_endpoint)
+
+    async def _call_on_handlers_called(self):
+        # like the handlers of the requests received from the callee topic, state var changes made by the method
+        # called are committed afterwards
+        if self._on_handlers_called is not None:
+            res = self._on_handlers_called()
+            if inspect.isawaitable(res):
+                await res
+
+    async def _execute_locally(self, rpc_req: RPCReq) -> RPCResp:
+        rpc_resp = await self._admit_and_execute(rpc_req)
+        items = rpc_resp.ret_val
+        if not inspect.isasyncgen(items):
+            await self._call_on_handlers_called()
+            result_cache = self._result_cache
+            if result_cache is not None and rpc_resp.ret_error is None:
+                result_cache.put(rpc_req.call_uuid, rpc_resp, persist=False)
+            return rpc_resp
+
+        async def items_then_on_handlers_called():
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
+                await self._call_on_handlers_called()
+
+        return rpc_resp._replace(ret_val=items_then_on_handlers_called())
+
+    async def call_locally(self, rpc_req: RPCReq) -> RPCResp:
+        """
+        execute a request of a caller in this process, refer to RPCLocalEndPoints. Like the requests received from the
+        callee topic, a request of a call running waits for it, responses are answered from the result cache, and
+        cancel_call stops the call.
+        Cancelling call_locally doesn't stop the call, so that the caller can send the request again.
+        Items generated by an async generator function are copied while iterated
+        """
+        call_uuid = rpc_req.call_uuid
+        result_cache = self._result_cache
+        cached_resp = result_cache.get(call_uuid) if result_cache is not None else None
+        if cached_resp is not None:
+            Metrics.increase("rpc.requests.duplicate")
+            rpc_resp = cached_resp
+        else:
+            running_call = self._running_calls.get(call_uuid, None)
+            if running_call is None:
+                rpc_req = rpc_req._replace(args=RPCLocalEndPoints.copy(rpc_req.args),
+                                           kwargs=RPCLocalEndPoints.copy(rpc_req.kwargs))
+                running_call = self._running_calls[call_uuid] = asyncio.ensure_future(self._execute_locally(rpc_req))
+                running_call.add_done_callback(lambda _: self._running_calls.pop(call_uuid, None))
+            else:
+                Metrics.increase("rpc.requests.duplicate")
+            rpc_resp = await asyncio.shield(running_call)
+
+        ret_val = rpc_resp.ret_val
+        if ret_val is None:
+            return rpc_resp
+        elif inspect.isasyncgen(ret_val):
+            async def copy_items():
+                try:
+                    async for item in ret_val:
+                        yield RPCLocalEndPoints.copy(item)
+                finally:
+                    await ret_val.aclose()
+            return rpc_resp._replace(ret_val=copy_items())
+        else:
+            return rpc_resp._replace(ret_val=RPCLocalEndPoints.copy(ret_val))
+
+    def cancel_call(self, call_uuid: str):
+        """stop executing the call. If the request has not arrived, it's dropped when it arrives"""
+        running_call = self._running_calls.get(call_uuid, None)
+        if running_call is not None:
+            running_call.cancel()
+        else:
+            cancelled_call_uuids = self._cancelled_call_uuids
+            cancelled_call_uuids[call_uuid] = None
+            while len(cancelled_call_uuids) > RPCEndPointServiceUnit.MAX_CANCELLED_CALL_UUIDS:
+                cancelled_call_uuids.popitem(last=False)
+
+    async def _execute_before_deadline(self, rpc_req: RPCReq, resp_stream: ObjectStateStream,
+                                       deadline: Optional[float]) -> Optional[RPCResp]:
+        """:param deadline: time.monotonic() when the caller stops waiting, None means no deadline"""
+        if deadline is None:
+            return await self._admit_and_execute(rpc_req, resp_stream)
+
+        try:
+            return await asyncio.wait_for(self._admit_and_execute(rpc_req, resp_stream),
+                                          deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            Metrics.increase("rpc.requests.expired")
+            return RPCResp(call_uuid=rpc_req.call_uuid, ret_error=f"deadline of call {rpc_req.call_uuid} exceeded")
+
     @state_var_change_handler(state_vars=RPCReqMessage.req, state_var_source=rpc_callee_stream)
     @pick_one_change
     async def _on_rpc_call(self, state_var_owner_pk: Any, state_var_name: str, rpc_req: RPCReq):
         # ignore rpc call not sent to myself
         if rpc_req.endpoint == self._rpc_endpoint:
-            try:
-                res = getattr(self._rpc_service_provider, rpc_req.method_name)(*rpc_req.args, **rpc_req.kwargs)
-                if inspect.isawaitable(res):
-                    res = await res
-                rpc_resp = RPCResp(call_uuid=rpc_req.call_uuid, ret_val=res)
-            except Exception:
-                exception_type, exception, call_stack = sys.exc_info()
-                rpc_resp = RPCResp(call_uuid=rpc_req.call_uuid,
-                                   ret_error='.'.join(traceback.format_exception(exception_type, exception, call_stack)))
-
-            rpc_resp_message = create_stateful_object(rpc_req.endpoint, RPCRespMessage)
-            rpc_resp_message[RPCRespMessage.resp].VALUE = rpc_resp
+            call_uuid = rpc_req.call_uuid
+            if call_uuid in self._cancelled_call_uuids:
+                del self._cancelled_call_uuids[call_uuid]
+                Metrics.increase("rpc.requests.cancelled")
+                return
+
+            timeout_seconds = rpc_req.timeout_seconds
+            if timeout_seconds is not None and timeout_seconds <= 0:
+                # nobody is waiting for the result
+                Metrics.increase("rpc.requests.expired")
+                return
+            deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+
+            if call_uuid in self._running_calls:
+                # a retry of the caller, the call running will respond
+                Metrics.increase("rpc.requests.duplicate")
+                return
 
             resp_stream = ObjectStateStream(rpc_req.resp_topic)
             resp_stream.initialize(self._app)
-            rpc_resp_message.commit_state_var_changes(resp_stream)
+
+            result_cache = self._result_cache
+            if result_cache is not None:
+                cached_resp = result_cache.get(call_uuid)
+                if cached_resp is not None:
+                    Metrics.increase("rpc.requests.duplicate")
+                    self._send_resp(rpc_req, cached_resp, resp_stream)
+                    return
+
+            running_call = asyncio.ensure_future(self._execute_before_deadline(rpc_req, resp_stream, deadline))
+            self._running_calls[call_uuid] = running_call
+            try:
+                rpc_resp = await running_call
+            except asyncio.CancelledError:
+                Metrics.increase("rpc.requests.cancelled")
+                return
+            finally:
+                self._running_calls.pop(call_uuid, None)
+
+            if rpc_resp is not None:
+                # errors may be transient, and items streamed are not kept
+                if result_cache is not None and rpc_resp.ret_error is None and not inspect.isasyncgen(rpc_resp.ret_val):
+                    result_cache.put(call_uuid, rpc_resp)
+                self._send_resp(rpc_req, rpc_resp, resp_stream)
+
+    @state_var_change_handler(state_vars=RPCControlMessage.control, state_var_source=rpc_callee_stream)
+    @pick_one_change
+    def _on_rpc_control(self, state_var_owner_pk: Any, state_var_name: str, rpc_control: RPCControl):
+        if rpc_control.endpoint != self._rpc_endpoint:
+            return
+
+        if rpc_control.credits > 0:
+            credits = self._stream_credits.get(rpc_control.call_uuid, None)
+            if credits is not None:
+                for _ in range(rpc_control.credits):
+                    credits.release()
+
+        if rpc_control.cancel:
+            self.cancel_call(rpc_control.call_uuid)
 
 
 class RPCEndPointService(StatelessService):
 
-    def __init__(self, service_provider: Union[PkMixin, type]):
+    def __init__(self, service_provider: Union[PkMixin, type], max_in_flight: Optional[int] = None,
+                 max_queue_size: int = 1000, result_cache: Optional[RPCResultCache] = None):
         super().__init__()
-        self._rpc_end_point_service_unit = RPCEndPointServiceUnit(service_provider)
+        self._rpc_end_point_service_unit = RPCEndPointServiceUnit(service_provider, max_in_flight, max_queue_size,
+                                                                  result_cache)
         self.add_service_units(self._rpc_end_point_service_unit)
 
     # If define a property rpc_callee_stream here, RPCEndPointService.rpc_callee_stream will conflicts
@@ -153,6 +708,81 @@ class RPCEndPointService(StatelessService):
 
 # region classes for caller side
 
+class RPCRespItems:
+    """
+    Responses of a call to an async generator function, put in order of their seq no matter the order they arrive
+    """
+
+    __slots__ = ("_next_seq", "_out_of_order", "_in_order")
+
+    def __init__(self):
+        super().__init__()
+        self._next_seq = 0
+        self._out_of_order: Dict[int, RPCResp] = dict()
+        self._in_order: asyncio.Queue = asyncio.Queue()
+
+    def put(self, rpc_resp: RPCResp):
+        if rpc_resp.seq is None:
+            # the method called is not an async generator function, there is only one response
+            self._in_order.put_nowait(rpc_resp)
+            return
+
+        out_of_order = self._out_of_order
+        out_of_order[rpc_resp.seq] = rpc_resp
+        while self._next_seq in out_of_order:
+            self._in_order.put_nowait(out_of_order.pop(self._next_seq))
+            self._next_seq = self._next_seq + 1
+
+    async def get(self) -> RPCResp:
+        return await self._in_order.get()
+
+
+class RPCLoadBalancer:
+    """
+    Choose the partition of the callee topic to send a request of a class endpoint to.
+
+    The partitions of the instance advertising the least load recently are chosen, round robin among them. Without
+    fresh load advertised, all the partitions are chosen round robin.
+    """
+
+    LOAD_TTL_SECONDS = 10.0
+
+    __slots__ = ("_loads_by_topic", "_round_robin_counters")
+
+    def __init__(self):
+        super().__init__()
+        self._loads_by_topic: Dict[str, Dict[Tuple[int, ...], Tuple[int, float]]] = defaultdict(dict)
+        """topic name -> partitions of an instance -> (load, time.monotonic() when advertised)"""
+        self._round_robin_counters: Dict[str, int] = defaultdict(int)
+
+    def update(self, callee_load: RPCCalleeLoad):
+        loads = self._loads_by_topic[callee_load.topic]
+        # partitions are reassigned after rebalance, drop the instances that consumed the partitions before
+        partitions = set(callee_load.partitions)
+        for stale_partitions in [p for p in loads if p != callee_load.partitions and not partitions.isdisjoint(p)]:
+            del loads[stale_partitions]
+        if len(callee_load.partitions) > 0:
+            loads[callee_load.partitions] = (callee_load.load, time.monotonic())
+
+    def pick_partition(self, topic: faust.types.TP) -> int:
+        topic_name = topic.topic
+        counter = self._round_robin_counters[topic_name]
+        self._round_robin_counters[topic_name] = counter + 1
+
+        loads = self._loads_by_topic.get(topic_name, None)
+        if loads:
+            now = time.monotonic()
+            fresh_loads = [(load, partitions) for partitions, (load, advertised_time) in loads.items()
+                           if now - advertised_time <= RPCLoadBalancer.LOAD_TTL_SECONDS]
+            if fresh_loads:
+                load, partitions = min(fresh_loads)
+                # count the request in until the instance advertises again, so that a burst is spread
+                loads[partitions] = (load + 1, loads[partitions][1])
+                return partitions[counter % len(partitions)]
+
+        return counter % topic.partition
+
+
 class RPCCaller:
     """The base class for classes will call RPC"""
 
@@ -165,6 +795,12 @@ class RPCCaller:
     def __init__(self):
         super().__init__()
         self._call_result_futures_by_call_uuid: Dict[str, asyncio.Future] = dict()
+        self._call_resp_items_by_call_uuid: Dict[str, RPCRespItems] = dict()
+        self._rpc_load_balancer = RPCLoadBalancer()
+
+    @property
+    def rpc_load_balancer(self) -> RPCLoadBalancer:
+        return self._rpc_load_balancer
 
     def generate_result_future(self) -> Tuple[str, asyncio.Future]:
         call_uuid = generate_uuid()
@@ -176,12 +812,28 @@ class RPCCaller:
         # use pop instead of del in case the call_uuid has also been dropped by rpc response
         self._call_result_futures_by_call_uuid.pop(call_uuid, None)
 
+    def generate_resp_items(self) -> Tuple[str, RPCRespItems]:
+        call_uuid = generate_uuid()
+        resp_items = self._call_resp_items_by_call_uuid[call_uuid] = RPCRespItems()
+        return call_uuid, resp_items
+
+    def drop_resp_items(self, call_uuid: str):
+        self._call_resp_items_by_call_uuid.pop(call_uuid, None)
+
     def _create_rpc_stub(self, rpc_stub_data: RPCStubData):
         return RPCStub(self, rpc_stub_data)
 
     @state_var_change_handler(state_vars=RPCRespMessage.resp, state_var_source=rpc_caller_stream)
     @pick_one_change
     def _on_rpc_resp(self, state_var_owner_pk: Any, state_var_name: str, rpc_resp: RPCResp):
+        if rpc_resp.callee_load is not None:
+            self._rpc_load_balancer.update(rpc_resp.callee_load)
+
+        resp_items = self._call_resp_items_by_call_uuid.get(rpc_resp.call_uuid, None)
+        if resp_items is not None:
+            resp_items.put(rpc_resp)
+            return
+
         try:
             call_result_future = self._call_result_futures_by_call_uuid.pop(rpc_resp.call_uuid)
             call_result_future.set_result(rpc_resp)
@@ -212,31 +864,201 @@ class RPCMethodStub:
         self._rpc_stub = rpc_stub
         self._method_name = method_name
 
-    async def __call__(self, *args, rpc_timeout_seconds=24 * 3600, **kwargs):
+    def _send_req(self, call_uuid: str, args: Sequence[Any], kwargs: Mapping[str, Any], deadline: float,
+                  rpc_priority: int, stream_window: int = 0, partition: Optional[int] = None) \
+            -> Tuple[ObjectStateStream, Optional[int], asyncio.Future]:
+        """
+        deadline is time.monotonic() of this process, the time left is sent to the callee.
+        return the request stream, the partition the request is sent to, and the future of sending.
+        Retries pass the partition of the first request, so that the instance having its result receives it
+        """
         rpc_stub = self._rpc_stub
         rpc_caller = rpc_stub.rpc_caller
-
-        call_uuid, call_result_future = rpc_caller.generate_result_future()
-
-        # send msg to rpc call
         callee_endpoint = rpc_stub.stub_data.endpoint
+        # requests to an instance endpoint are partitioned by the endpoint, i.e. the pk of the message
+        if partition is None and callee_endpoint.pk is None:
+            partition = rpc_caller.rpc_load_balancer.pick_partition(rpc_stub.stub_data.topic)
+
         rpc_req_message = create_stateful_object(callee_endpoint, RPCReqMessage)
         rpc_req_message[RPCReqMessage.req].VALUE = RPCReq(call_uuid=call_uuid, endpoint=callee_endpoint,
                                                           resp_topic=rpc_caller.rpc_caller_stream.topic_define,
-                                                          method_name=self._method_name, args=args, kwargs=kwargs)
+                                                          method_name=self._method_name, args=args, kwargs=kwargs,
+                                                          timeout_seconds=max(0.0, deadline - time.monotonic()),
+                                                          priority=rpc_priority,
+                                                          stream_window=stream_window)
 
         req_stream = ObjectStateStream(rpc_stub.stub_data.topic)
         req_stream.initialize(rpc_caller.app)  # assert isinstance(rpc_caller, Service)
-        await rpc_req_message.commit_state_var_changes(req_stream)
+        return req_stream, partition, rpc_req_message.commit_state_var_changes(req_stream, partition=partition)
+
+    def _send_control(self, req_stream: ObjectStateStream, partition: Optional[int], call_uuid: str, *,
+                      cancel: bool = False, credits: int = 0):
+        # control messages are sent to the partition of the request, so the instance executing it receives them
+        callee_endpoint = self._rpc_stub.stub_data.endpoint
+        rpc_control_message = create_stateful_object(callee_endpoint, RPCControlMessage)
+        rpc_control_message[RPCControlMessage.control].VALUE = RPCControl(call_uuid=call_uuid, endpoint=callee_endpoint,
+                                                                          cancel=cancel, credits=credits)
+        rpc_control_message.commit_state_var_changes(req_stream, partition=partition)
+
+    def _find_local_end_point(self) -> Tuple[Optional[RPCEndPointServiceUnit], Optional[int]]:
+        """
+        return the endpoint unit to call in this process, or the partition to send the request to, None if it's
+        picked on sending. Calls of a class endpoint are spread by the load balancer among the instances of the
+        consumer group, this process included with its current load
+        """
+        rpc_stub = self._rpc_stub
+        topic = rpc_stub.stub_data.topic
+        local_end_point = RPCLocalEndPoints.find(topic.topic, rpc_stub.stub_data.endpoint)
+        if local_end_point is None or rpc_stub.stub_data.endpoint.pk is not None:
+            return local_end_point, None
+
+        callee_load = local_end_point.get_callee_load()
+        load_balancer = rpc_stub.rpc_caller.rpc_load_balancer
+        load_balancer.update(callee_load)
+        partition = load_balancer.pick_partition(topic)
+        return (local_end_point, None) if partition in callee_load.partitions else (None, partition)
+
+    async def __call__(self, *args, rpc_timeout_seconds=24 * 3600, rpc_priority: int = 0, rpc_retries: int = 0,
+                       **kwargs):
+        """
+        rpc_timeout_seconds is the time waiting for each attempt. After timeout, the request is sent again with same
+        call_uuid at most rpc_retries times; callees with result cache execute it only once
+        """
+        rpc_stub = self._rpc_stub
+        rpc_caller = rpc_stub.rpc_caller
+
+        local_end_point, partition = self._find_local_end_point()
+        if local_end_point is not None:
+            return await self._call_locally(local_end_point, args, kwargs, rpc_timeout_seconds, rpc_priority,
+                                            rpc_retries)
 
-        # await call result future be set result by _on_rpc_resp
+        start_time = time.monotonic()
+        call_uuid, call_result_future = rpc_caller.generate_result_future()
+
+        deadline = time.monotonic() + rpc_timeout_seconds * (rpc_retries + 1)
         try:
-            await asyncio.wait_for(call_result_future, rpc_timeout_seconds)
-        except asyncio.TimeoutError as err:
-            call_result_future.set_result(RPCResp(call_uuid=call_uuid, ret_error=str(err)))
+            for attempt in range(rpc_retries + 1):
+                # send msg to rpc call
+                req_stream, partition, req_sent = self._send_req(call_uuid, args, kwargs, deadline, rpc_priority,
+                                                                 partition=partition)
+                await req_sent
+
+                # await call result future be set result by _on_rpc_resp
+                try:
+                    # shield the future from being cancelled by timeout, the response may arrive during retries
+                    rpc_ret: RPCResp = await asyncio.wait_for(asyncio.shield(call_result_future), rpc_timeout_seconds)
+                    break
+                except asyncio.TimeoutError as err:
+                    rpc_ret = RPCResp(call_uuid=call_uuid, ret_error=f"rpc call {self._method_name} timeout: {err}")
+                    if attempt < rpc_retries:
+                        Metrics.increase("rpc.calls.retried")
+            else:
+                # tell the callee to stop working on the call
+                self._send_control(req_stream, partition, call_uuid, cancel=True)
+        finally:
             rpc_caller.drop_result_future(call_uuid)
 
-        rpc_ret: RPCResp = call_result_future.result()
+        Metrics.increase("rpc.calls.remote")
+        Metrics.observe("rpc.latency_ms.remote", (time.monotonic() - start_time) * 1000)
+        return RPCMethodStub._get_ret_val(rpc_ret)
+
+    async def stream(self, *args, rpc_timeout_seconds=24 * 3600, rpc_priority: int = 0,
+                     rpc_stream_window: int = 16, **kwargs) -> AsyncIterator[Any]:
+        """
+        call an async generator function of the callee, and iterate the items it generates as they arrive:
+
+            async for item in stub.method.stream(*args, **kwargs):
+
+        The callee sends at most rpc_stream_window items ahead of the items iterated here, so memory is bounded on
+        both sides. rpc_timeout_seconds limits the time of the whole iteration.
+        Calling a normal function this way iterates its only return value
+        """
+        assert rpc_stream_window > 0
+        rpc_stub = self._rpc_stub
+        rpc_caller = rpc_stub.rpc_caller
+        deadline = time.monotonic() + rpc_timeout_seconds
+
+        local_end_point, partition = self._find_local_end_point()
+        if local_end_point is not None:
+            rpc_req = RPCReq(call_uuid=generate_uuid(), endpoint=rpc_stub.stub_data.endpoint, resp_topic=None,
+                             method_name=self._method_name, args=args, kwargs=kwargs,
+                             timeout_seconds=rpc_timeout_seconds, priority=rpc_priority,
+                             stream_window=rpc_stream_window)
+            ret_val = RPCMethodStub._get_ret_val(
+                await asyncio.wait_for(local_end_point.call_locally(rpc_req), rpc_timeout_seconds))
+            if inspect.isasyncgen(ret_val):
+                try:
+                    async for item in ret_val:
+                        yield item
+                finally:
+                    # release the admission of the call if the iteration is abandoned
+                    await ret_val.aclose()
+            else:
+                yield ret_val
+            return
+
+        call_uuid, resp_items = rpc_caller.generate_resp_items()
+        req_stream, partition, req_sent = self._send_req(call_uuid, args, kwargs, deadline, rpc_priority,
+                                                         rpc_stream_window, partition)
+        await req_sent
+
+        completed = False
+        num_items_not_credited = 0
+        try:
+            while True:
+                rpc_resp = await asyncio.wait_for(resp_items.get(), deadline - time.monotonic())
+                if rpc_resp.ret_error:
+                    completed = True
+                    raise RuntimeError(rpc_resp.ret_error)
+                if rpc_resp.seq is None:
+                    completed = True
+                    yield rpc_resp.ret_val
+                    return
+                if rpc_resp.end_of_stream:
+                    completed = True
+                    return
+
+                yield rpc_resp.ret_val
+
+                # give back credits in batches to save messages
+                num_items_not_credited = num_items_not_credited + 1
+                if num_items_not_credited * 2 >= rpc_stream_window:
+                    self._send_control(req_stream, partition, call_uuid, credits=num_items_not_credited)
+                    num_items_not_credited = 0
+        finally:
+            rpc_caller.drop_resp_items(call_uuid)
+            if not completed:
+                # timeout, or the iteration is abandoned
+                self._send_control(req_stream, partition, call_uuid, cancel=True)
+
+    async def _call_locally(self, local_end_point: RPCEndPointServiceUnit, args: Sequence[Any],
+                            kwargs: Mapping[str, Any], rpc_timeout_seconds: float, rpc_priority: int,
+                            rpc_retries: int):
+        start_time = time.monotonic()
+        rpc_req = RPCReq(call_uuid=generate_uuid(), endpoint=self._rpc_stub.stub_data.endpoint, resp_topic=None,
+                         method_name=self._method_name, args=args, kwargs=kwargs,
+                         timeout_seconds=rpc_timeout_seconds * (rpc_retries + 1), priority=rpc_priority)
+        for attempt in range(rpc_retries + 1):
+            try:
+                # the call keeps running after timeout, a retry waits for it like a retry sent through kafka
+                rpc_ret = await asyncio.wait_for(local_end_point.call_locally(rpc_req), rpc_timeout_seconds)
+                break
+            except asyncio.TimeoutError as err:
+                rpc_ret = RPCResp(call_uuid=rpc_req.call_uuid, ret_error=f"rpc call {self._method_name} timeout: {err}")
+                if attempt < rpc_retries:
+                    Metrics.increase("rpc.calls.retried")
+            except asyncio.CancelledError:
+                local_end_point.cancel_call(rpc_req.call_uuid)
+                raise
+        else:
+            local_end_point.cancel_call(rpc_req.call_uuid)
+
+        Metrics.increase("rpc.calls.local")
+        Metrics.observe("rpc.latency_ms.local", (time.monotonic() - start_time) * 1000)
+        return RPCMethodStub._get_ret_val(rpc_ret)
+
+    @staticmethod
+    def _get_ret_val(rpc_ret: RPCResp) -> Any:
         if rpc_ret.ret_error:
             raise RuntimeError(rpc_ret.ret_error)
         else:
@@ -1,14 +1,30 @@
 import logging
 import asyncio
+import importlib
+import os
+import pickle
 import random
+import signal
+import socket
+import struct
 import sys
 import time
+import traceback
 from asyncio.transports import SubprocessTransport
 from collections import OrderedDict
-from typing import NamedTuple, Callable, Dict, Awaitable, Optional, Union, Tuple, TypeVar, Generic, Set, Iterable
+from typing import NamedTuple, Callable, Dict, Awaitable, Optional, Union, Tuple, TypeVar, Generic, Set, Iterable, \
+    List, Any
 
+import psutil
+
+from gs_framework.metrics import Metrics
 from gs_framework.pool import Pool
+from gs_framework.process_monitor import ProcessMonitor, ProcessLimits, ProcessUsage
+from gs_framework.deadline_scheduler import DeadlineScheduler
 from gs_framework.resource_usage_control import ResourceUsageControl
+from gs_framework.sub_process_output import OutputPipeline
+from gs_framework.task_journal import TaskJournal, TaskJournalRecord
+from gs_framework.task_scheduler import TaskScheduler
 from gs_framework.utilities import generate_uuid, ensure_await
 
 
@@ -16,23 +32,53 @@ logger = logging.getLogger(__name__)
 
 
 class AsyncSubProcessProtocol(asyncio.SubprocessProtocol):
-    def __init__(self):
+    """output of the process is framed by line and rate limited, refer to OutputPipeline"""
+
+    def __init__(self, spool_path: Optional[str] = None):
+        """:param spool_path: gzip file keeping all the output, None means only the latest lines are kept"""
         super().__init__()
         self.exit_future = asyncio.Future()
+        self.output = OutputPipeline(self.emit_line, spool_path=spool_path)
 
     def pipe_data_received(self, fd, data):
-        data_str = data.decode('ascii').rstrip()
+        self.output.feed(fd, data)
+
+    def emit_line(self, fd: int, line: str):
         if fd == 2:
-            print(data_str, file=sys.stderr)
+            print(line, file=sys.stderr)
         else:
-            print(data_str)
+            print(line)
 
     def process_exited(self):
+        self.output.flush()
         self.exit_future.set_result(True)
 
 
+class ZygoteProcessTransport:
+    """the part of SubprocessTransport used by SubProcessExecutor, for processes forked by SubProcessZygote"""
+
+    __slots__ = ("_pid", "_returncode", "_zygote")
+
+    def __init__(self, pid: int, zygote: "SubProcessZygote"):
+        super().__init__()
+        self._pid = pid
+        self._returncode: Optional[int] = None
+        self._zygote = zygote
+
+    def get_pid(self) -> int:
+        return self._pid
+
+    def get_returncode(self) -> Optional[int]:
+        return self._returncode
+
+    def kill(self):
+        # the pid of a process exited may have been reused, and only the zygote knows if it's reaped
+        if self._returncode is None:
+            self._zygote.kill(self._pid)
+
+
 class SubProcessExecInfo(NamedTuple):
-    transport: SubprocessTransport
+    transport: Union[SubprocessTransport, ZygoteProcessTransport]
     protocol: AsyncSubProcessProtocol
 
     def kill(self):
@@ -43,10 +89,303 @@ class SubProcessExecInfo(NamedTuple):
         return self.protocol.exit_future
 
 
-async def run_sub_process(code: str, protocol_factory: Callable[[], AsyncSubProcessProtocol]) -> SubProcessExecInfo:
+def _frame(obj: Any) -> bytes:
+    data = pickle.dumps(obj)
+    return struct.pack(">I", len(data)) + data
+
+
+class _FrameReader:
+
+    __slots__ = ("_buffer", )
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Any]:
+        buffer = self._buffer
+        buffer.extend(data)
+        frames = list()
+        while len(buffer) >= 4:
+            frame_size = struct.unpack(">I", buffer[:4])[0]
+            if len(buffer) < 4 + frame_size:
+                break
+            frames.append(pickle.loads(bytes(buffer[4:4 + frame_size])))
+            del buffer[:4 + frame_size]
+        return frames
+
+
+def _run_forked(code: str, stdout_fd: int, stderr_fd: int):
+    """run code in a process forked by the zygote like `python -c code` does, never returns"""
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+        exec(compile(code, "<string>", "exec"), {"__name__": "__main__"})
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+
+def run_zygote(sock_fd: int, preload_modules: List[str]):
+    """
+    main of the zygote process: import the modules, then fork a child running the code of each request. The output
+    pipes of the child are passed in with the request, and the pid and exit code of the child are reported back.
+    Children are killed by the zygote on request, and when the parent has gone
+    """
+    for module_name in preload_modules:
+        importlib.import_module(module_name)
+
+    sock = socket.socket(fileno=sock_fd)
+    sock.settimeout(0.1)
+    frame_reader = _FrameReader()
+    received_fds: List[int] = list()
+    children: Set[int] = set()
+    """not reaped yet, so their pids are not reused"""
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(sock, 65536, 16)
+            if len(data) == 0:
+                break  # the parent has gone
+
+            received_fds.extend(fds)
+            for request in frame_reader.feed(data):
+                if request[0] == "kill":
+                    if request[1] in children:
+                        os.kill(request[1], signal.SIGKILL)
+                    continue
+
+                _, request_id, code = request
+                stdout_fd, stderr_fd = received_fds[:2]
+                del received_fds[:2]
+                pid = os.fork()
+                if pid == 0:
+                    sock.close()
+                    _run_forked(code, stdout_fd, stderr_fd)
+                children.add(pid)
+                os.close(stdout_fd)
+                os.close(stderr_fd)
+                sock.sendall(_frame(("started", request_id, pid)))
+        except socket.timeout:
+            pass
+
+        while True:
+            try:
+                pid, wait_status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            children.discard(pid)
+            # negative signal number if killed by signal, same as returncode of asyncio sub processes
+            sock.sendall(_frame(("exited", pid, os.waitstatus_to_exitcode(wait_status))))
+
+    # exit codes of the children can't be reported anymore
+    for pid in children:
+        os.kill(pid, signal.SIGKILL)
+
+
+class _ZygoteProcess:
+
+    __slots__ = ("transport", "protocol", "num_open_pipes", "exited")
+
+    def __init__(self, transport: ZygoteProcessTransport, protocol: AsyncSubProcessProtocol):
+        super().__init__()
+        self.transport = transport
+        self.protocol = protocol
+        self.num_open_pipes = 2
+        self.exited = False
+
+    def on_exit_or_pipe_closed(self):
+        # like asyncio sub processes, report exit after all the output is received
+        if self.exited and self.num_open_pipes == 0:
+            self.protocol.process_exited()
+
+
+class _ZygotePipeProtocol(asyncio.Protocol):
+
+    def __init__(self, process: _ZygoteProcess, fd: int):
+        super().__init__()
+        self._process = process
+        self._fd = fd
+
+    def data_received(self, data: bytes):
+        self._process.protocol.pipe_data_received(self._fd, data)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        process = self._process
+        process.num_open_pipes = process.num_open_pipes - 1
+        process.on_exit_or_pipe_closed()
+
+
+class SubProcessZygote:
+    """
+    A warm process with the modules preloaded, forking the sub processes run by run_sub_process. Launching a sub
+    process with it takes a fork instead of an interpreter start plus cold imports of the modules.
+
+    Sub processes keep the semantics of `python -c code`: exit code of sys.exit, 1 on exception, -9 when killed, and
+    stdout / stderr passed to pipe_data_received of the protocol.
+
+    It requires python 3.9+ (socket.send_fds), run_sub_process execs sub processes on older versions
+    """
+
+    SUPPORTED = hasattr(socket, "send_fds") and hasattr(os, "waitstatus_to_exitcode")
+
+    def __init__(self, preload_modules: Iterable[str]):
+        super().__init__()
+        self._preload_modules = list(preload_modules)
+        self._zygote_process: Optional[asyncio.subprocess.Process] = None
+        self._sock: Optional[socket.socket] = None
+        self._frame_reader = _FrameReader()
+        self._started_futures: Dict[str, asyncio.Future] = dict()
+        self._processes: Dict[int, _ZygoteProcess] = dict()
+        self._exit_codes_before_started: Dict[int, int] = dict()
+
+    @property
+    def alive(self) -> bool:
+        return self._sock is not None
+
+    async def start(self):
+        parent_sock, zygote_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        zygote_fd = zygote_sock.fileno()
+        code = f"from gs_framework.sub_process_executor import run_zygote; " \
+               f"run_zygote({zygote_fd}, {self._preload_modules!r})"
+        self._zygote_process = await asyncio.create_subprocess_exec(sys.executable, "-c", code,
+                                                                    pass_fds=(zygote_fd, ))
+        zygote_sock.close()
+
+        parent_sock.setblocking(False)
+        self._sock = parent_sock
+        asyncio.get_event_loop().add_reader(parent_sock.fileno(), self._on_zygote_readable)
+        logger.info(f"zygote {self._zygote_process.pid} started with modules {self._preload_modules}")
+
+    def _on_zygote_readable(self):
+        try:
+            data = self._sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if len(data) == 0:
+            logger.error("zygote exited, sub processes are started by exec from now on")
+            # children of the zygote are orphans now, kill the ones whose exits are not reported
+            for pid in self._processes.keys():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            self.stop()
+            return
+
+        for message in self._frame_reader.feed(data):
+            if message[0] == "started":
+                _, request_id, pid = message
+                started_future = self._started_futures.pop(request_id, None)
+                if started_future is not None and not started_future.done():
+                    started_future.set_result(pid)
+            else:
+                _, pid, exit_code = message
+                process = self._processes.pop(pid, None)
+                if process is None:
+                    # the child exits before its started message is handled
+                    self._exit_codes_before_started[pid] = exit_code
+                else:
+                    process.transport._returncode = exit_code
+                    process.exited = True
+                    process.on_exit_or_pipe_closed()
+
+    async def spawn(self, code: str, protocol_factory: Callable[[], AsyncSubProcessProtocol]) -> SubProcessExecInfo:
+        if not self.alive:
+            await self.start()
+
+        loop = asyncio.get_event_loop()
+        stdout_read_fd, stdout_write_fd = os.pipe()
+        stderr_read_fd, stderr_write_fd = os.pipe()
+        request_id = generate_uuid()
+        started_future = self._started_futures[request_id] = loop.create_future()
+        try:
+            socket.send_fds(self._sock, [_frame(("run", request_id, code))], [stdout_write_fd, stderr_write_fd])
+        finally:
+            os.close(stdout_write_fd)
+            os.close(stderr_write_fd)
+
+        protocol = protocol_factory()
+        pid = await started_future
+        transport = ZygoteProcessTransport(pid, self)
+        process = _ZygoteProcess(transport, protocol)
+        protocol.connection_made(transport)
+        for fd, read_fd in ((1, stdout_read_fd), (2, stderr_read_fd)):
+            await loop.connect_read_pipe(lambda pipe_fd=fd: _ZygotePipeProtocol(process, pipe_fd),
+                                         os.fdopen(read_fd, "rb", 0))
+
+        exit_code = self._exit_codes_before_started.pop(pid, None)
+        if exit_code is None:
+            self._processes[pid] = process
+        else:
+            transport._returncode = exit_code
+            process.exited = True
+            process.on_exit_or_pipe_closed()
+        return SubProcessExecInfo(transport, protocol)
+
+    def kill(self, pid: int):
+        """kill a process forked, the zygote skips it if it has exited"""
+        if self._sock is not None:
+            self._sock.sendall(_frame(("kill", pid)))
+
+    def stop(self):
+        """processes running are killed by the zygote once the socket is closed, then the zygote exits"""
+        sock = self._sock
+        if sock is None:
+            return
+        self._sock = None
+        asyncio.get_event_loop().remove_reader(sock.fileno())
+        sock.close()
+
+        for started_future in self._started_futures.values():
+            if not started_future.done():
+                started_future.set_exception(RuntimeError("zygote exited"))
+        self._started_futures.clear()
+
+        for process in self._processes.values():
+            process.transport._returncode = -signal.SIGKILL
+            process.exited = True
+            process.on_exit_or_pipe_closed()
+        self._processes.clear()
+
+
+async def run_sub_process(code: str, protocol_factory: Callable[[], AsyncSubProcessProtocol],
+                          zygote: Optional[SubProcessZygote] = None) -> SubProcessExecInfo:
+    """run `python -c code`, forked by the zygote if given"""
+    start_time = time.monotonic()
+    if zygote is not None and SubProcessZygote.SUPPORTED:
+        try:
+            sub_process_exec_info = await zygote.spawn(code, protocol_factory)
+            Metrics.observe("sub_process.launch_ms.zygote", (time.monotonic() - start_time) * 1000)
+            return sub_process_exec_info
+        except (OSError, RuntimeError) as e:
+            logger.error(f"failed to fork sub process by zygote, exec it instead: {e}")
+
     sub_process = asyncio.get_event_loop().subprocess_exec(protocol_factory, sys.executable, "-c", code,
                                                            stdin=None, stderr=None)
     sub_process_transport, sub_process_protocol = await sub_process
+    Metrics.observe("sub_process.launch_ms.exec", (time.monotonic() - start_time) * 1000)
     return SubProcessExecInfo(sub_process_transport, sub_process_protocol)
 
 
@@ -59,12 +398,14 @@ random.seed()
 class TaskRetry:
 
     __slots__ = ["_max_retry", "_retry_times", "_next_run_time_in_seconds", "_retry_interval_in_seconds",
-                 "_wait_interval_seconds"]
+                 "_wait_interval_seconds", "_scheduler"]
 
-    def __init__(self, max_retry: int, retry_interval_in_seconds: int):
+    def __init__(self, max_retry: int, retry_interval_in_seconds: int, retry_times: int = 0,
+                 scheduler: Optional[DeadlineScheduler] = None):
         super().__init__()
+        self._scheduler = scheduler if scheduler is not None else DeadlineScheduler.default()
         self._max_retry: int = max_retry
-        self._retry_times: int = 0
+        self._retry_times: int = retry_times
         self._next_run_time_in_seconds: int = None
         self._retry_interval_in_seconds: int = retry_interval_in_seconds
         self._wait_interval_seconds: int = None
@@ -82,12 +423,15 @@ class TaskRetry:
             self._wait_interval_seconds = wait_interval_seconds
             return True, wait_interval_seconds
 
+    @property
+    def retry_times(self) -> int:
+        return self._retry_times
+
     async def wait_for_run(self):
         if self._next_run_time_in_seconds is not None:
             now_in_seconds = int(time.time())
-            wait_seconds = max(0, self._next_run_time_in_seconds - now_in_seconds)
-            if wait_seconds > 0:
-                await asyncio.sleep(wait_seconds)
+            if self._next_run_time_in_seconds > now_in_seconds:
+                await self._scheduler.sleep_until(self._next_run_time_in_seconds)
             self._wait_interval_seconds = None
 
     def __repr__(self) -> str:
@@ -108,42 +452,197 @@ class SubProcessExecutor(Generic[POOL_ITEM_TYPE, TASK_DATA_TYPE]):
 
     EXIT_CODE_4_STOP_RESOURCE_USAGE = 20
 
-    def __init__(self, pool: Pool[POOL_ITEM_TYPE]):
+    MAX_FINISHED_TASKS = 1024
+    """number of finished tasks whose usage and output are kept"""
+
+    def __init__(self, pool: Pool[POOL_ITEM_TYPE], journal_path: Optional[str] = None,
+                 limits: Optional[ProcessLimits] = None, task_memory_bytes: Optional[int] = None,
+                 monitor_interval_seconds: float = 5):
+        """
+        :param journal_path: file journaling the tasks submitted, refer to recover. None means tasks are only kept
+        in memory
+        :param limits: processes over the limits are killed, refer to get_task_usage for the reason
+        :param task_memory_bytes: memory a task is expected to take. Tasks are started only if the memory available
+        covers it besides the memory that tasks just started are still to take. None means tasks are started
+        whenever a pool item is idle
+        """
         super().__init__()
+        self._monitor = ProcessMonitor(monitor_interval_seconds)
+        self._limits = limits
+        self._task_memory_bytes = task_memory_bytes
+        self._admission_retry_seconds = monitor_interval_seconds
+        self._num_starting = 0
+        """tasks dispatched whose processes are not created yet"""
+        self._finished_task_usages: Dict[SubProcessExecutor.TASK_ID, ProcessUsage] = OrderedDict()
+        self._finished_task_outputs: Dict[SubProcessExecutor.TASK_ID, List[str]] = OrderedDict()
         self._pool = pool
-        self._account_usage_control = ResourceUsageControl((3600 * 8, 3600 * 2, 3600))
-        self._waiting_queue: Dict[SubProcessExecutor.TASK_ID, SubProcessExecutor.TASK_WAITING_DATA] = OrderedDict()
+        # cooldowns of pool items are saved next to the journal, so they survive restarts as well
+        self._scheduler = DeadlineScheduler(f"{journal_path}.deadlines" if journal_path is not None else None)
+        self._account_usage_control = ResourceUsageControl((3600 * 8, 3600 * 2, 3600), self._scheduler, "pool_item")
+        self._waiting_queue: TaskScheduler[SubProcessExecutor.TASK_WAITING_DATA] = TaskScheduler("sub_process")
         self._running_processes: Dict[SubProcessExecutor.TASK_ID, SubProcessExecutor.TASK_RUNNING_DATA] = OrderedDict()
+        self._journal: Optional[TaskJournal] = TaskJournal(journal_path) if journal_path is not None else None
+
+    def recover(self) -> List[TaskJournalRecord]:
+        """
+        return the tasks waiting or running when the process stopped, in order of submission. The caller submits them
+        again with the task id and retry times recorded, and calls discard_recovered_task for the ones it doesn't
+        submit; they stay journaled till then. Processes still running for them are killed.
+        Pool items in cooldown before restart are taken out of the pool till their cooldowns end
+        """
+        for obj_exec in self._account_usage_control.restore(self._cb_test_usage):
+            logger.info(f"{obj_exec} is in cooldown before restart, drop it from pool")
+            self._pool.remove_object(obj_exec)
+        return self._journal.recover() if self._journal is not None else list()
+
+    def discard_recovered_task(self, task_id: TASK_ID):
+        """drop a task returned by recover from the journal, instead of submitting it again"""
+        if self._journal is not None:
+            self._journal.record_end(task_id)
+
+    def get_task_usage(self, task_id: TASK_ID) -> Optional[ProcessUsage]:
+        """usage of the process of a task running or finished lately, limit_exceeded tells if it's killed for limits"""
+        usage = self._monitor.usage(task_id)
+        return usage if usage is not None else self._finished_task_usages.get(task_id, None)
+
+    def get_task_output(self, task_id: TASK_ID, max_lines: Optional[int] = None) -> Optional[List[str]]:
+        """latest lines of output of a task running or finished lately, stderr lines are prefixed with [stderr]"""
+        task_running_data = self._running_processes.get(task_id, None)
+        if task_running_data is not None:
+            return task_running_data[0].protocol.output.recent_lines(max_lines)
+        recent_lines = self._finished_task_outputs.get(task_id, None)
+        if recent_lines is None or max_lines is None:
+            return recent_lines
+        return recent_lines[max(0, len(recent_lines) - max_lines):]
+
+    @staticmethod
+    def _keep_finished(finished: Dict[TASK_ID, Any], task_id: TASK_ID, value: Any):
+        finished[task_id] = value
+        while len(finished) > SubProcessExecutor.MAX_FINISHED_TASKS:
+            finished.popitem(last=False)
+
+    def _on_task_process_ended(self, task_id: TASK_ID, sub_process_exec_info: SubProcessExecInfo):
+        usage = self._monitor.unwatch(task_id)
+        if usage is not None:
+            SubProcessExecutor._keep_finished(self._finished_task_usages, task_id, usage)
+            if usage.limit_exceeded is not None:
+                logger.warning(f"task {task_id} is killed for {usage.limit_exceeded}, {usage}")
+        output = getattr(sub_process_exec_info.protocol, "output", None)
+        if output is not None:
+            SubProcessExecutor._keep_finished(self._finished_task_outputs, task_id, output.recent_lines())
+            output.close()
+
+    def _can_admit(self) -> bool:
+        task_memory_bytes = self._task_memory_bytes
+        if task_memory_bytes is None:
+            return True
+        # tasks started lately may not have taken their memory yet
+        reserved_bytes = task_memory_bytes * self._num_starting + \
+            sum(max(0, task_memory_bytes - rss_bytes) for rss_bytes in self._monitor.rss_bytes())
+        admitted = psutil.virtual_memory().available - reserved_bytes >= task_memory_bytes
+        if not admitted:
+            Metrics.increase("sub_process.admission.deferred")
+        return admitted
+
+    def _admit_waiting_tasks(self):
+        while len(self._waiting_queue) > 0 and self._can_admit():
+            try:
+                obj_exec = self._pool.borrow_object()
+            except RuntimeError:
+                return  # tasks are started once pool items are returned
+            self._next_waiting_task(obj_exec)
+        if len(self._waiting_queue) > 0:
+            self._schedule_admission()
+
+    def _schedule_admission(self):
+        """try again later to start the tasks waiting for memory"""
+        if "admission" not in self._scheduler:
+            self._scheduler.schedule("admission", time.time() + self._admission_retry_seconds,
+                                     self._admit_waiting_tasks)
+
+    def _dispatch(self, func_async_task: FUNC_ASYNC_TASK_4_PROCESS, obj_exec: POOL_ITEM_TYPE):
+        self._num_starting = self._num_starting + 1
+        asyncio.ensure_future(func_async_task(obj_exec))
+
+    def _next_waiting_task(self, obj_exec: POOL_ITEM_TYPE):
+        next_task_id_and_data = self._waiting_queue.pop() if self._can_admit() else None
+        if next_task_id_and_data is not None:
+            _, (next_task, *_) = next_task_id_and_data
+            self._dispatch(next_task, obj_exec)
+        else:
+            pool = self._pool
+            pool.return_object(obj_exec)
+            if len(self._waiting_queue) > 0:
+                self._schedule_admission()
+            if logger.isEnabledFor(logging.DEBUG):
+                # listing active items iterates the whole pool, only done when debugging
+                logger.debug(f"{pool.get_num_active()} active items in pool: {pool.get_active_items()}, "
+                             f"{self._account_usage_control.get_usage_control_repr()}")
+
+    def _cb_test_usage(self, obj_exec: POOL_ITEM_TYPE) -> Callable[[], None]:
+        def test_account_usage():
+            logger.info(f"add {obj_exec} back to pool")
+            add_result = self._pool.add_object(obj_exec)
+            assert add_result
+            self._next_waiting_task(self._pool.borrow_object())
+
+        return test_account_usage
+
+    @property
+    def waiting_queue(self) -> TaskScheduler[TASK_WAITING_DATA]:
+        return self._waiting_queue
 
     # return task id
     def submit(self, func_create_sub_process: FUNC_CREATE_SUB_PROCESS, task_data: TASK_DATA_TYPE, time_out_seconds: int,
                cb_on_process_created: Optional[FUNC_TASK_PROCESS_CALLBACK] = None,
                cb_on_process_ended: Optional[FUNC_TASK_PROCESS_CALLBACK] = None,
-               cb_on_process_timeout: Optional[FUNC_TASK_PROCESS_CALLBACK] = None) -> TASK_ID:
+               cb_on_process_timeout: Optional[FUNC_TASK_PROCESS_CALLBACK] = None,
+               task_group: Optional[str] = None, priority: int = 0, deadline: Optional[float] = None,
+               task_id: Optional[TASK_ID] = None, retry_times: int = 0) -> TASK_ID:
+        """
+        tasks waiting for pool items are scheduled by priority (smaller first), fair share among task groups and
+        deadline (time.time() before which the task should start), refer to TaskScheduler.
+        task_id and retry_times are given when submitting tasks recovered, refer to recover
+        """
 
         waiting_queue = self._waiting_queue
         running_processes = self._running_processes
         pool = self._pool
         account_usage_control = self._account_usage_control
 
-        task_uuid: SubProcessExecutor.TASK_ID = generate_uuid()
-        task_retry = TaskRetry(max_retry=10, retry_interval_in_seconds=60 * 2)
+        journal = self._journal
 
-        def next_waiting_task(obj_exec: POOL_ITEM_TYPE):
-            try:
-                _, (next_task, *_) = waiting_queue.popitem(last=False)
-                asyncio.ensure_future(next_task(obj_exec))
-            except KeyError:
-                pool.return_object(obj_exec)
-                logger.info(f"{pool.get_num_active()} active items in pool: {pool.get_active_items()}, "
-                            f"{account_usage_control.get_usage_control_repr()}")
+        task_uuid: SubProcessExecutor.TASK_ID = task_id if task_id is not None else generate_uuid()
+        task_retry = TaskRetry(max_retry=10, retry_interval_in_seconds=60 * 2, retry_times=retry_times,
+                               scheduler=self._scheduler)
+        # tasks queued again keep their place in the group instead of going to the tail
+        task_seq = waiting_queue.next_seq()
+
+        if journal is not None:
+            journal.record_submit(TaskJournalRecord(task_id=task_uuid, task_data=task_data,
+                                                    time_out_seconds=time_out_seconds, task_group=task_group,
+                                                    priority=priority, deadline=deadline, retry_times=retry_times))
+
+        def enqueue(func_async_task: SubProcessExecutor.FUNC_ASYNC_TASK_4_PROCESS, requeue: bool = True):
+            waiting_queue.push(task_uuid, (func_async_task, task_data, task_retry), group=task_group,
+                               priority=priority, deadline=deadline, seq=task_seq)
+            if requeue and journal is not None:
+                journal.record_requeue(task_uuid, task_retry.retry_times)
 
         async def async_task(obj_exec: POOL_ITEM_TYPE):
             stop_resource_usage = False
 
             try:
-                sub_process_exec_info: SubProcessExecInfo = await func_create_sub_process(obj_exec)
+                try:
+                    sub_process_exec_info: SubProcessExecInfo = await func_create_sub_process(obj_exec)
+                finally:
+                    self._num_starting = self._num_starting - 1
                 running_processes[task_uuid] = (sub_process_exec_info, obj_exec, task_data, task_retry)
+                pid = sub_process_exec_info.transport.get_pid()
+                if pid is not None:
+                    self._monitor.watch(task_uuid, pid, self._limits, lambda reason: sub_process_exec_info.kill())
+                if journal is not None:
+                    journal.record_start(task_uuid, pid)
 
                 logger.info(f"{len(running_processes)} tasks are running, {len(waiting_queue)} tasks in queue,"
                             f" {self._account_usage_control.get_usage_control_repr()}")
@@ -159,35 +658,32 @@ class SubProcessExecutor(Generic[POOL_ITEM_TYPE, TASK_DATA_TYPE]):
                     # 1 means terminated because of exception,  0 means end normally, 9 means be killed
                     if 1 == exit_code:
                         # the process terminates with an exception
+                        pool.report_failure(obj_exec)
                         ok_2_retry, wait_interval_seconds = task_retry.mark_retry()
                         if ok_2_retry:
                             async def async_retry_task(next_obj_exec: POOL_ITEM_TYPE):
+                                # not counted as starting while waiting for the retry
+                                self._num_starting = self._num_starting - 1
                                 await task_retry.wait_for_run()
+                                self._num_starting = self._num_starting + 1
                                 await async_task(next_obj_exec)
 
-                            assert task_uuid not in waiting_queue
-                            waiting_queue[task_uuid] = (async_retry_task, task_data, task_retry)
+                            enqueue(async_retry_task)
                     elif SubProcessExecutor.EXIT_CODE_4_STOP_RESOURCE_USAGE == exit_code:
                         stop_resource_usage = True
 
-                        print(f"{obj_exec} will be dropped from pool")
+                        logger.info(f"{obj_exec} will be dropped from pool")
                         remove_result = pool.remove_object(obj_exec)
                         assert remove_result
+                        asyncio.ensure_future(account_usage_control.stop_usage(obj_exec,
+                                                                               self._cb_test_usage(obj_exec)))
 
-                        def test_account_usage():
-                            print(f"add {obj_exec} back to pool")
-                            add_result = pool.add_object(obj_exec)
-                            assert add_result
-                            next_waiting_task(pool.borrow_object())
-
-                        asyncio.ensure_future(account_usage_control.stop_usage(obj_exec, test_account_usage))
-
-                        assert task_uuid not in waiting_queue
-                        waiting_queue[task_uuid] = (async_task, task_data, task_retry)
+                        enqueue(async_task)
                     elif 0 == exit_code:
                         account_usage_control.resume_resource(obj_exec)
                     elif -9 == exit_code:
-                        # the process is killed. leave the resource in pool but do not cancel resource usage control
+                        # the process is killed, maybe for its limits. leave the resource in pool but do not cancel
+                        # resource usage control
                         pass
                     else:
                         # stop the process immediately
@@ -205,7 +701,11 @@ class SubProcessExecutor(Generic[POOL_ITEM_TYPE, TASK_DATA_TYPE]):
                         await ensure_await(cb_on_process_timeout(task_uuid, sub_process_exec_info, obj_exec, task_data,
                                                                  task_retry))
             finally:
-                running_processes.pop(task_uuid, None)
+                task_running_data = running_processes.pop(task_uuid, None)
+                if task_running_data is not None:
+                    self._on_task_process_ended(task_uuid, task_running_data[0])
+                if journal is not None and task_uuid not in waiting_queue:
+                    journal.record_end(task_uuid)
                 if stop_resource_usage:
                     try:
                         next_obj_available: POOL_ITEM_TYPE = self._pool.borrow_object()
@@ -213,22 +713,28 @@ class SubProcessExecutor(Generic[POOL_ITEM_TYPE, TASK_DATA_TYPE]):
                         next_obj_available = None
 
                     if next_obj_available is not None:
-                        next_waiting_task(next_obj_available)
+                        self._next_waiting_task(next_obj_available)
                 else:
-                    next_waiting_task(obj_exec)
+                    self._next_waiting_task(obj_exec)
 
-        try:
-            obj_available: POOL_ITEM_TYPE = self._pool.borrow_object()
-            asyncio.ensure_future(async_task(obj_available))
-        except RuntimeError:
-            waiting_queue[task_uuid] = (async_task, task_data, task_retry)
+        if self._can_admit():
+            try:
+                obj_available: POOL_ITEM_TYPE = self._pool.borrow_object()
+                self._dispatch(async_task, obj_available)
+            except RuntimeError:
+                enqueue(async_task, requeue=False)
+        else:
+            enqueue(async_task, requeue=False)
+            self._schedule_admission()
 
         return task_uuid
 
     async def cancel_task(self, task_id: TASK_ID, cb_on_process_cancelled: Optional[FUNC_TASK_PROCESS_CALLBACK] = None)\
             -> bool:
-        task_waiting_data: SubProcessExecutor.TASK_WAITING_DATA = self._waiting_queue.pop(task_id, None)
+        task_waiting_data: SubProcessExecutor.TASK_WAITING_DATA = self._waiting_queue.remove(task_id)
         if task_waiting_data is not None:
+            if self._journal is not None:
+                self._journal.record_end(task_id)
             if cb_on_process_cancelled:
                 _, task_data, task_retry = task_waiting_data
                 await ensure_await(cb_on_process_cancelled(task_id, None, None, task_data, task_retry))
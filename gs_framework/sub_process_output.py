@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+"""
+Output of sub processes, framed by line and rate limited before being emitted
+"""
+import codecs
+import gzip
+import os
+from collections import deque
+from typing import Callable, Optional, Dict, List, Any
+
+from .metrics import Metrics
+from .rate_limit import TokenBucket
+
+
+class LineFramer:
+    """decode chunks of bytes incrementally as utf-8 and split them into lines, partial lines are kept till completed"""
+
+    __slots__ = ("_decoder", "_partial", "_max_line_length")
+
+    def __init__(self, max_line_length: int = 64 * 1024):
+        super().__init__()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self._max_line_length = max_line_length
+
+    def feed(self, data: bytes) -> List[str]:
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        if len(self._partial) > self._max_line_length:
+            # a process writing without line breaks doesn't grow the buffer without limit
+            lines.append(self._partial)
+            self._partial = ""
+        return [line.rstrip("\r") for line in lines]
+
+    def flush(self) -> List[str]:
+        text = self._partial + self._decoder.decode(b"", final=True)
+        self._partial = ""
+        return [text] if len(text) > 0 else []
+
+
+class OutputPipeline:
+    """
+    Lines of stdout (fd 1) and stderr (fd 2) of a sub process go through:
+    1. a ring buffer of the latest lines, refer to recent_lines
+    2. an optional gzip spool file with all the lines
+    3. emit, limited to lines_per_second with burst. Lines over the limit are sampled, one of each sample_every
+       lines is emitted, and the number of lines suppressed is emitted once the output calms down
+    """
+
+    def __init__(self, emit: Callable[[int, str], Any], ring_size: int = 200, lines_per_second: float = 20,
+                 burst: int = 200, sample_every: int = 100, spool_path: Optional[str] = None):
+        super().__init__()
+        self._emit = emit
+        self._framers: Dict[int, LineFramer] = dict()
+        self._recent_lines = deque(maxlen=ring_size)
+        self._token_bucket = TokenBucket(lines_per_second, burst)
+        self._sample_every = sample_every
+        self._num_suppressed = 0
+        self._spool_file = None
+        if spool_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(spool_path)), exist_ok=True)
+            self._spool_file = gzip.open(spool_path, "at", encoding="utf-8")
+
+    def feed(self, fd: int, data: bytes):
+        framer = self._framers.get(fd, None)
+        if framer is None:
+            framer = self._framers[fd] = LineFramer()
+        for line in framer.feed(data):
+            self._on_line(fd, line)
+
+    def flush(self):
+        """emit partial lines left, called when the process exits"""
+        for fd, framer in self._framers.items():
+            for line in framer.flush():
+                self._on_line(fd, line)
+        self._report_suppressed()
+        if self._spool_file is not None:
+            self._spool_file.flush()
+
+    def close(self):
+        self.flush()
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+
+    def _on_line(self, fd: int, line: str):
+        self._recent_lines.append(line if fd != 2 else f"[stderr] {line}")
+        if self._spool_file is not None:
+            self._spool_file.write(f"{fd} {line}\n")
+
+        if self._token_bucket.try_acquire():
+            self._report_suppressed()
+            self._emit(fd, line)
+        else:
+            self._num_suppressed = self._num_suppressed + 1
+            Metrics.increase("sub_process.output.lines_suppressed")
+            if self._num_suppressed % self._sample_every == 0:
+                self._emit(fd, f"[sampled, {self._num_suppressed} lines suppressed] {line}")
+
+    def _report_suppressed(self):
+        if self._num_suppressed > 0:
+            self._emit(2, f"{self._num_suppressed} lines suppressed by rate limit")
+            self._num_suppressed = 0
+
+    def recent_lines(self, max_lines: Optional[int] = None) -> List[str]:
+        recent_lines = list(self._recent_lines)
+        return recent_lines if max_lines is None else recent_lines[max(0, len(recent_lines) - max_lines):]
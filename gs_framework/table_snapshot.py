@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+"""
+Snapshots of faust tables for fast start
+
+Faust saves the changelog offset of each table partition inside the rocksdb db of that partition. A backup of the db
+is therefore a consistent checkpoint of both the table content and the offset it covers: a fresh node restores the
+backup into its data dir before the app starts, and faust only replays the changelog after the restored offset.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple, List
+
+from faust.types import AppT
+
+logger = logging.getLogger(__name__)
+
+
+class StartupPhases:
+    """Measure and report how long each phase of service start takes"""
+
+    __slots__ = ("_name", "_phase_start_time", "_seconds_by_phase")
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+        self._phase_start_time = time.monotonic()
+        self._seconds_by_phase: Dict[str, float] = OrderedDict()
+
+    def end_phase(self, phase: str):
+        now = time.monotonic()
+        self._seconds_by_phase[phase] = now - self._phase_start_time
+        self._phase_start_time = now
+
+    @property
+    def seconds_by_phase(self) -> Dict[str, float]:
+        return self._seconds_by_phase
+
+    def report(self):
+        total_seconds = sum(self._seconds_by_phase.values())
+        phases_str = ', '.join(map(lambda phase_and_seconds: f"{phase_and_seconds[0]}: {phase_and_seconds[1]:.3f}",
+                                   self._seconds_by_phase.items()))
+        logger.info(f"{self._name} started in {total_seconds:.3f} seconds. {phases_str}")
+
+
+class TableSnapshot:
+    """
+    Periodically back up the rocksdb dbs of all the tables of an app into snapshot_dir, and restore them on a node
+    whose data dir doesn't have the dbs yet.
+
+    Layout of snapshot_dir: {snapshot_dir}/{app_id}/{table_name}/{partition}/ is a rocksdb backup engine dir
+    """
+
+    __slots__ = ("_snapshot_dir", "_interval_seconds", "_num_backups_to_keep")
+
+    def __init__(self, snapshot_dir: str, interval_seconds: float = 600, num_backups_to_keep: int = 2):
+        super().__init__()
+        assert num_backups_to_keep > 0
+        self._snapshot_dir = snapshot_dir
+        self._interval_seconds = interval_seconds
+        self._num_backups_to_keep = num_backups_to_keep
+
+    def _backup_dir(self, app: AppT, table_name: str, partition: int) -> str:
+        return os.path.join(self._snapshot_dir, app.conf.id, table_name, str(partition))
+
+    @staticmethod
+    def _iter_rocksdb_stores(app: AppT) -> Iterable[Tuple[str, object]]:
+        for table_name, table in app.tables.items():
+            store = table.data
+            # only the rocksdb store has partition dbs to back up
+            if hasattr(store, "partition_path") and hasattr(store, "db_for_partition"):
+                yield table_name, store
+
+    @staticmethod
+    def _dbs_2_backup(app: AppT) -> List[Tuple[str, int, object]]:
+        """
+        (table_name, partition, db) of the partitions actively assigned to this node. Must be called in the event loop,
+        where faust opens the partition dbs
+        """
+        partitions = sorted(set(map(lambda tp: tp.partition, app.assignor.assigned_actives())))
+        dbs = list()
+        for table_name, store in TableSnapshot._iter_rocksdb_stores(app):
+            for partition in partitions:
+                # don't create dbs for the partitions the table doesn't have
+                if os.path.exists(str(store.partition_path(partition))):
+                    dbs.append((table_name, partition, store.db_for_partition(partition)))
+        return dbs
+
+    def restore(self, app: AppT) -> int:
+        """
+        Must be called after the tables are defined and before the app starts.
+        Return the number of partition dbs restored
+        """
+        import rocksdb
+
+        num_restored = 0
+        for table_name, store in TableSnapshot._iter_rocksdb_stores(app):
+            table_snapshot_dir = os.path.join(self._snapshot_dir, app.conf.id, table_name)
+            if not os.path.isdir(table_snapshot_dir):
+                continue
+
+            for partition_dir_name in os.listdir(table_snapshot_dir):
+                partition = int(partition_dir_name)
+                db_path = str(store.partition_path(partition))
+                if os.path.exists(db_path):
+                    continue  # the local db is at least as new as the snapshot
+
+                backup_engine = rocksdb.BackupEngine(self._backup_dir(app, table_name, partition))
+                backup_engine.restore_latest_backup(db_path, db_path)
+                num_restored = num_restored + 1
+                logger.info(f"partition {partition} of table {table_name} restored from snapshot")
+
+        return num_restored
+
+    def _backup(self, app: AppT, dbs: List[Tuple[str, int, object]]) -> int:
+        """
+        rocksdb supports backing up a db being written by other threads: the memtables are flushed and the backup is
+        made of the sst files at that point, which also contain the changelog offset faust wrote with the content
+        """
+        import rocksdb
+
+        for table_name, partition, db in dbs:
+            backup_dir = self._backup_dir(app, table_name, partition)
+            os.makedirs(backup_dir, exist_ok=True)
+            backup_engine = rocksdb.BackupEngine(backup_dir)
+            backup_engine.create_backup(db, flush_before_backup=True)
+            backup_engine.purge_old_backups(self._num_backups_to_keep)
+
+        return len(dbs)
+
+    async def take_snapshot(self, app: AppT):
+        start_time = time.monotonic()
+        dbs = TableSnapshot._dbs_2_backup(app)
+        # backup engine blocks until all the files are copied, run it out of the event loop
+        num_backed_up = await asyncio.get_event_loop().run_in_executor(None, self._backup, app, dbs)
+        logger.info(f"snapshot of {num_backed_up} table partitions of app {app.conf.id} taken in "
+                    f"{time.monotonic() - start_time:.3f} seconds")
+
+    def initialize(self, app: AppT):
+        """schedule the periodical snapshot. Must be called before the app starts"""
+        snapshot = self
+
+        async def snapshot_timer(*args_not_used):
+            try:
+                await snapshot.take_snapshot(app)
+            except Exception as e:
+                logger.error(f"failed to take snapshot of app {app.conf.id}: {e}")
+
+        app.timer(interval=self._interval_seconds)(snapshot_timer)
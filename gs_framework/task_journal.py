@@ -0,0 +1,153 @@
+# -*- coding: UTF-8 -*-
+"""
+Append only journal of the tasks of SubProcessExecutor, so that the tasks submitted survive restarts of the process
+"""
+import logging
+import os
+import pickle
+import struct
+from collections import OrderedDict
+from typing import NamedTuple, Any, Optional, Dict, List, Hashable
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class TaskJournalRecord(NamedTuple):
+
+    task_id: Hashable
+    task_data: Any
+    time_out_seconds: int
+    task_group: Optional[str] = None
+    priority: int = 0
+    deadline: Optional[float] = None
+    retry_times: int = 0
+    pid: Optional[int] = None
+    """pid of the sub process running the task, None if the task is waiting"""
+    pid_create_time: Optional[float] = None
+    """to tell the process from a later one reusing the pid"""
+
+
+class TaskJournal:
+    """
+    Each change of a task is appended as a length prefixed pickle of (operation, task_id, args). The journal is
+    rewritten with only the tasks not ended once ended tasks take most of it, and on recover.
+    """
+
+    OP_SUBMIT = 1
+    OP_START = 2
+    OP_REQUEUE = 3
+    OP_END = 4
+
+    COMPACT_MIN_RECORDS = 1000
+
+    def __init__(self, path: str, fsync: bool = False):
+        """:param fsync: sync the file on each change, which survives crashes of the host too"""
+        super().__init__()
+        self._path = path
+        self._fsync = fsync
+        self._tasks: Dict[Hashable, TaskJournalRecord] = OrderedDict()
+        self._num_records = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._load()
+        self._file = open(path, "ab")
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+
+        with open(self._path, "rb") as journal_file:
+            data = journal_file.read()
+
+        offset = 0
+        while offset + 4 <= len(data):
+            record_size = struct.unpack(">I", data[offset:offset + 4])[0]
+            if offset + 4 + record_size > len(data):
+                logger.warning(f"journal {self._path} ends with a partial record, which is dropped")
+                break
+            op, task_id, args = pickle.loads(data[offset + 4:offset + 4 + record_size])
+            self._apply(op, task_id, args)
+            offset = offset + 4 + record_size
+            self._num_records = self._num_records + 1
+
+    def _apply(self, op: int, task_id: Hashable, args: Any):
+        tasks = self._tasks
+        if op == TaskJournal.OP_SUBMIT:
+            tasks[task_id] = args
+        elif op == TaskJournal.OP_END:
+            tasks.pop(task_id, None)
+        else:
+            record = tasks.get(task_id, None)
+            if record is not None:
+                if op == TaskJournal.OP_START:
+                    pid, pid_create_time = args
+                    tasks[task_id] = record._replace(pid=pid, pid_create_time=pid_create_time)
+                else:
+                    assert op == TaskJournal.OP_REQUEUE
+                    tasks[task_id] = record._replace(retry_times=args, pid=None, pid_create_time=None)
+
+    def _append(self, op: int, task_id: Hashable, args: Any):
+        self._apply(op, task_id, args)
+        data = pickle.dumps((op, task_id, args))
+        self._file.write(struct.pack(">I", len(data)) + data)
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+        self._num_records = self._num_records + 1
+        if self._num_records > max(TaskJournal.COMPACT_MIN_RECORDS, len(self._tasks) * 4):
+            self._compact()
+
+    def _compact(self):
+        temp_path = f"{self._path}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            for task_id, record in self._tasks.items():
+                data = pickle.dumps((TaskJournal.OP_SUBMIT, task_id, record))
+                temp_file.write(struct.pack(">I", len(data)) + data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        self._file.close()
+        os.replace(temp_path, self._path)
+        self._file = open(self._path, "ab")
+        self._num_records = len(self._tasks)
+
+    def record_submit(self, record: TaskJournalRecord):
+        self._append(TaskJournal.OP_SUBMIT, record.task_id, record)
+
+    def record_start(self, task_id: Hashable, pid: Optional[int]):
+        try:
+            pid_create_time = psutil.Process(pid).create_time() if pid is not None else None
+        except psutil.NoSuchProcess:
+            pid_create_time = None
+        self._append(TaskJournal.OP_START, task_id, (pid, pid_create_time))
+
+    def record_requeue(self, task_id: Hashable, retry_times: int):
+        self._append(TaskJournal.OP_REQUEUE, task_id, retry_times)
+
+    def record_end(self, task_id: Hashable):
+        self._append(TaskJournal.OP_END, task_id, None)
+
+    def recover(self) -> List[TaskJournalRecord]:
+        """
+        return the tasks not ended in order of submission. Processes of the tasks running before restart are killed,
+        since their output and exit code can't be received anymore.
+        The records are kept till the tasks are submitted again, which replaces them, so the tasks are not lost if the
+        process stops again before that. Tasks not to be submitted again are dropped by record_end
+        """
+        records = list(self._tasks.values())
+        for record in records:
+            if record.pid is None:
+                continue
+            try:
+                process = psutil.Process(record.pid)
+                if record.pid_create_time is not None and process.create_time() == record.pid_create_time:
+                    logger.info(f"kill process {record.pid} of task {record.task_id} started before restart")
+                    process.kill()
+            except psutil.NoSuchProcess:
+                pass
+
+        return records
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""
+Queue of waiting tasks with priorities, weighted fair share among task groups and deadlines
+"""
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, Generic, TypeVar, Optional, Tuple, List, Any, Hashable
+
+from .metrics import Metrics, Samples
+
+TASK_ID = Hashable
+TASK_ITEM = TypeVar('TASK_ITEM')
+
+
+class _TaskEntry:
+
+    __slots__ = ("task_id", "item", "group", "priority", "deadline", "seq", "enqueue_time", "removed")
+
+    def __init__(self, task_id: TASK_ID, item: Any, group: Optional[str], priority: int, deadline: Optional[float],
+                 seq: int):
+        super().__init__()
+        self.task_id = task_id
+        self.item = item
+        self.group = group
+        self.priority = priority
+        self.deadline = deadline
+        self.seq = seq
+        self.enqueue_time = time.monotonic()
+        self.removed = False
+
+    def sort_key(self) -> Tuple[float, int]:
+        # earliest deadline first, tasks without deadline in order of submission after them
+        return (self.deadline if self.deadline is not None else math.inf), self.seq
+
+
+class _GroupQueue:
+    """tasks of one group at one priority level"""
+
+    __slots__ = ("group", "heap", "size", "pass_value", "in_level_heap")
+
+    def __init__(self, group: Optional[str]):
+        super().__init__()
+        self.group = group
+        self.heap: List[Tuple[Tuple[float, int], _TaskEntry]] = list()
+        self.size = 0
+        self.pass_value = 0.0
+        """virtual time of the group, increased by 1 / weight on each task dequeued"""
+        self.in_level_heap = False
+
+
+class _PriorityLevel:
+
+    __slots__ = ("group_queues", "group_heap", "virtual_time", "size")
+
+    def __init__(self):
+        super().__init__()
+        self.group_queues: Dict[Optional[str], _GroupQueue] = dict()
+        self.group_heap: List[Tuple[float, int, _GroupQueue]] = list()
+        self.virtual_time = 0.0
+        self.size = 0
+
+
+class TaskScheduler(Generic[TASK_ITEM]):
+    """
+    Tasks of smaller priority value are always dequeued first. Among the task groups of same priority, tasks are
+    dequeued in proportion to the weights of the groups (stride scheduling), so a group submitting many tasks doesn't
+    starve the others. Within a group, tasks with earlier deadline go first, then tasks in order of submission.
+
+    push, pop and remove take O(log n). Removed tasks are dropped lazily when they reach the top of the heaps.
+
+    Queue depth of each group is published as gauge "scheduler.queue_depth.{name}.{group}" and time waited in queue
+    as samples "scheduler.wait_ms.{name}.{group}" in Metrics
+    """
+
+    DEFAULT_GROUP_WEIGHT = 1.0
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+        self._entries: Dict[TASK_ID, _TaskEntry] = dict()
+        self._levels: Dict[int, _PriorityLevel] = dict()
+        self._priority_heap: List[int] = list()
+        """priorities having tasks, may contain priorities emptied since"""
+        self._group_weights: Dict[Optional[str], float] = dict()
+        self._depth_by_group: Dict[Optional[str], int] = dict()
+        self._seq = itertools.count()
+        self._group_seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, task_id: TASK_ID) -> bool:
+        return task_id in self._entries
+
+    def next_seq(self) -> int:
+        """sequence number of a new submission, pass it to push again to keep the place of a task in its group"""
+        return next(self._seq)
+
+    def set_group_weight(self, group: Optional[str], weight: float):
+        assert weight > 0
+        self._group_weights[group] = weight
+
+    def _update_depth(self, group: Optional[str], delta: int):
+        depth = self._depth_by_group.get(group, 0) + delta
+        if depth > 0:
+            self._depth_by_group[group] = depth
+        else:
+            self._depth_by_group.pop(group, None)
+        Metrics.set_gauge(f"scheduler.queue_depth.{self._name}.{group}", depth)
+
+    def push(self, task_id: TASK_ID, item: TASK_ITEM, *, group: Optional[str] = None, priority: int = 0,
+             deadline: Optional[float] = None, seq: Optional[int] = None):
+        """
+        :param deadline: time.time() before which the task should start
+        :param seq: refer to next_seq, a new sequence number if None
+        """
+        assert task_id not in self._entries, f"task {task_id} is in queue already"
+        entry = _TaskEntry(task_id, item, group, priority, deadline, self.next_seq() if seq is None else seq)
+        self._entries[task_id] = entry
+        self._update_depth(group, 1)
+
+        level = self._levels.get(priority, None)
+        if level is None:
+            level = self._levels[priority] = _PriorityLevel()
+            heapq.heappush(self._priority_heap, priority)
+        level.size = level.size + 1
+
+        group_queue = level.group_queues.get(group, None)
+        if group_queue is None:
+            group_queue = level.group_queues[group] = _GroupQueue(group)
+        heapq.heappush(group_queue.heap, (entry.sort_key(), entry))
+        group_queue.size = group_queue.size + 1
+
+        if not group_queue.in_level_heap:
+            # a group becoming busy doesn't get credit for the time it was idle
+            group_queue.pass_value = max(group_queue.pass_value, level.virtual_time)
+            heapq.heappush(level.group_heap, (group_queue.pass_value, next(self._group_seq), group_queue))
+            group_queue.in_level_heap = True
+
+    def remove(self, task_id: TASK_ID) -> Optional[TASK_ITEM]:
+        entry = self._entries.pop(task_id, None)
+        if entry is None:
+            return None
+
+        entry.removed = True
+        self._update_depth(entry.group, -1)
+        level = self._levels[entry.priority]
+        level.size = level.size - 1
+        level.group_queues[entry.group].size = level.group_queues[entry.group].size - 1
+        return entry.item
+
+    def pop(self) -> Optional[Tuple[TASK_ID, TASK_ITEM]]:
+        """return the id and item of the next task, None if no task is waiting"""
+        priority_heap = self._priority_heap
+        while len(priority_heap) > 0:
+            priority = priority_heap[0]
+            level = self._levels[priority]
+            if level.size == 0:
+                heapq.heappop(priority_heap)
+                del self._levels[priority]
+                continue
+
+            entry = self._pop_from_level(level)
+            self._entries.pop(entry.task_id)
+            self._update_depth(entry.group, -1)
+            Metrics.observe(f"scheduler.wait_ms.{self._name}.{entry.group}",
+                            (time.monotonic() - entry.enqueue_time) * 1000)
+            return entry.task_id, entry.item
+
+        return None
+
+    def _pop_from_level(self, level: _PriorityLevel) -> _TaskEntry:
+        while True:
+            pass_value, _, group_queue = heapq.heappop(level.group_heap)
+            group_queue.in_level_heap = False
+            if group_queue.size == 0:
+                level.group_queues.pop(group_queue.group, None)
+                continue
+
+            task_heap = group_queue.heap
+            _, entry = heapq.heappop(task_heap)
+            while entry.removed:
+                _, entry = heapq.heappop(task_heap)
+
+            group_queue.size = group_queue.size - 1
+            level.size = level.size - 1
+            level.virtual_time = pass_value
+            group_queue.pass_value = pass_value + 1.0 / self._group_weights.get(group_queue.group,
+                                                                                TaskScheduler.DEFAULT_GROUP_WEIGHT)
+            if group_queue.size > 0:
+                heapq.heappush(level.group_heap, (group_queue.pass_value, next(self._group_seq), group_queue))
+                group_queue.in_level_heap = True
+            else:
+                level.group_queues.pop(group_queue.group, None)
+            return entry
+
+    def queue_depths(self) -> Dict[Optional[str], int]:
+        return dict(self._depth_by_group)
+
+    def wait_time_samples(self, group: Optional[str]) -> Optional[Samples]:
+        return Metrics.get_samples(f"scheduler.wait_ms.{self._name}.{group}")
+
+    def items(self) -> List[Tuple[TASK_ID, TASK_ITEM]]:
+        """the tasks waiting, not in the order they are dequeued"""
+        return [(task_id, entry.item) for task_id, entry in self._entries.items()]
@@ -1,11 +1,13 @@
 import asyncio
 import inspect
 from typing import Callable, Any, Mapping, Union, Awaitable, Dict
+from weakref import WeakKeyDictionary
 
 from faust import TopicT, StreamT, ChannelT
 from faust.types import AppT, TP
 
 from gs_framework.faust_utilities import FaustUtilities
+from gs_framework.shared_memory_values import SharedMemoryValues
 
 
 class InMemoryChannelWrapper:
@@ -66,21 +68,46 @@ class TopicWrapper:
         if func_process_message is not None:
             self.set_message_handler(func_process_message, agent_name)
 
+    _handlers_by_app: 'WeakKeyDictionary[AppT, Dict[str, Dict[str, FUNC_PROCESS_MESSAGE]]]' = WeakKeyDictionary()
+    """
+    app -> topic name -> handler name -> handler.
+    Only one agent is created for each topic in an app, no matter how many handlers, possibly of different services
+    hosted by the app, read the topic. The agent decodes each message once and passes it to all the handlers
+    """
+
     def set_message_handler(self, func_process_message: FUNC_PROCESS_MESSAGE, agent_name: str = None):
         assert func_process_message is not None
 
-        async def agent_function(stream: StreamT):
-            async for event in stream.events():
-                message_key, message_value, headers = FaustUtilities.decode_message(event)
-                message_key_bytes = event.message.key
-                res = func_process_message(message_key, message_value, headers, message_key_bytes)
-                if inspect.isawaitable(res):
-                    asyncio.ensure_future(res)
-
         app = self.topic.app
         topic_name = self.topic.get_topic_name()
 
         agent_name = agent_name or f"agent_of_{topic_name}"
-        assert agent_name not in app.agents, f"{agent_name} has been created for app {app}"
 
-        app.agent(self.topic, name=agent_name)(agent_function)
+        handlers_by_topic = TopicWrapper._handlers_by_app.get(app, None)
+        if handlers_by_topic is None:
+            handlers_by_topic = TopicWrapper._handlers_by_app[app] = dict()
+
+        handlers = handlers_by_topic.get(topic_name, None)
+        if handlers is None:
+            handlers = handlers_by_topic[topic_name] = dict()
+
+            async def agent_function(stream: StreamT):
+                async for event in stream.events():
+                    message_key, message_value, headers = FaustUtilities.decode_message(event)
+                    if SharedMemoryValues.has_handles(message_value):
+                        message_value = await SharedMemoryValues.resolve_state_vars(message_value)
+                    message_key_bytes = event.message.key
+                    # handlers may change the dict decoded, e.g. add names of state variables, so each gets its own
+                    copy_value = len(handlers) > 1 and isinstance(message_value, dict)
+                    for handler in handlers.values():
+                        res = handler(message_key, dict(message_value) if copy_value else message_value, headers,
+                                      message_key_bytes)
+                        if inspect.isawaitable(res):
+                            asyncio.ensure_future(res)
+
+            topic_agent_name = f"agent_of_{topic_name}"
+            assert topic_agent_name not in app.agents, f"{topic_agent_name} has been created for app {app}"
+            app.agent(self.topic, name=topic_agent_name)(agent_function)
+
+        assert agent_name not in handlers, f"{agent_name} has been created for app {app}"
+        handlers[agent_name] = func_process_message
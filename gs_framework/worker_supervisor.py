@@ -0,0 +1,239 @@
+# -*- coding: UTF-8 -*-
+"""
+Run a service in many processes on one node, so that CPU heavy handlers use all the cores.
+
+All the worker processes start the same service (same app id), so they are members of one consumer group and kafka
+assigns each of them a disjoint subset of the partitions of the input topics. When a worker stops or crashes, its
+partitions are rebalanced to the others until it is restarted. Note that a topic with fewer partitions than workers
+leaves some workers idle.
+
+    supervisor = WorkerSupervisor(create_scholar_service, num_workers=8)
+    supervisor.run()
+
+where create_scholar_service returns the service bound to its streams and not started yet.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from typing import Callable, Dict, Any, List, Optional, NamedTuple
+
+from .faust_utilities import FaustUtilities
+from .metrics import Metrics
+from .service import Service
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerMetrics(NamedTuple):
+    """sent periodically by each worker to the supervisor"""
+
+    worker_index: int
+    pid: int
+    metrics: Dict[str, Any]
+
+
+class _Worker:
+
+    __slots__ = ("index", "process", "start_time", "num_restarts", "restart_time")
+
+    def __init__(self, index: int):
+        super().__init__()
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.start_time: float = 0
+        self.num_restarts = 0
+        self.restart_time: Optional[float] = None
+        """time.monotonic() when the worker is restarted after crash, None if it's not waiting for restart"""
+
+
+def _run_worker(service_factory: Callable[[], Service], worker_index: int, metrics_queue: multiprocessing.Queue,
+                metrics_interval_seconds: float):
+    """entry of worker processes"""
+    # the supervisor forwards SIGTERM to workers, ctrl-c in terminal is handled by the supervisor only
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    FaustUtilities.set_data_dir_suffix(f"_worker_{worker_index}")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    service = service_factory()
+    stopping = asyncio.Event()
+
+    async def report_metrics():
+        while True:
+            try:
+                metrics_queue.put_nowait(WorkerMetrics(worker_index, os.getpid(), Metrics.snapshot()))
+            except queue.Full:
+                pass
+            await asyncio.sleep(metrics_interval_seconds)
+
+    async def run():
+        await service.start()
+        logger.info(f"worker {worker_index} of {service._get_app_id()} started in process {os.getpid()}")
+        reporter = asyncio.ensure_future(report_metrics())
+        await stopping.wait()
+        reporter.cancel()
+        # leave the consumer group, so that the partitions are rebalanced to other workers at once
+        await service.stop()
+
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.run_until_complete(run())
+
+
+class WorkerSupervisor:
+    """
+    Fork num_workers processes, each of which runs the service returned by service_factory, and restart the ones
+    exited unexpectedly. A worker crashing soon after started is restarted with exponential backoff.
+
+    SIGTERM or SIGINT to the supervisor process is forwarded to the workers as SIGTERM, and the workers not exited in
+    stop_timeout_seconds are killed.
+    """
+
+    def __init__(self, service_factory: Callable[[], Service], num_workers: Optional[int] = None,
+                 restart_backoff_seconds: float = 1, max_restart_backoff_seconds: float = 60,
+                 metrics_interval_seconds: float = 10, stop_timeout_seconds: float = 30):
+        """
+        :param service_factory: called in each worker process, must be picklable if the start method of
+        multiprocessing is not fork
+        :param num_workers: number of cpu cores if None
+        """
+        super().__init__()
+        self._service_factory = service_factory
+        self._num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self._restart_backoff_seconds = restart_backoff_seconds
+        self._max_restart_backoff_seconds = max_restart_backoff_seconds
+        self._metrics_interval_seconds = metrics_interval_seconds
+        self._stop_timeout_seconds = stop_timeout_seconds
+
+        self._workers: List[_Worker] = [_Worker(i) for i in range(self._num_workers)]
+        self._metrics_queue: multiprocessing.Queue = multiprocessing.Queue(maxsize=self._num_workers * 16)
+        self._metrics_by_worker: Dict[int, WorkerMetrics] = dict()
+        self._stopping = False
+
+    @property
+    def num_workers(self) -> int:
+        return self._num_workers
+
+    def _start_worker(self, worker: _Worker):
+        worker.process = multiprocessing.Process(target=_run_worker, name=f"worker_{worker.index}",
+                                                 args=(self._service_factory, worker.index, self._metrics_queue,
+                                                       self._metrics_interval_seconds))
+        worker.process.start()
+        worker.start_time = time.monotonic()
+        worker.restart_time = None
+
+    def _check_worker(self, worker: _Worker):
+        if worker.restart_time is not None:
+            if time.monotonic() >= worker.restart_time:
+                worker.num_restarts = worker.num_restarts + 1
+                Metrics.increase("supervisor.workers.restarted")
+                self._start_worker(worker)
+            return
+
+        process = worker.process
+        if process.is_alive():
+            return
+
+        uptime_seconds = time.monotonic() - worker.start_time
+        # a worker which has run for long is restarted at once, otherwise back off exponentially
+        if uptime_seconds > self._max_restart_backoff_seconds:
+            worker.num_restarts = 0
+        backoff_seconds = 0 if worker.num_restarts == 0 else \
+            min(self._restart_backoff_seconds * 2 ** (worker.num_restarts - 1), self._max_restart_backoff_seconds)
+        logger.warning(f"worker {worker.index} (pid {process.pid}) exited with code {process.exitcode} after "
+                       f"{uptime_seconds:.1f} seconds, restart in {backoff_seconds:.1f} seconds")
+        self._metrics_by_worker.pop(worker.index, None)
+        worker.restart_time = time.monotonic() + backoff_seconds
+
+    def _collect_metrics(self):
+        while True:
+            try:
+                worker_metrics: WorkerMetrics = self._metrics_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._metrics_by_worker[worker_metrics.worker_index] = worker_metrics
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        metrics of all the workers: counters and gauges are summed, samples are merged with count summed, mean
+        weighted by count, and max / percentiles taken as the max of the workers
+        """
+        self._collect_metrics()
+        aggregated: Dict[str, Any] = dict()
+        for worker_metrics in self._metrics_by_worker.values():
+            for name, value in worker_metrics.metrics.items():
+                if not isinstance(value, dict):
+                    aggregated[name] = aggregated.get(name, 0) + value
+                    continue
+
+                merged = aggregated.get(name, None)
+                if merged is None:
+                    aggregated[name] = dict(value)
+                    continue
+
+                count = merged["count"] + value["count"]
+                if "mean" in value:
+                    if "mean" in merged:
+                        merged["mean"] = (merged["mean"] * merged["count"] + value["mean"] * value["count"]) / count
+                        for key in ("max", "p50", "p90", "p99"):
+                            merged[key] = max(merged[key], value[key])
+                    else:
+                        merged.update(value)
+                merged["count"] = count
+
+        aggregated["supervisor.workers.alive"] = sum(1 for worker in self._workers
+                                                     if worker.process is not None and worker.process.is_alive())
+        aggregated["supervisor.workers.restarted"] = Metrics.get_counter("supervisor.workers.restarted")
+        return aggregated
+
+    def metrics_by_worker(self) -> Dict[int, WorkerMetrics]:
+        self._collect_metrics()
+        return dict(self._metrics_by_worker)
+
+    def stop(self):
+        """forward SIGTERM to the workers, can be called from a signal handler"""
+        self._stopping = True
+
+    def run(self, on_metrics: Optional[Callable[[Dict[str, Any]], None]] = None):
+        """
+        start the workers and supervise them until stopped. on_metrics is called with the aggregated metrics every
+        metrics_interval_seconds
+        """
+        for signal_num in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_num, lambda signum, stack_frame: self.stop())
+
+        for worker in self._workers:
+            self._start_worker(worker)
+        logger.info(f"{self._num_workers} workers started")
+
+        next_metrics_time = time.monotonic() + self._metrics_interval_seconds
+        while not self._stopping:
+            for worker in self._workers:
+                self._check_worker(worker)
+            self._collect_metrics()
+
+            if on_metrics is not None and time.monotonic() >= next_metrics_time:
+                on_metrics(self.metrics())
+                next_metrics_time = time.monotonic() + self._metrics_interval_seconds
+            time.sleep(0.2)
+
+        self._stop_workers()
+
+    def _stop_workers(self):
+        processes = [worker.process for worker in self._workers
+                     if worker.process is not None and worker.process.is_alive()]
+        for process in processes:
+            os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self._stop_timeout_seconds
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"worker process {process.pid} not stopped in {self._stop_timeout_seconds} seconds, "
+                               f"kill it")
+                process.kill()
+                process.join()
+        logger.info(f"{len(processes)} workers stopped")
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark of a class endpoint served by 1 to N callee processes.
+
+Each callee process runs RPCEndPointService(SlowSquare), all of them are in the same consumer group, and each request
+is executed by one of them. The caller sends a batch of concurrent calls for each number of callee processes and
+prints the throughput.
+"""
+import asyncio
+import logging
+import multiprocessing
+import sys
+import time
+
+import faust
+
+from gs_framework.activatable_stateful_service import Env
+from gs_framework.stream_rpc import RPCCaller, RPCEndPointService, RPCEndPoint, RPCStubData
+
+logger = logging.getLogger(__name__)
+
+CALLEE_TOPIC = faust.types.TP("benchmark_rpc_load_balance_callee", 8)
+CALLER_TOPIC = faust.types.TP("benchmark_rpc_load_balance_caller", 1)
+
+
+class SlowSquare:
+
+    @staticmethod
+    def square(x: int) -> int:
+        # blocking on purpose, a callee process executes one call at a time
+        time.sleep(0.05)
+        return x * x
+
+
+def run_callee():
+    async def start_callee():
+        callee_service = RPCEndPointService(SlowSquare)
+        callee_service.bind_rpc_callee_stream(CALLEE_TOPIC)
+        await callee_service.start()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(start_callee())
+    loop.run_forever()
+
+
+class BenchmarkCaller(RPCCaller, Env):
+
+    def __init__(self, name: str):
+        super().__init__()
+
+    async def run_batch(self, num_calls: int) -> float:
+        stub = self._create_rpc_stub(RPCStubData(CALLEE_TOPIC, RPCEndPoint(SlowSquare)))
+        start_time = time.monotonic()
+        results = await asyncio.gather(*[stub.square(i, rpc_timeout_seconds=600) for i in range(num_calls)])
+        assert results == [i * i for i in range(num_calls)]
+        return num_calls / (time.monotonic() - start_time)
+
+
+async def run_benchmark(max_num_callees: int, num_calls: int, rebalance_seconds: float):
+    caller = BenchmarkCaller("benchmark_rpc_load_balance")
+    caller.bind(topic_define=CALLER_TOPIC)
+    caller.rpc_caller_stream.bind(CALLER_TOPIC)
+    await caller.start()
+
+    callee_processes = list()
+    for num_callees in range(1, max_num_callees + 1):
+        callee_process = multiprocessing.Process(target=run_callee, daemon=True)
+        callee_process.start()
+        callee_processes.append(callee_process)
+
+        # wait for the consumer group to rebalance
+        await asyncio.sleep(rebalance_seconds)
+        calls_per_second = await caller.run_batch(num_calls)
+        print(f"{num_callees} callee processes: {calls_per_second:.1f} calls per second")
+
+    for callee_process in callee_processes:
+        callee_process.terminate()
+
+
+if __name__ == "__main__":
+    max_num_callees = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    asyncio.get_event_loop().run_until_complete(run_benchmark(max_num_callees, num_calls=400, rebalance_seconds=30))
@@ -0,0 +1,42 @@
+# -*- coding: UTF-8 -*-
+"""
+Compare the latency of launching notebook runner processes by exec and by fork from a SubProcessZygote.
+
+Each launch runs the import of gs_framework.colab.colab_pool_env done by ColabPoolEnv.run_notebook, the latency is
+measured until the process exits
+"""
+import asyncio
+import time
+
+from gs_framework.metrics import Metrics
+from gs_framework.sub_process_executor import AsyncSubProcessProtocol, SubProcessZygote, run_sub_process
+
+CODE = "from gs_framework.colab.colab_pool_env import run_notebook_process"
+
+
+async def measure(zygote, num_launches: int) -> float:
+    seconds = list()
+    for _ in range(num_launches):
+        start_time = time.monotonic()
+        sub_process_exec_info = await run_sub_process(CODE, AsyncSubProcessProtocol, zygote)
+        await sub_process_exec_info.exit_future
+        assert sub_process_exec_info.transport.get_returncode() == 0
+        seconds.append(time.monotonic() - start_time)
+    return sum(seconds) / len(seconds)
+
+
+async def run_benchmark(num_launches: int = 10):
+    exec_seconds = await measure(None, num_launches)
+
+    zygote = SubProcessZygote(["gs_framework.colab.colab_pool_env"])
+    await zygote.start()
+    await measure(zygote, 1)  # wait for the zygote to finish preloading
+    zygote_seconds = await measure(zygote, num_launches)
+    zygote.stop()
+
+    print(f"exec: {exec_seconds * 1000:.1f} ms per task, zygote: {zygote_seconds * 1000:.1f} ms per task")
+    print(Metrics.snapshot())
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(run_benchmark())
@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+"""
+Run two services on the in process broker, no kafka needed, and measure the throughput of state messages between them
+"""
+import asyncio
+import time
+from typing import Any, Dict, List
+
+import faust
+
+from gs_framework.activatable_stateful_service import Env
+from gs_framework.faust_utilities import FaustUtilities
+from gs_framework.state_stream import ObjectStateStream
+from gs_framework.state_var_change_dispatcher import state_var_change_handler
+from gs_framework.state_variable import StateVariable
+from gs_framework.stateful_object import State, create_stateful_object
+
+
+class CountMessage(State):
+
+    count = StateVariable(dtype=int, default_val=0, help="sequence number of the message")
+
+
+class Sender(Env):
+
+    count_stream: ObjectStateStream = ObjectStateStream.bind_at_runtime()
+
+    def __init__(self, name: str):
+        super().__init__()
+
+    async def send(self, num_messages: int):
+        for i in range(num_messages):
+            message = create_stateful_object(i, CountMessage)
+            message[CountMessage.count].VALUE = i
+            await message.commit_state_var_changes(self.count_stream)
+
+
+class Receiver(Env):
+
+    count_stream: ObjectStateStream = ObjectStateStream.bind_at_runtime()
+
+    def __init__(self, name: str, num_messages: int):
+        super().__init__()
+        self._num_messages = num_messages
+        self._num_received = 0
+        self.all_received = asyncio.Event()
+
+    @state_var_change_handler(state_vars=CountMessage, state_var_source=count_stream)
+    def on_count_message(self, sender_pk: Any, state_vars: Dict[str, Any], triggering_state_var_names: List[str]):
+        self._num_received = self._num_received + 1
+        if self._num_received >= self._num_messages:
+            self.all_received.set()
+
+
+async def run_test(num_messages: int = 10000):
+    FaustUtilities.use_in_process_broker("test_in_process_broker")
+
+    count_topic = faust.types.TP(topic="test_in_process_broker_count", partition=4)
+    sender = Sender("sender")
+    receiver = Receiver("receiver", num_messages)
+    for env, status_topic_name in ((sender, "test_in_process_broker_sender"),
+                                   (receiver, "test_in_process_broker_receiver")):
+        env.bind(topic_define=faust.types.TP(topic=status_topic_name, partition=1))
+        env.count_stream.bind(topic_define=count_topic)
+        await env.start()
+
+    start_time = time.monotonic()
+    await sender.send(num_messages)
+    await receiver.all_received.wait()
+    seconds = time.monotonic() - start_time
+    print(f"{num_messages} messages in {seconds:.3f} seconds, {num_messages / seconds:.0f} messages per second")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(run_test())